@@ -0,0 +1,122 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "sqlite.db")
+# Answers kept before the least recently used ones are evicted, 0 disables the cache
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+# Cosine similarity of the question embeddings above which a cached answer is reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+# Seconds a cached answer stays valid
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+
+class AnswerCache:
+    """
+    A semantic cache of answers to questions.
+
+    An answer is reused for a question whose embedding is close enough to a cached
+    question's, asked to the same model against the same corpus version. Entries expire
+    after `ttl` seconds and the least recently used ones are evicted past `max_entries`.
+
+    Args:
+        path (str): The SQLite file holding the cache.
+        threshold (float): The minimum cosine similarity of a hit.
+        ttl (float): Seconds an answer stays valid.
+        max_entries (int): The maximum number of cached answers.
+
+    Attributes:
+        stats (dict): Cumulative "hits" and "misses" counters.
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS answer_cache
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT, corpus_version TEXT, query TEXT,
+                  vector BLOB, answer TEXT, sources TEXT, created REAL, last_used REAL)''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS answer_cache_key ON answer_cache (model, corpus_version)")
+        self.conn.commit()
+
+    def lookup(self, model, corpus_version, vector):
+        """
+        Finds the cached answer of the most similar question.
+
+        Args:
+            model (str): The model that answers.
+            corpus_version (str): The version stamp of the ingested documents.
+            vector (list[float]): The embedding of the question.
+
+        Returns:
+            dict: The "query", "answer", "sources" and "similarity" of the hit, None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, query, vector, answer, sources FROM answer_cache WHERE model = ? AND corpus_version = ? AND created > ?",
+                (model, corpus_version, now - self.ttl),
+            ).fetchall()
+            best = None
+            if rows:
+                query_vector = np.asarray(vector, dtype=np.float32)
+                matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+                norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query_vector) or 1.0)
+                similarities = matrix @ query_vector / np.where(norms == 0, 1.0, norms)
+                index = int(np.argmax(similarities))
+                if similarities[index] >= self.threshold:
+                    best = rows[index], float(similarities[index])
+
+            if best is None:
+                self.stats["misses"] += 1
+                return None
+            (entry_id, query, _, answer, sources), similarity = best
+            self.conn.execute("UPDATE answer_cache SET last_used = ? WHERE id = ?", (now, entry_id))
+            self.conn.commit()
+            self.stats["hits"] += 1
+        return {"query": query, "answer": answer, "sources": json.loads(sources), "similarity": similarity}
+
+    def store(self, model, corpus_version, query, vector, answer, sources):
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO answer_cache (model, corpus_version, query, vector, answer, sources, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (model, corpus_version, query, np.asarray(vector, dtype=np.float32).tobytes(), answer, json.dumps(sources), now, now),
+            )
+            # Drop expired answers, then the least recently used ones past the size limit.
+            self.conn.execute("DELETE FROM answer_cache WHERE created <= ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM answer_cache WHERE id NOT IN (SELECT id FROM answer_cache ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM answer_cache")
+            self.conn.commit()
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+def load_answer_cache():
+    # The shared answer cache, None when ANSWER_CACHE_MAX_ENTRIES is 0
+    global _answer_cache
+    if ANSWER_CACHE_MAX_ENTRIES <= 0:
+        return None
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+        return _answer_cache
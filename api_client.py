@@ -0,0 +1,79 @@
+import json
+import os
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# The analyzer service the GUI uses instead of running the backend itself, e.g. http://127.0.0.1:8765
+ANALYZER_SERVER_URL = os.getenv("ANALYZER_SERVER_URL")
+ANALYZER_SERVER_TIMEOUT = float(os.getenv("ANALYZER_SERVER_TIMEOUT", 600))
+
+class AnalyzerClient:
+    """
+    A client of server.py with the same functions as the local backend, so the GUI can
+    use a shared, warm service instead of loading the vector store and models itself.
+
+    Args:
+        base_url (str): The URL of the service.
+        timeout (float): Seconds to wait for a response.
+    """
+
+    def __init__(self, base_url=ANALYZER_SERVER_URL, timeout=ANALYZER_SERVER_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode("utf-8")
+        request = Request(self.base_url + path, data=body, method=method, headers={"Content-Type": "application/json"})
+        try:
+            return urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            raise RuntimeError(json.loads(e.read() or b"{}").get("error", str(e))) from e
+
+    def _call(self, method, path, data=None):
+        with self._request(method, path, data) as response:
+            return json.loads(response.read())
+
+    def _stream(self, path, data, on_token):
+        # Send tokens to on_token as they arrive and return the final object
+        with self._request("POST", path, dict(data, stream=True)) as response:
+            for line in response:
+                message = json.loads(line)
+                if "token" in message:
+                    on_token(message["token"])
+                elif "error" in message:
+                    raise RuntimeError(message["error"])
+                else:
+                    return message
+        raise RuntimeError("the server closed the stream without a result")
+
+    def query_rag(self, model, session_id, query_text, on_token=None, scope=None):
+        # Same result as query_data_v2.query_rag
+        data = {"model": model, "session": session_id, "question": query_text, "scope": scope}
+        if on_token is None:
+            response = self._call("POST", "/query", data)
+        else:
+            response = self._stream("/query", data, on_token)
+        f_sources = "<b>Sources:</b><ul>" + "".join(f"<li>{source}</li>" for source in response["sources"]) + "</ul>"
+        return [f"{response['answer']}<br>", f_sources, response["sources"]]
+
+    def summarize_docs(self, model, session_id):
+        return self._call("POST", "/summarize", {"model": model, "session": session_id})["summary"]
+
+    def run_database(self):
+        self._call("POST", "/ingest", {})
+        return True
+
+    def docs_used_in_chroma(self):
+        return self._call("GET", "/documents")["documents"]
+
+    def return_chat_history(self):
+        return self._call("GET", "/history")["sessions"]
+
+    def generate_session_id(self):
+        return self._call("POST", "/sessions", {})["session"]
+
+    def health(self):
+        return self._call("GET", "/health")
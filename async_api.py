@@ -0,0 +1,174 @@
+import asyncio
+import os
+import time
+import weakref
+from collections import OrderedDict
+
+import httpx
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from langchain_openai import ChatOpenAI
+from langchain_core.messages import HumanMessage, AIMessage
+
+from llm_utils import get_llm, OPENAI_MODELS
+from db_utils import create_db, get_session_history
+from vector_store import index_version
+from query_data_v2 import create_chain, expand_scope, lookup_answer, store_answer, format_response, context_sources, CHAIN_CACHE_SIZE
+from summarize_docs import create_summary_chain, load_documents_to_summarize
+from stage_timings import stage, record
+
+# Questions or summaries running at the same time against each backend
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 2))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))
+
+def backend_of(model):
+    return "openai" if model in OPENAI_MODELS else "ollama"
+
+class _LoopState:
+    # Clients, semaphores and chains bound to one event loop
+    def __init__(self):
+        self.semaphores = {
+            "ollama": asyncio.Semaphore(OLLAMA_MAX_CONCURRENCY),
+            "openai": asyncio.Semaphore(OPENAI_MAX_CONCURRENCY),
+        }
+        # One connection pool for every OpenAI model, capped like the backend.
+        self.openai_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=OPENAI_MAX_CONCURRENCY))
+        self.llms = {}
+        self.chains = OrderedDict()
+
+_loop_states = weakref.WeakKeyDictionary()
+
+def _state():
+    loop = asyncio.get_running_loop()
+    if loop not in _loop_states:
+        _loop_states[loop] = _LoopState()
+    return _loop_states[loop]
+
+def aget_llm(model: str):
+    """
+    Returns the client of a model for the running event loop. OpenAI models share the
+    loop's HTTP client; Ollama clients hold no connection and are shared with get_llm.
+
+    Args:
+        model (str): The model name.
+
+    Returns:
+        The ChatOpenAI or Ollama client.
+    """
+    state = _state()
+    if model not in state.llms:
+        if backend_of(model) == "openai":
+            state.llms[model] = ChatOpenAI(model=model, http_async_client=state.openai_client)
+        else:
+            state.llms[model] = get_llm(model)
+    return state.llms[model]
+
+async def _aget_chain(model):
+    # Like query_data_v2.get_chain, per event loop and without the message history wrapper
+    state = _state()
+    version = index_version()
+    cached = state.chains.get(model)
+    if cached is not None and cached[0] == version:
+        state.chains.move_to_end(model)
+        return cached[1]
+
+    chain = await asyncio.to_thread(create_chain, model, aget_llm(model))
+    state.chains[model] = (version, chain)
+    state.chains.move_to_end(model)
+    while len(state.chains) > CHAIN_CACHE_SIZE:
+        state.chains.popitem(last=False)
+    return chain
+
+async def aquery_rag(model: str, session_id: str, query_text: str, on_token=None, scope=None):
+    """
+    Asynchronous counterpart of query_rag.
+
+    At most OLLAMA_MAX_CONCURRENCY / OPENAI_MAX_CONCURRENCY questions are answered at
+    the same time per backend; the others wait for their turn. Cancelling the task
+    cancels the model calls (query rewrite, SQL generation and answer) and nothing is
+    written to the chat history; a vector or lexical search already running in a worker
+    thread finishes in the background.
+
+    Args:
+        model (str): The name of the RAG model to use.
+        session_id (str): The session ID for the query.
+        query_text (str): The text of the query.
+        on_token (function): Called with every piece of the answer as it is generated.
+        scope (dict): Restricts retrieval to some documents, see query_data_v2.expand_scope.
+
+    Returns:
+        list: A list containing the formatted response, formatted sources, and sources.
+    """
+    scope = await asyncio.to_thread(expand_scope, scope)
+    history = get_session_history(session_id)
+    with stage("history"):
+        messages = await asyncio.to_thread(lambda: history.messages)
+
+    hit, key = await asyncio.to_thread(lookup_answer, model, query_text, messages, scope)
+    if hit:
+        answer, sources = hit["answer"], hit["sources"]
+        if on_token:
+            on_token(answer)
+    else:
+        chain = await _aget_chain(model)
+        inputs = {"input": query_text, "chat_history": messages, "scope": scope}
+        with stage("queue"):
+            await _state().semaphores[backend_of(model)].acquire()
+        try:
+            with stage("chain"):
+                if on_token is None:
+                    response = await chain.ainvoke(inputs)
+                else:
+                    start, first_token = time.perf_counter(), True
+                    response = {"answer": ""}
+                    async for chunk in chain.astream(inputs):
+                        for name, value in chunk.items():
+                            if name == "answer":
+                                if first_token:
+                                    record("first_token", time.perf_counter() - start)
+                                    first_token = False
+                                response["answer"] += value
+                                on_token(value)
+                            else:
+                                response[name] = value
+        finally:
+            _state().semaphores[backend_of(model)].release()
+        answer = response["answer"]
+        sources = context_sources(response["context"])
+        await asyncio.to_thread(store_answer, model, key, query_text, answer, sources)
+
+    with stage("history"):
+        await asyncio.to_thread(history.add_messages, [HumanMessage(content=query_text), AIMessage(content=answer)])
+        return await asyncio.to_thread(format_response, session_id, answer, sources)
+
+async def asummarize_docs(model: str, session_id: str):
+    """
+    Asynchronous counterpart of summarize_docs, sharing the per-backend concurrency limit.
+
+    Args:
+        model (str): The model to use for summarization.
+        session_id (str): The session ID for the chat history.
+
+    Returns:
+        str: The summaries of the documents.
+    """
+    split_docs = await asyncio.to_thread(load_documents_to_summarize)
+    print(f"Summarizing documents using {model}, Please wait...")
+
+    await asyncio.to_thread(create_db)
+    chain = create_summary_chain(model, llm=aget_llm(model))
+    async with _state().semaphores[backend_of(model)]:
+        response = await chain.ainvoke(split_docs)
+    summaries = response["output_text"]
+
+    await asyncio.to_thread(get_session_history(session_id).add_ai_message, summaries)
+    print(f"Summaries:\n{summaries}")
+    return summaries
+
+async def aclose():
+    # Close the HTTP clients of the running event loop
+    state = _loop_states.pop(asyncio.get_running_loop(), None)
+    if state is not None:
+        await state.openai_client.aclose()
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from async_api import aquery_rag, aclose
+from stage_timings import start_timings, percentile
+
+# Questions answered at the same time, on top of the per-backend limits of async_api
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_DEFAULT_MODEL = os.getenv("BATCH_DEFAULT_MODEL", "gpt-3.5-turbo-0125")
+
+# Stages in report order; "generation" is the part of "chain" not spent rewriting or retrieving.
+STAGES = ["history", "cache", "queue", "rewrite", "retrieval", "table_query", "first_token", "generation", "chain", "total"]
+
+def read_records(path, default_model, default_session=None):
+    """
+    Reads the questions of a JSONL workload.
+
+    Every line is an object with a "question" and optionally a "model", a "session"
+    (or "session_id") and a "scope" (see query_data_v2.expand_scope); blank lines are skipped.
+
+    Records without a session get a session of their own, so independent questions do
+    not see each other's answers, unless a default session is given.
+
+    Args:
+        path (str): The JSONL file, "-" for standard input.
+        default_model (str): The model of records without one.
+        default_session (str): The session of records without one, shared by all of them.
+
+    Returns:
+        list[dict]: The records with "line", "model", "session", "question" and "scope".
+    """
+    records = []
+    stream = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with stream:
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            records.append({
+                "line": line_number,
+                "model": data.get("model") or default_model,
+                "session": str(data.get("session") or data.get("session_id") or default_session or f"batch-{uuid.uuid4().hex}"),
+                "question": data["question"],
+                "scope": data.get("scope"),
+            })
+    return records
+
+async def answer_record(record, limit):
+    # Answer one record, with its stage timings collected in this task's context
+    timings = start_timings()
+    result = dict(record)
+    async with limit:
+        start = time.perf_counter()
+        try:
+            f_answer, _, sources = await aquery_rag(record["model"], record["session"], record["question"], scope=record["scope"])
+            result["answer"] = f_answer.removesuffix("<br>")
+            result["sources"] = sources
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        timings["total"] = time.perf_counter() - start
+
+    if "chain" in timings:
+        spent = sum(timings.get(name, 0.0) for name in ("rewrite", "retrieval", "table_query"))
+        timings["generation"] = max(timings["chain"] - spent, 0.0)
+    result["timings"] = {name: round(seconds, 6) for name, seconds in timings.items()}
+    return result
+
+async def run_batch(records, output, concurrency=BATCH_CONCURRENCY):
+    """
+    Answers the records and writes one JSON line per answer as soon as it is ready.
+
+    Records of the same session are answered one after the other, in input order, so
+    follow-up questions see the answers before them; different sessions run in parallel.
+
+    Args:
+        records (list[dict]): The records from read_records.
+        output: A text stream for the answers.
+        concurrency (int): The number of questions answered at the same time.
+
+    Returns:
+        tuple: (the results in completion order, the elapsed seconds).
+    """
+    limit = asyncio.Semaphore(concurrency)
+    sessions = {}
+    for record in records:
+        sessions.setdefault(record["session"], []).append(record)
+
+    results = []
+
+    async def run_session(session_records):
+        for record in session_records:
+            result = await answer_record(record, limit)
+            results.append(result)
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            status = "❌" if "error" in result else "✅"
+            print(f"{status} [{len(results)}/{len(records)}] line {record['line']} in {result['timings']['total']:.2f}s")
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(run_session(session_records) for session_records in sessions.values()))
+    finally:
+        await aclose()
+    return results, time.perf_counter() - start
+
+def print_report(results, elapsed):
+    # Throughput and latency percentiles per stage
+    errors = sum(1 for result in results if "error" in result)
+    print(f"\n📊 {len(results)} questions in {elapsed:.2f}s: {len(results) / elapsed if elapsed else 0:.2f} questions/s, "
+          f"{errors} errors")
+    print(f"{'stage':<12} {'count':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name in STAGES:
+        values = [result["timings"][name] for result in results if name in result["timings"]]
+        if not values:
+            continue
+        p50, p95, p99 = (percentile(values, p) * 1000 for p in (50, 95, 99))
+        print(f"{name:<12} {len(values):>6} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions without the GUI.")
+    parser.add_argument("input", help='JSONL records with "question" and optionally "model" and "session", "-" for stdin.')
+    parser.add_argument("-o", "--output", default="answers.jsonl", help="Where to write the answers as JSONL.")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--model", default=BATCH_DEFAULT_MODEL, help="The model of records without one.")
+    parser.add_argument("--session", help="A session shared by the records without one; by default each gets its own.")
+    args = parser.parse_args()
+
+    records = read_records(args.input, args.model, args.session)
+    with open(args.output, "w", encoding="utf-8") as output:
+        results, elapsed = asyncio.run(run_batch(records, output, max(args.concurrency, 1)))
+    print_report(results, elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# Benchmarks for the ingestion path. Point OLLAMA_HOST at ollama_standin.py to run them
+# without the real models, e.g.:
+#   python ollama_standin.py --port 11435 &
+#   OLLAMA_HOST=http://127.0.0.1:11435 python benchmarks.py embeddings
+
+def bench_embeddings(args):
+    from llm_utils import BatchedOllamaEmbeddings
+
+    texts = [f"chunk {i}: " + "lorem ipsum dolor sit amet " * 30 for i in range(args.chunks)]
+    for batch_size in args.batch_sizes:
+        for max_in_flight in args.in_flight:
+            embeddings = BatchedOllamaEmbeddings(batch_size=batch_size, max_in_flight=max_in_flight)
+            start = time.perf_counter()
+            embeddings.embed_documents(texts)
+            elapsed = time.perf_counter() - start
+            print(
+                f"batch_size={batch_size:<4} in_flight={max_in_flight:<3} "
+                f"{len(texts) / elapsed:8.1f} chunks/s  retries={embeddings.stats['retries']}"
+            )
+
+def bench_splitter(args):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from preprocess import scan_directory, documents_file_loader, CHUNK_SIZE, CHUNK_OVERLAP
+    from offset_splitter import OffsetTextSplitter
+
+    documents = documents_file_loader(scan_directory(args.data)[".pdf"])
+    characters = sum(len(document.page_content) for document in documents)
+    print(f"{len(documents)} pages, {characters} characters, {args.repeat} repeats")
+
+    splitters = {
+        "RecursiveCharacterTextSplitter": RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, length_function=len, is_separator_regex=False
+        ),
+        "OffsetTextSplitter": OffsetTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP),
+    }
+    outputs = {}
+    for name, splitter in splitters.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            chunks = splitter.split_documents(documents)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        outputs[name] = [chunk.page_content for chunk in chunks]
+        print(f"{name:<32} {elapsed * 1000:8.2f} ms  {characters / elapsed / 1e6:6.2f} M chars/s  {len(chunks)} chunks")
+
+    same = outputs["RecursiveCharacterTextSplitter"] == outputs["OffsetTextSplitter"]
+    print(f"Identical chunks: {same}")
+
+def bench_pdf(args):
+    from difflib import SequenceMatcher
+    from preprocess import scan_directory, pdf_backends, split_documents
+
+    file_paths = scan_directory(args.data)[".pdf"]
+    results = {}
+    for name, loader_cls in pdf_backends.items():
+        start = time.perf_counter()
+        documents = [document for file_path in file_paths for document in loader_cls(file_path).load()]
+        elapsed = time.perf_counter() - start
+        results[name] = documents
+        characters = sum(len(document.page_content) for document in documents)
+        print(
+            f"{name:<8} {elapsed:8.3f} s  {len(documents)} pages  {characters} characters"
+            f"  {len(split_documents(documents))} chunks"
+        )
+
+    baseline, candidate = results["pypdf"], results["pymupdf"]
+    baseline_keys = [(d.metadata["source"], d.metadata["page"]) for d in baseline]
+    candidate_keys = [(d.metadata["source"], d.metadata["page"]) for d in candidate]
+    print(f"Same source/page metadata: {baseline_keys == candidate_keys}")
+
+    similarities = [
+        SequenceMatcher(None, a.page_content, b.page_content, autojunk=False).ratio()
+        for a, b in zip(baseline, candidate)
+    ]
+    if similarities:
+        print(
+            f"Page text similarity: mean {sum(similarities) / len(similarities):.3f},"
+            f" min {min(similarities):.3f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Document Analyzer benchmarks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    embeddings_parser = subparsers.add_parser("embeddings", help="Embedding throughput for batch sizes and concurrency.")
+    embeddings_parser.add_argument("--chunks", type=int, default=512)
+    embeddings_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    embeddings_parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 4, 8])
+    embeddings_parser.set_defaults(func=bench_embeddings)
+
+    splitter_parser = subparsers.add_parser("splitter", help="OffsetTextSplitter against RecursiveCharacterTextSplitter on the PDFs in data/.")
+    splitter_parser.add_argument("--data", default="data")
+    splitter_parser.add_argument("--repeat", type=int, default=20)
+    splitter_parser.set_defaults(func=bench_splitter)
+
+    pdf_parser = subparsers.add_parser("pdf", help="Speed and output of the PDF backends on the PDFs in data/.")
+    pdf_parser.add_argument("--data", default="data")
+    pdf_parser.set_defaults(func=bench_pdf)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,12 @@
 import sqlite3
 import json
+import threading
+
+from sqlalchemy import create_engine
+from langchain_community.chat_message_histories import SQLChatMessageHistory
+
+_history_engine = None
+_history_engine_lock = threading.Lock()
 
 def create_db():
     # Create a new SQLite3 database file (if it doesn't exist)
@@ -10,13 +17,22 @@ def create_db():
     conn.commit()
     conn.close()
 
+def get_session_history(session_id):
+    # Chat history of a session; every session shares one SQLAlchemy engine and its connection pool
+    global _history_engine
+    with _history_engine_lock:
+        if _history_engine is None:
+            _history_engine = create_engine("sqlite:///sqlite.db")
+    return SQLChatMessageHistory(session_id=session_id, connection=_history_engine, table_name="history")
+
 def generate_session_id():
     # Generate session id for use in chat history
     conn = sqlite3.connect('sqlite.db')
     c = conn.cursor()
 
-    # Get the maximum existing session ID from the message_store table
-    c.execute("SELECT MAX(session_id) FROM history")
+    # Get the maximum existing numeric session ID from the message_store table; sessions named
+    # by other clients (e.g. batch_query.py) are left out.
+    c.execute("SELECT MAX(CAST(session_id AS INTEGER)) FROM history WHERE session_id NOT GLOB '*[^0-9]*' AND session_id != ''")
     max_session_id = c.fetchone()[0]
 
     if max_session_id is None:
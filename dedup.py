@@ -0,0 +1,268 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+
+DEDUP_DB = "sqlite.db"
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+# Estimated Jaccard similarity of word shingles above which two chunks count as duplicates
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.85))
+DEDUP_NUM_PERM = 128
+# Chunks filtered per write transaction, so the other writers of sqlite.db get their turn
+DEDUP_COMMIT_INTERVAL = int(os.getenv("DEDUP_COMMIT_INTERVAL", 64))
+SHINGLE_SIZE = 5
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(42)
+_PERM_A = _rng.randint(1, _MERSENNE_PRIME, size=DEDUP_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, _MERSENNE_PRIME, size=DEDUP_NUM_PERM, dtype=np.uint64)
+
+def minhash(text):
+    """
+    Computes the MinHash signature of the word shingles of a text.
+
+    Args:
+        text (str): The text to sketch.
+
+    Returns:
+        np.ndarray: DEDUP_NUM_PERM uint32 values.
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in shingles],
+        dtype=np.uint64,
+    )
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+def lsh_bands(threshold, num_perm=DEDUP_NUM_PERM):
+    # Pick the most rows per band whose LSH threshold (1/b)^(1/r) is still below the similarity threshold
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+class NearDuplicateIndex:
+    """
+    A persistent MinHash/LSH index of the chunks stored in the vector store.
+
+    Chunks whose estimated similarity to a stored chunk reaches the threshold are
+    suppressed: they are not embedded or stored, and their source is recorded against the
+    stored chunk instead. The index lives in SQLite next to the ingestion manifest, so
+    chunks are also compared with the ones ingested in earlier runs.
+
+    Args:
+        path (str): The SQLite file holding the index.
+        threshold (float): The similarity threshold.
+
+    Attributes:
+        stats (dict): "chunks", "suppressed" and "characters_saved" counters for this index.
+        touched (set): IDs of stored chunks that received new duplicates.
+    """
+
+    def __init__(self, path=DEDUP_DB, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.bands, self.rows = lsh_bands(threshold)
+        self.stats = {"chunks": 0, "suppressed": 0, "characters_saved": 0}
+        self.touched = set()
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        c = self.conn.cursor()
+        # Readers of sqlite.db (chat history, manifest) do not wait for the dedup writes.
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute('''CREATE TABLE IF NOT EXISTS dedup_signatures
+                 (chunk_id TEXT PRIMARY KEY, source TEXT, signature BLOB)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS dedup_bands (band_key TEXT, chunk_id TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS dedup_suppressed
+                 (chunk_id TEXT PRIMARY KEY, source TEXT, kept_id TEXT)''')
+        c.execute("CREATE INDEX IF NOT EXISTS dedup_bands_key ON dedup_bands (band_key)")
+        c.execute("CREATE INDEX IF NOT EXISTS dedup_bands_chunk ON dedup_bands (chunk_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS dedup_signatures_source ON dedup_signatures (source)")
+        c.execute("CREATE INDEX IF NOT EXISTS dedup_suppressed_source ON dedup_suppressed (source)")
+        c.execute("CREATE INDEX IF NOT EXISTS dedup_suppressed_kept ON dedup_suppressed (kept_id)")
+        self.conn.commit()
+
+    def _band_keys(self, signature):
+        keys = []
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            keys.append(f"{band}:{hashlib.blake2b(values, digest_size=8).hexdigest()}")
+        return keys
+
+    def _find_duplicate(self, c, chunk_id, signature, band_keys):
+        placeholders = ",".join("?" * len(band_keys))
+        c.execute(
+            f"SELECT DISTINCT chunk_id FROM dedup_bands WHERE band_key IN ({placeholders}) AND chunk_id != ?",
+            [*band_keys, chunk_id],
+        )
+        for (candidate_id,) in c.fetchall():
+            row = c.execute("SELECT signature FROM dedup_signatures WHERE chunk_id = ?", (candidate_id,)).fetchone()
+            if row is None:
+                continue
+            candidate = np.frombuffer(row[0], dtype=np.uint32)
+            if np.mean(candidate == signature) >= self.threshold:
+                return candidate_id
+        return None
+
+    def filter(self, chunks):
+        """
+        Removes near-duplicates of already indexed chunks and indexes the rest.
+
+        The index is committed every DEDUP_COMMIT_INTERVAL chunks rather than once per
+        call, so the manifest and journal writes of the pipeline are not locked out.
+
+        Args:
+            chunks (list[Document]): Chunks with an "id" in their metadata.
+
+        Returns:
+            list[Document]: The chunks that should be stored.
+        """
+        kept = []
+        with self._lock:
+            c = self.conn.cursor()
+            for position, chunk in enumerate(chunks, start=1):
+                if position % DEDUP_COMMIT_INTERVAL == 0:
+                    self.conn.commit()
+                chunk_id = chunk.metadata["id"]
+                self.stats["chunks"] += 1
+
+                # A chunk that is already stored stays stored.
+                if c.execute("SELECT 1 FROM dedup_signatures WHERE chunk_id = ?", (chunk_id,)).fetchone():
+                    kept.append(chunk)
+                    continue
+
+                signature = minhash(chunk.page_content)
+                band_keys = self._band_keys(signature)
+                duplicate_of = self._find_duplicate(c, chunk_id, signature, band_keys)
+
+                if duplicate_of is not None:
+                    c.execute(
+                        "INSERT OR REPLACE INTO dedup_suppressed (chunk_id, source, kept_id) VALUES (?, ?, ?)",
+                        (chunk_id, chunk.metadata.get("source"), duplicate_of),
+                    )
+                    self.touched.add(duplicate_of)
+                    self.stats["suppressed"] += 1
+                    self.stats["characters_saved"] += len(chunk.page_content)
+                    continue
+
+                c.execute(
+                    "INSERT OR REPLACE INTO dedup_signatures (chunk_id, source, signature) VALUES (?, ?, ?)",
+                    (chunk_id, chunk.metadata.get("source"), signature.tobytes()),
+                )
+                c.executemany(
+                    "INSERT INTO dedup_bands (band_key, chunk_id) VALUES (?, ?)",
+                    [(band_key, chunk_id) for band_key in band_keys],
+                )
+                kept.append(chunk)
+            self.conn.commit()
+        return kept
+
+    def duplicate_sources(self, kept_ids):
+        """
+        Lists the sources every stored chunk also appeared in.
+
+        Args:
+            kept_ids (list[str]): IDs of stored chunks.
+
+        Returns:
+            dict: kept_id -> sorted list of the sources of its suppressed duplicates.
+        """
+        sources = {}
+        with self._lock:
+            for kept_id in kept_ids:
+                rows = self.conn.execute(
+                    "SELECT DISTINCT source FROM dedup_suppressed WHERE kept_id = ?", (kept_id,)
+                ).fetchall()
+                sources[kept_id] = sorted(row[0] for row in rows)
+        return sources
+
+    def kept_ids(self, sources):
+        """
+        Lists the stored chunks that stand in for chunks suppressed in the given sources.
+
+        Args:
+            sources (list[str]): Document paths.
+
+        Returns:
+            list[str]: The sorted IDs of the stored chunks.
+        """
+        sources = list(sources)
+        kept = set()
+        with self._lock:
+            # Stay below SQLite's limit on bound parameters.
+            for i in range(0, len(sources), 500):
+                part = sources[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT DISTINCT kept_id FROM dedup_suppressed WHERE source IN ({', '.join('?' * len(part))})", part
+                ).fetchall()
+                kept.update(row[0] for row in rows)
+        return sorted(kept)
+
+    def suppressed_sources(self):
+        # The sources that had at least one chunk suppressed
+        with self._lock:
+            rows = self.conn.execute("SELECT DISTINCT source FROM dedup_suppressed").fetchall()
+        return sorted(row[0] for row in rows)
+
+    def release(self, source, current_ids=None):
+        """
+        Forgets the chunks of a source that were deleted from the vector store.
+
+        Suppressed duplicates of those chunks now have nothing to point to, so the
+        sources they came from are returned to be re-indexed.
+
+        Args:
+            source (str): The source whose chunks were deleted.
+            current_ids (list[str]): Chunk IDs the source still produces, None when the whole source is gone.
+
+        Returns:
+            list[str]: Other sources that need to be re-indexed.
+        """
+        current_ids = set(current_ids or [])
+        with self._lock:
+            c = self.conn.cursor()
+            kept_ids = [
+                row[0] for row in c.execute("SELECT chunk_id FROM dedup_signatures WHERE source = ?", (source,))
+                if row[0] not in current_ids
+            ]
+            suppressed_ids = [
+                row[0] for row in c.execute("SELECT chunk_id FROM dedup_suppressed WHERE source = ?", (source,))
+                if row[0] not in current_ids
+            ]
+
+            orphaned_sources = set()
+            for kept_id in kept_ids:
+                rows = c.execute("SELECT source FROM dedup_suppressed WHERE kept_id = ?", (kept_id,)).fetchall()
+                orphaned_sources.update(row[0] for row in rows)
+                c.execute("DELETE FROM dedup_suppressed WHERE kept_id = ?", (kept_id,))
+                c.execute("DELETE FROM dedup_bands WHERE chunk_id = ?", (kept_id,))
+                c.execute("DELETE FROM dedup_signatures WHERE chunk_id = ?", (kept_id,))
+            c.executemany("DELETE FROM dedup_suppressed WHERE chunk_id = ?", [(chunk_id,) for chunk_id in suppressed_ids])
+            self.conn.commit()
+
+        orphaned_sources.discard(source)
+        return sorted(orphaned_sources)
+
+    def clear(self):
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("DELETE FROM dedup_signatures")
+            c.execute("DELETE FROM dedup_bands")
+            c.execute("DELETE FROM dedup_suppressed")
+            self.conn.commit()
+
+    def report(self):
+        if self.stats["chunks"]:
+            print(
+                f"🧹 Suppressed {self.stats['suppressed']} of {self.stats['chunks']} chunks as near-duplicates"
+                f" ({self.stats['suppressed'] / self.stats['chunks']:.0%}, {self.stats['characters_saved']} characters not embedded)"
+            )
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+# Vectors kept on disk before the least recently used ones are evicted
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 500000))
+
+def normalize_text(text):
+    # Collapse whitespace so re-flowed but otherwise identical chunks share an entry
+    return " ".join(text.split())
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+class CachedEmbeddings(Embeddings):
+    """
+    An on-disk embedding cache in front of another embedding function.
+
+    Vectors are keyed by (model name, hash of the normalized text) and stored in SQLite, so
+    they survive a reset of the vector store. When the cache grows past `max_entries` the
+    least recently used vectors are evicted.
+
+    Args:
+        embeddings (Embeddings): The embedding function called on cache misses.
+        model (str): The embedding model name, part of the cache key.
+        path (str): The SQLite file holding the cache.
+        max_entries (int): The maximum number of cached vectors.
+
+    Attributes:
+        stats (dict): Cumulative "hits", "misses" and "evictions" counters.
+    """
+
+    def __init__(self, embeddings, model, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.model = model
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS embedding_cache
+                 (model TEXT, text_hash TEXT, vector BLOB, last_used REAL, PRIMARY KEY (model, text_hash))''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embedding_cache_last_used ON embedding_cache (last_used)")
+        self.conn.commit()
+        self._count = self.conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+    def _lookup(self, hashes):
+        found = {}
+        hashes = list(hashes)
+        now = time.time()
+        with self._lock:
+            # Stay below SQLite's limit on bound parameters.
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embedding_cache WHERE model = ? AND text_hash IN ({placeholders})",
+                    [self.model, *part],
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = array("f", vector).tolist()
+                self.conn.executemany(
+                    "UPDATE embedding_cache SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, self.model, key) for key, _ in rows],
+                )
+            self.conn.commit()
+        return found
+
+    def _store(self, vectors):
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(self.model, key, array("f", vector).tobytes(), now) for key, vector in vectors.items()],
+            )
+            self._count += len(vectors)
+
+            if self._count > self.max_entries:
+                # Evict an extra 10% so eviction does not run on every write.
+                self._count = self.conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+                excess = self._count - int(self.max_entries * 0.9)
+                if excess > 0:
+                    self.conn.execute(
+                        "DELETE FROM embedding_cache WHERE rowid IN "
+                        "(SELECT rowid FROM embedding_cache ORDER BY last_used LIMIT ?)",
+                        (excess,),
+                    )
+                    self._count -= excess
+                    self.stats["evictions"] += excess
+            self.conn.commit()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes = [text_hash(text) for text in texts]
+        vectors = self._lookup(set(hashes))
+
+        # Embed every missing text once, even if it appears several times in the batch.
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        if missing:
+            new_vectors = dict(zip(missing, self.embeddings.embed_documents(list(missing.values()))))
+            self._store(new_vectors)
+            vectors.update(new_vectors)
+
+        with self._lock:
+            self.stats["misses"] += len(missing)
+            self.stats["hits"] += len(texts) - len(missing)
+        return [vectors[key] for key in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def throughput(self):
+        # Chunks per second of the wrapped embedding function, if it measures it
+        if hasattr(self.embeddings, "throughput"):
+            return self.embeddings.throughput()
+        return 0.0
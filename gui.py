@@ -14,11 +14,21 @@ from PyQt5.QtGui import *
 from qfluentwidgets import *
 
 from upload_files import select_files_and_move
-from summarize_docs import summarize_docs
-from query_data_v2 import query_rag
-from vector_store import run_database, docs_used_in_chroma
-from db_utils import generate_session_id, return_chat_history, create_db
 from llm_utils import list_local_models
+from api_client import ANALYZER_SERVER_URL, AnalyzerClient
+
+if ANALYZER_SERVER_URL:
+    # Share the warm backend of server.py instead of loading the vector store and models here.
+    client = AnalyzerClient(ANALYZER_SERVER_URL)
+    summarize_docs, query_rag = client.summarize_docs, client.query_rag
+    run_database, docs_used_in_chroma = client.run_database, client.docs_used_in_chroma
+    generate_session_id, return_chat_history = client.generate_session_id, client.return_chat_history
+    create_db = lambda: None
+else:
+    from summarize_docs import summarize_docs
+    from query_data_v2 import query_rag
+    from vector_store import run_database, docs_used_in_chroma
+    from db_utils import generate_session_id, return_chat_history, create_db
 
 WINDOW_WIDTH = 1600
 WINDOW_HEIGHT = 900
@@ -29,6 +39,7 @@ class WorkerSignals(QObject):
     finished = pyqtSignal(bool)
     result = pyqtSignal(list)
     summary = pyqtSignal(str)
+    token = pyqtSignal(str)
 
 class Worker(QRunnable):
     """
@@ -37,6 +48,7 @@ class Worker(QRunnable):
     Args:
         fn (function): The function to be executed by the worker.
         *args: Variable length argument list to be passed to the function.
+        stream_tokens (bool): Pass the function an `on_token` callback that emits the `token` signal.
         **kwargs: Arbitrary keyword arguments to be passed to the function.
 
     Attributes:
@@ -46,12 +58,14 @@ class Worker(QRunnable):
         signals (WorkerSignals): The signals used for communication between the worker and the main thread.
     """
 
-    def __init__(self, fn, *args, **kwargs):
+    def __init__(self, fn, *args, stream_tokens=False, **kwargs):
         super(Worker, self).__init__()
         self.fn = fn
         self.args = args
         self.kwargs = kwargs
         self.signals = WorkerSignals()
+        if stream_tokens:
+            self.kwargs["on_token"] = self.signals.token.emit
 
     @pyqtSlot()
     def run(self):
@@ -69,6 +83,16 @@ class Worker(QRunnable):
         else:
             self.signals.summary.emit(result)
             
+def markdown_block_boundary(text):
+    # End of the last complete markdown block (a blank line outside of a code fence), 0 if there is none
+    boundary = 0
+    position = text.find("\n\n")
+    while position != -1:
+        if text.count("```", 0, position) % 2 == 0:
+            boundary = position + 2
+        position = text.find("\n\n", position + 2)
+    return boundary
+
 class SettingsBox(MessageBoxBase):
     """
     A dialog box for managing settings, specifically the OpenAI API key.
@@ -212,6 +236,13 @@ class DocAnalyzerUI(QMainWindow):
             "Multithreading with maximum %d threads" % self.threadpool.maxThreadCount()
         )
 
+        # Keep the index up to date with files dropped into data/ by other tools
+        self.watcher = None
+        if os.getenv("WATCH_DATA_DIR") == "1" and not ANALYZER_SERVER_URL:
+            from watcher import DataWatcher
+            self.watcher = DataWatcher("data")
+            self.watcher.start()
+
         self.chat_list.itemClicked.connect(self.display_chat_content)
         self.chat_list.itemClicked.connect(self.update_chat)
 
@@ -254,6 +285,8 @@ class DocAnalyzerUI(QMainWindow):
 
         self.chat_list = self.create_list_widget("Chat_")
         self.doc_list = self.create_list_widget("")
+        # The selected documents scope the questions; nothing selected searches every document.
+        self.doc_list.setSelectionMode(QAbstractItemView.ExtendedSelection)
 
         sidebar_layout.addWidget(self.chat_list)
         sidebar_layout.addWidget(self.doc_list)
@@ -499,19 +532,11 @@ class DocAnalyzerUI(QMainWindow):
         
     def handle_summary(self, summary):
         if summary:
-            # Set up for typing effect
             self.current_response = summary
-            self.current_sources = ""  # No sources for summary
             self.source = []  # No sources for summary
-            self.char_index = 0
-            self.md_buffer = ""
-            
-            # Move cursor to end and prepare for typing
-            self.chat_display.moveCursor(QTextCursor.End)
-            self.cursor = self.chat_display.textCursor()
-            
-            # Start typing effect
-            self.type_next_character()
+            self.start_answer()
+            self.handle_token(summary)
+            self.end_answer("")
         else:
             self.chat_input.setEnabled(True)
         
@@ -523,7 +548,12 @@ class DocAnalyzerUI(QMainWindow):
             session_id = self.selected_chat.split("_")[1]
             model = self.selected_model
 
-            worker_cb = Worker(query_rag, model, session_id, user_message)
+            selected_docs = [item.text() for item in self.doc_list.selectedItems()]
+            scope = {"sources": selected_docs} if selected_docs else None
+
+            self.start_answer("<b>AI:</b> ")
+            worker_cb = Worker(query_rag, model, session_id, user_message, stream_tokens=True, scope=scope)
+            worker_cb.signals.token.connect(self.handle_token)
             worker_cb.signals.result.connect(self.handle_response)
             self.threadpool.start(worker_cb)
             self.chat_input.clear()
@@ -542,46 +572,58 @@ class DocAnalyzerUI(QMainWindow):
         self.chat_input.setEnabled(True)
         self.chat_input.setFocus()
 
-    def type_next_character(self):
-        if self.char_index < len(self.current_response):
-            char = self.current_response[self.char_index]
-        
-            # Buffer characters to form the full Markdown input
-            self.md_buffer += char
+    def start_answer(self, label=""):
+        # Prepare to render an answer at the end of the chat as its tokens arrive
+        self.chat_display.moveCursor(QTextCursor.End)
+        if label:
+            self.chat_display.insertHtml(label)
+        self.cursor = self.chat_display.textCursor()
+        self.md_committed = self.cursor.position()
+        self.md_pending = ""
+        self.md_render_scheduled = False
+        self.md_active = True
+
+    def handle_token(self, token):
+        # Finished markdown blocks are rendered once; the unfinished one is re-rendered at most every 50 ms
+        if not self.md_active:
+            return
+        self.md_pending += token
+        boundary = markdown_block_boundary(self.md_pending)
+        if boundary:
+            block, self.md_pending = self.md_pending[:boundary], self.md_pending[boundary:]
+            self.replace_pending_html(markdown.markdown(block) + "<br>")
+            self.md_committed = self.cursor.position()
+        if not self.md_render_scheduled:
+            self.md_render_scheduled = True
+            QTimer.singleShot(50, self.render_pending)
+
+    def render_pending(self):
+        self.md_render_scheduled = False
+        if self.md_active:
+            self.replace_pending_html(markdown.markdown(self.md_pending) if self.md_pending.strip() else "")
+
+    def replace_pending_html(self, html):
+        # Replace everything after the rendered blocks with the given HTML
+        self.cursor.setPosition(self.md_committed)
+        self.cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+        self.cursor.removeSelectedText()
+        if html:
+            self.cursor.insertHtml(html)
+        self.chat_display.setTextCursor(self.cursor)
+        self.chat_display.ensureCursorVisible()
 
-            # Convert Markdown to HTML
-            if char == '\n' or self.char_index == len(self.current_response) - 1:
-                html_content = markdown.markdown(self.md_buffer)
-                # print(f"html_content is: {html_content}\n") # for debug
-                
-                # Move the cursor to the end and insert HTML
-                self.cursor.movePosition(QTextCursor.End)
-                self.chat_display.setTextCursor(self.cursor)
-                self.chat_display.insertHtml(html_content)
-                self.md_buffer = ""  # Reset buffer for next chunk
-
-            self.char_index += 1
-            self.chat_display.setTextCursor(self.cursor)
-            self.chat_display.ensureCursorVisible()
-            QTimer.singleShot(
-                20, self.type_next_character
-            ) 
-        else:
-            # Append sources if any
-            if self.current_sources:
-                self.cursor.insertHtml(self.current_sources)
-            self.finish_response()
+    def end_answer(self, sources_html):
+        self.render_pending()
+        self.md_active = False
+        self.cursor.movePosition(QTextCursor.End)
+        if sources_html:
+            self.cursor.insertHtml("<br>" + sources_html)
+        self.finish_response()
 
     def handle_response(self, response):
         self.current_response = response[0]
-        self.current_sources = response[1]
         self.source = response[2]
-        self.char_index = 0
-        self.md_buffer = ""
-        self.chat_display.moveCursor(QTextCursor.End)
-        self.chat_display.insertHtml("<b>AI:</b> ")
-        self.cursor = self.chat_display.textCursor()
-        self.type_next_character()
+        self.end_answer(response[1])
 
     def update_model(self, text):
         print(f"Selected Model: {text}")
@@ -604,4 +646,7 @@ if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = DocAnalyzerUI()
     window.show()
-    sys.exit(app.exec_())
+    exit_code = app.exec_()
+    if window.watcher:
+        window.watcher.stop()
+    sys.exit(exit_code)
@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+JOURNAL_DB = "sqlite.db"
+# Failed attempts after which an unchanged file is no longer retried
+JOURNAL_MAX_RETRIES = int(os.getenv("JOURNAL_MAX_RETRIES", 3))
+
+class IngestJournal:
+    """
+    A crash-safe record of ingestion progress, per file and per embedding batch.
+
+    Every file of a run is marked pending before the pipeline starts and done once all of
+    its chunks are written, and every chunk batch is marked done once it is flushed to the
+    vector store. After an interrupted run the pending files are resumed first and their
+    finished batches are skipped instead of being embedded again. Failed files keep a retry
+    count; after JOURNAL_MAX_RETRIES failures with the same content they are skipped.
+
+    Args:
+        path (str): The SQLite file holding the journal.
+        max_retries (int): The number of failures before a file is skipped.
+    """
+
+    def __init__(self, path=JOURNAL_DB, max_retries=JOURNAL_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        c = self.conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS ingest_journal
+                 (path TEXT PRIMARY KEY, sha256 TEXT, status TEXT, retries INTEGER, error TEXT, updated REAL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS ingest_batches
+                 (batch_id TEXT PRIMARY KEY, path TEXT, updated REAL)''')
+        c.execute("CREATE INDEX IF NOT EXISTS ingest_batches_path ON ingest_batches (path)")
+        self.conn.commit()
+
+    def begin(self, fingerprints):
+        """
+        Marks the files of a run as pending.
+
+        Args:
+            fingerprints (dict): path -> (size, mtime, sha256) of the files to ingest.
+
+        Returns:
+            tuple: (paths to ingest, interrupted files first; paths skipped after too many failures).
+        """
+        resumed, fresh, given_up = [], [], []
+        now = time.time()
+        with self._lock:
+            c = self.conn.cursor()
+            for path, (_, _, sha256) in fingerprints.items():
+                row = c.execute("SELECT sha256, status, retries FROM ingest_journal WHERE path = ?", (path,)).fetchone()
+                if row is None or row[0] != sha256:
+                    # New content starts over, including its finished batches.
+                    c.execute("DELETE FROM ingest_batches WHERE path = ?", (path,))
+                    c.execute(
+                        "INSERT OR REPLACE INTO ingest_journal (path, sha256, status, retries, error, updated) VALUES (?, ?, 'pending', 0, NULL, ?)",
+                        (path, sha256, now),
+                    )
+                    fresh.append(path)
+                elif row[1] == "failed" and row[2] >= self.max_retries:
+                    given_up.append(path)
+                else:
+                    if row[1] == "pending":
+                        resumed.append(path)
+                    else:
+                        fresh.append(path)
+                    c.execute("UPDATE ingest_journal SET status = 'pending', updated = ? WHERE path = ?", (now, path))
+            self.conn.commit()
+
+        if resumed:
+            print(f"⏯️ Resuming {len(resumed)} files from an interrupted run")
+        if given_up:
+            print(f"⛔ Skipping {len(given_up)} files that failed {self.max_retries} times: {given_up}")
+        return resumed + fresh, given_up
+
+    @staticmethod
+    def batch_id(path, chunks):
+        # A batch is identified by its file and the IDs of its chunks
+        chunk_ids = "\n".join(chunk.metadata["id"] for chunk in chunks)
+        return hashlib.sha1(f"{path}\n{chunk_ids}".encode("utf-8")).hexdigest()
+
+    def batch_done(self, batch_id):
+        with self._lock:
+            row = self.conn.execute("SELECT 1 FROM ingest_batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return row is not None
+
+    def has_batches(self, path):
+        # Whether an earlier run already flushed batches of the file's current content
+        with self._lock:
+            row = self.conn.execute("SELECT 1 FROM ingest_batches WHERE path = ? LIMIT 1", (path,)).fetchone()
+        return row is not None
+
+    def mark_batches_done(self, batches):
+        # batches: list of (batch_id, path) that were flushed to the vector store
+        if not batches:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ingest_batches (batch_id, path, updated) VALUES (?, ?, ?)",
+                [(batch_id, path, now) for batch_id, path in batches],
+            )
+            self.conn.commit()
+
+    def mark_file_done(self, path):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE ingest_journal SET status = 'done', error = NULL, updated = ? WHERE path = ?", (time.time(), path)
+            )
+            self.conn.execute("DELETE FROM ingest_batches WHERE path = ?", (path,))
+            self.conn.commit()
+
+    def mark_file_failed(self, path, error):
+        with self._lock:
+            self.conn.execute(
+                "UPDATE ingest_journal SET status = 'failed', retries = retries + 1, error = ?, updated = ? WHERE path = ?",
+                (error, time.time(), path),
+            )
+            self.conn.commit()
+
+    def forget(self, paths):
+        # Drop deleted files from the journal
+        with self._lock:
+            self.conn.executemany("DELETE FROM ingest_journal WHERE path = ?", [(path,) for path in paths])
+            self.conn.executemany("DELETE FROM ingest_batches WHERE path = ?", [(path,) for path in paths])
+            self.conn.commit()
+
+    def reset_failed(self):
+        # Give failed files their retries back
+        with self._lock:
+            self.conn.execute("UPDATE ingest_journal SET retries = 0 WHERE status = 'failed'")
+            self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM ingest_journal")
+            self.conn.execute("DELETE FROM ingest_batches")
+            self.conn.commit()
+
+    def status(self):
+        """
+        Summarizes the journal.
+
+        Returns:
+            dict: "counts" per status, and the "items" that are pending or failed as
+            (path, status, retries, error, finished batches) tuples.
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            counts = dict(c.execute("SELECT status, COUNT(*) FROM ingest_journal GROUP BY status").fetchall())
+            items = c.execute('''SELECT j.path, j.status, j.retries, j.error,
+                         (SELECT COUNT(*) FROM ingest_batches b WHERE b.path = j.path)
+                     FROM ingest_journal j WHERE j.status != 'done' ORDER BY j.status, j.path''').fetchall()
+        return {"counts": counts, "items": items}
+
+def print_status():
+    status = IngestJournal().status()
+    counts = status["counts"]
+    print(f"pending: {counts.get('pending', 0)}  done: {counts.get('done', 0)}  failed: {counts.get('failed', 0)}")
+    for path, state, retries, error, batches in status["items"]:
+        line = f"  {state:<8} {path}  retries={retries}  finished batches={batches}"
+        if error:
+            line += f"  error={error}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the ingestion journal.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="Show pending, done and failed files with their retry counts.")
+    subparsers.add_parser("reset-failed", help="Retry failed files on the next run.")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print_status()
+    elif args.command == "reset-failed":
+        IngestJournal().reset_failed()
+        print("Failed files will be retried on the next run.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from langchain.schema.document import Document
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "lexical.db")
+# Bytes of the index file memory-mapped by every reader
+LEXICAL_MMAP_SIZE = int(os.getenv("LEXICAL_MMAP_SIZE", 256 * 1024 * 1024))
+
+# "-", "_" and "." are part of a token, so "ERR-1042", "max_tokens" and "v2.1.0" stay whole
+_TOKENIZER = "unicode61 tokenchars '-_.'"
+_TOKEN = re.compile(r"[\w\-.]+")
+
+def lexical_terms(text):
+    # The tokens of a text without the punctuation that only surrounds them ("end." -> "end")
+    terms = (token.strip("-_.") for token in _TOKEN.findall(text))
+    return " ".join(term for term in terms if term)
+
+def _scope_conditions(scope):
+    # SQL conditions on lexical_chunks (aliased c) restricting a search to a scope
+    conditions, params = [], []
+    for key, column in (("sources", "c.source"), ("folders", "json_extract(c.metadata, '$.folder')"),
+                        ("file_types", "json_extract(c.metadata, '$.file_type')")):
+        values = scope.get(key)
+        if values:
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+    duplicate_ids = scope.get("duplicate_ids")
+    if duplicate_ids:
+        # Chunks kept in another document for a document in scope match as well.
+        conditions = [f"(({' AND '.join(conditions)}) OR c.chunk_id IN ({', '.join('?' * len(duplicate_ids))}))"]
+        params.extend(duplicate_ids)
+    if scope.get("ingested_after") is not None:
+        conditions.append("json_extract(c.metadata, '$.ingested_at') >= ?")
+        params.append(scope["ingested_after"])
+    return conditions, params
+
+class LexicalIndex:
+    """
+    An on-disk BM25 index of the chunks stored in the vector store, kept in an SQLite
+    FTS5 table next to it.
+
+    It is updated incrementally by the ingestion pipeline: chunks are added when they
+    are written to Chroma and removed when they are deleted from it. Every reading thread
+    has its own connection with the index file memory-mapped.
+
+    Args:
+        path (str): The SQLite file holding the index.
+        mmap_size (int): Bytes memory-mapped by reading connections.
+    """
+
+    def __init__(self, path=LEXICAL_INDEX_PATH, mmap_size=LEXICAL_MMAP_SIZE):
+        self.path = path
+        self.mmap_size = mmap_size
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        c = self.conn.cursor()
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute('''CREATE TABLE IF NOT EXISTS lexical_chunks
+                 (rowid INTEGER PRIMARY KEY, chunk_id TEXT UNIQUE, source TEXT, metadata TEXT, content TEXT, terms TEXT)''')
+        c.execute("CREATE INDEX IF NOT EXISTS lexical_chunks_source ON lexical_chunks (source)")
+        c.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS lexical_fts USING fts5
+                 (terms, content='lexical_chunks', content_rowid='rowid', tokenize="{_TOKENIZER}")''')
+        # Keep the FTS index in step with its content table.
+        c.execute('''CREATE TRIGGER IF NOT EXISTS lexical_chunks_insert AFTER INSERT ON lexical_chunks BEGIN
+                 INSERT INTO lexical_fts (rowid, terms) VALUES (new.rowid, new.terms); END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS lexical_chunks_delete AFTER DELETE ON lexical_chunks BEGIN
+                 INSERT INTO lexical_fts (lexical_fts, rowid, terms) VALUES ('delete', old.rowid, old.terms); END''')
+        self.conn.commit()
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+            self._local.conn = conn
+        return conn
+
+    def add(self, chunks):
+        # Index chunks, replacing the ones already indexed under the same ID
+        rows = [
+            (chunk.metadata["id"], chunk.metadata.get("source"), json.dumps(chunk.metadata, default=str),
+             chunk.page_content, lexical_terms(chunk.page_content))
+            for chunk in chunks
+        ]
+        with self._lock:
+            self.conn.executemany("DELETE FROM lexical_chunks WHERE chunk_id = ?", [(row[0],) for row in rows])
+            self.conn.executemany(
+                "INSERT INTO lexical_chunks (chunk_id, source, metadata, content, terms) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+
+    def delete_ids(self, chunk_ids):
+        with self._lock:
+            self.conn.executemany("DELETE FROM lexical_chunks WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids])
+            self.conn.commit()
+
+    def delete_sources(self, sources):
+        with self._lock:
+            self.conn.executemany("DELETE FROM lexical_chunks WHERE source = ?", [(source,) for source in sources])
+            self.conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self.conn.execute("DELETE FROM lexical_chunks")
+            self.conn.execute("INSERT INTO lexical_fts (lexical_fts) VALUES ('rebuild')")
+            self.conn.commit()
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM lexical_chunks").fetchone()[0]
+
+    def search(self, query, k=10, scope=None):
+        """
+        Finds the chunks that best match the terms of a query, ranked by BM25.
+
+        Args:
+            query (str): The search query.
+            k (int): The number of chunks to return.
+            scope (dict): Only search chunks with these "sources", "folders" or "file_types",
+                or ingested at or after "ingested_after" (a Unix time).
+
+        Returns:
+            list[Document]: The matching chunks, best first.
+        """
+        terms = lexical_terms(query).split()
+        if not terms:
+            return []
+        match = " OR ".join('"' + term.replace('"', '""') + '"' for term in dict.fromkeys(terms))
+        conditions, params = _scope_conditions(scope or {})
+        rows = self._reader().execute(
+            f'''SELECT c.metadata, c.content FROM lexical_fts f JOIN lexical_chunks c ON c.rowid = f.rowid
+               WHERE lexical_fts MATCH ?{"".join(" AND " + condition for condition in conditions)}
+               ORDER BY bm25(lexical_fts) LIMIT ?''',
+            (match, *params, k),
+        ).fetchall()
+        return [Document(page_content=content, metadata=json.loads(metadata)) for metadata, content in rows]
+
+_lexical_index = None
+_lexical_index_lock = threading.Lock()
+
+def load_lexical_index():
+    # One index handle is shared by the whole process, like the vector store
+    global _lexical_index
+    with _lexical_index_lock:
+        if _lexical_index is None:
+            _lexical_index = LexicalIndex()
+        return _lexical_index
@@ -1,21 +1,153 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
 import ollama
 from openai import OpenAI
 
 from dotenv import load_dotenv
 load_dotenv()
-from langchain_community.embeddings.ollama import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_community.llms.ollama import Ollama
+from langchain_openai import ChatOpenAI
+from embedding_cache import CachedEmbeddings, EMBEDDING_CACHE_MAX_ENTRIES
+
+EMBEDDING_MODEL = "nomic-embed-text"
+# The Ollama endpoint the vectors come from; /api/embed returns normalized vectors, unlike the
+# older /api/embeddings, so vectors of the two cannot be mixed in one store
+EMBEDDING_ENDPOINT = "/api/embed"
+# Recorded with the ingested vectors: the store is re-embedded when it changes
+EMBEDDING_VERSION = f"{EMBEDDING_MODEL}@{EMBEDDING_ENDPOINT}"
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+# Texts sent per /api/embed request
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+# Embedding requests allowed in flight at the same time
+EMBED_MAX_IN_FLIGHT = int(os.getenv("EMBED_MAX_IN_FLIGHT", 4))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", 5))
+
+OPENAI_MODELS = ("gpt-3.5-turbo-0125", "gpt-4-turbo")
+# Context windows in tokens, extended by CONTEXT_WINDOWS, e.g. "llama3:70b=32768" for an Ollama model
+# served with a larger num_ctx; other Ollama models get the default window of the Ollama server
+MODEL_CONTEXT_WINDOWS = {"gpt-3.5-turbo-0125": 16385, "gpt-4-turbo": 128000}
+MODEL_CONTEXT_WINDOWS.update(
+    (name.strip(), int(tokens)) for name, _, tokens in
+    (entry.rpartition("=") for entry in os.getenv("CONTEXT_WINDOWS", "").split(",") if "=" in entry)
+)
+OLLAMA_CONTEXT_WINDOW = int(os.getenv("OLLAMA_CONTEXT_WINDOW", 2048))
+
+_llms = {}
+_llms_lock = threading.Lock()
+_openai_http_client = None
+
+class BatchedOllamaEmbeddings(Embeddings):
+    """
+    Ollama embeddings that send texts in batches with a bounded number of concurrent requests.
+
+    Failed requests (connection errors, 429 and 5xx responses) are retried with a backoff
+    delay that is shared by all in-flight requests: it doubles on every failure and halves
+    on every success, so the whole client slows down while the server is overloaded.
+
+    Args:
+        model (str): The embedding model name.
+        host (str): The Ollama (or Ollama-compatible) server URL.
+        batch_size (int): The number of texts per request.
+        max_in_flight (int): The maximum number of concurrent requests.
+        max_retries (int): The number of retries for a failed request.
+
+    Attributes:
+        stats (dict): Cumulative "chunks", "seconds" and "retries" counters.
+    """
+
+    def __init__(self, model=EMBEDDING_MODEL, host=OLLAMA_HOST, batch_size=EMBED_BATCH_SIZE,
+                 max_in_flight=EMBED_MAX_IN_FLIGHT, max_retries=EMBED_MAX_RETRIES):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.client = ollama.Client(host=host)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.stats = {"chunks": 0, "seconds": 0.0, "retries": 0}
+        self._backoff = 0.0
+        self._lock = threading.Lock()
+
+    def _embed_batch(self, texts):
+        for attempt in range(self.max_retries + 1):
+            if self._backoff:
+                time.sleep(self._backoff)
+            try:
+                response = self.client.embed(model=self.model, input=texts)
+            except (ollama.ResponseError, httpx.HTTPError, ConnectionError) as e:
+                status_code = getattr(e, "status_code", None)
+                retryable = status_code is None or status_code == 429 or status_code >= 500
+                if attempt == self.max_retries or not retryable:
+                    raise
+                with self._lock:
+                    self._backoff = min(max(self._backoff * 2, 0.5), 30.0)
+                    self.stats["retries"] += 1
+                print(f"⏳ Embedding request failed ({e}), retrying in {self._backoff:.1f}s")
+                continue
+
+            with self._lock:
+                self._backoff = self._backoff / 2 if self._backoff > 0.1 else 0.0
+            return response["embeddings"]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        start = time.perf_counter()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        embeddings = [embedding for batch in self.executor.map(self._embed_batch, batches) for embedding in batch]
+
+        with self._lock:
+            self.stats["chunks"] += len(texts)
+            self.stats["seconds"] += time.perf_counter() - start
+        return embeddings
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed_batch([text])[0]
+
+    def throughput(self):
+        # Average chunks embedded per second so far
+        if not self.stats["seconds"]:
+            return 0.0
+        return self.stats["chunks"] / self.stats["seconds"]
 
 def get_embedding_function():
     """
     Returns the embedding function used for the vector store.
-    For now only OllamaEmbeddings is supported
+    For now only Ollama embeddings are supported, sent in batches
+    of EMBED_BATCH_SIZE with up to EMBED_MAX_IN_FLIGHT concurrent requests.
+    They sit behind the on-disk embedding cache unless EMBEDDING_CACHE_MAX_ENTRIES is 0.
 
     Returns:
         embeddings: The embedding function.
     """
-    embeddings = OllamaEmbeddings(model="nomic-embed-text")
+    embeddings = BatchedOllamaEmbeddings()
+    if EMBEDDING_CACHE_MAX_ENTRIES > 0:
+        embeddings = CachedEmbeddings(embeddings, EMBEDDING_VERSION)
     return embeddings
 
+def get_llm(model: str):
+    """
+    Returns the chat model for a model name. Clients are created once and shared by
+    every chain of the process; OpenAI models also share one HTTP connection pool.
+
+    Args:
+        model (str): The model name, an OpenAI model or a local Ollama model.
+
+    Returns:
+        The ChatOpenAI or Ollama client.
+    """
+    global _openai_http_client
+    with _llms_lock:
+        if model not in _llms:
+            if model in OPENAI_MODELS:
+                if _openai_http_client is None:
+                    _openai_http_client = httpx.Client(limits=httpx.Limits(max_keepalive_connections=20))
+                _llms[model] = ChatOpenAI(model=model, http_client=_openai_http_client)
+            else:
+                _llms[model] = Ollama(model=model)
+        return _llms[model]
+
 def list_local_models():
     # Listing local models from Ollama
     models = ollama.list()
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+MANIFEST_DB = "sqlite.db"
+
+def create_manifest():
+    # Create the ingestion manifest table (if it doesn't exist)
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_manifest
+             (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_migrations
+             (name TEXT PRIMARY KEY, done REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_settings
+             (name TEXT PRIMARY KEY, value TEXT)''')
+    conn.commit()
+    conn.close()
+
+def hash_file(path, block_size=1 << 20):
+    """
+    Computes the SHA-256 hash of a file's content.
+
+    Args:
+        path (str): The path of the file to hash.
+        block_size (int): The number of bytes read at a time.
+
+    Returns:
+        str: The hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def classify_files(paths):
+    """
+    Compares files on disk against the ingestion manifest.
+
+    Size and mtime are checked first; the content is only hashed when one of them
+    differs from the manifest, so unchanged files cost a single stat() call.
+
+    Args:
+        paths (list[str]): The file paths to classify.
+
+    Returns:
+        dict: A dictionary with the keys "new", "changed" and "unchanged" (lists of paths)
+        and "fingerprints" (path -> (size, mtime, sha256)) for the files that need recording.
+    """
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+
+    result = {"new": [], "changed": [], "unchanged": [], "fingerprints": {}}
+    touched = []
+
+    for path in paths:
+        stat = os.stat(path)
+        c.execute("SELECT size, mtime, sha256 FROM ingest_manifest WHERE path = ?", (path,))
+        row = c.fetchone()
+
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            result["unchanged"].append(path)
+            continue
+
+        sha256 = hash_file(path)
+        if row is None:
+            result["new"].append(path)
+            result["fingerprints"][path] = (stat.st_size, stat.st_mtime, sha256)
+        elif row[2] == sha256:
+            # Touched but not modified, only refresh the stat fields.
+            result["unchanged"].append(path)
+            touched.append((stat.st_size, stat.st_mtime, path))
+        else:
+            result["changed"].append(path)
+            result["fingerprints"][path] = (stat.st_size, stat.st_mtime, sha256)
+
+    if touched:
+        c.executemany("UPDATE ingest_manifest SET size = ?, mtime = ? WHERE path = ?", touched)
+        conn.commit()
+    conn.close()
+
+    return result
+
+def fingerprint(path):
+    # The (size, mtime, sha256) recorded for a file
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime, hash_file(path)
+
+def record_files(fingerprints):
+    """
+    Records ingested files in the manifest.
+
+    Args:
+        fingerprints (dict): A mapping of path -> (size, mtime, sha256).
+    """
+    if not fingerprints:
+        return
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.executemany(
+        "INSERT OR REPLACE INTO ingest_manifest (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+        [(path, *fingerprint) for path, fingerprint in fingerprints.items()],
+    )
+    conn.commit()
+    conn.close()
+
+def clear_manifest():
+    # Forget every ingested file, used when the vector store is reset
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("DELETE FROM ingest_manifest")
+    conn.commit()
+    conn.close()
+
+def manifest_paths():
+    # Every path currently recorded in the manifest
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("SELECT path FROM ingest_manifest")
+    paths = [row[0] for row in c.fetchall()]
+    conn.close()
+    return paths
+
+def remove_from_manifest(paths):
+    # Forget files that no longer exist on disk
+    if not paths:
+        return
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.executemany("DELETE FROM ingest_manifest WHERE path = ?", [(path,) for path in paths])
+    conn.commit()
+    conn.close()
+
+def migration_done(name):
+    # Whether a one-time upgrade of the stored data has already run
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM ingest_migrations WHERE name = ?", (name,))
+    done = c.fetchone() is not None
+    conn.close()
+    return done
+
+def mark_migration_done(name):
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO ingest_migrations (name, done) VALUES (?, ?)", (name, time.time()))
+    conn.commit()
+    conn.close()
+
+def stored_embedding_version():
+    # The embedding model and endpoint of the stored vectors, None when not recorded
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("SELECT value FROM ingest_settings WHERE name = 'embedding_version'")
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def record_embedding_version(version):
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO ingest_settings (name, value) VALUES ('embedding_version', ?)", (version,))
+    conn.commit()
+    conn.close()
+
+def stored_index_version():
+    # Bumped by every ingestion or reset of the index, in any process sharing sqlite.db
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("SELECT value FROM ingest_settings WHERE name = 'index_version'")
+    row = c.fetchone()
+    conn.close()
+    return int(row[0]) if row else 0
+
+def bump_index_version():
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("""INSERT INTO ingest_settings (name, value) VALUES ('index_version', '1')
+                 ON CONFLICT (name) DO UPDATE SET value = CAST(value AS INTEGER) + 1""")
+    conn.commit()
+    conn.close()
+
+def corpus_version():
+    # A stamp of the ingested corpus that changes whenever a file is ingested, changed or removed
+    create_manifest()
+    conn = sqlite3.connect(MANIFEST_DB)
+    c = conn.cursor()
+    c.execute("SELECT path, sha256 FROM ingest_manifest ORDER BY path")
+    digest = hashlib.sha1()
+    for path, sha256 in c.fetchall():
+        digest.update(f"{path}\n{sha256}\n".encode("utf-8"))
+    conn.close()
+    return digest.hexdigest()[:16]
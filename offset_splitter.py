@@ -0,0 +1,135 @@
+from langchain.schema.document import Document
+
+class OffsetTextSplitter:
+    """
+    A recursive character text splitter that works on character offsets.
+
+    It produces the same chunk boundaries as langchain's RecursiveCharacterTextSplitter
+    (non-regex separators, separators kept at the start of the next piece, whitespace
+    stripped), but pieces and chunks are (start, end) spans into the page text. Overlapping
+    text is therefore only copied when a chunk is materialized, and every chunk knows where
+    it came from.
+
+    Args:
+        chunk_size (int): The maximum number of characters per chunk.
+        chunk_overlap (int): The maximum number of characters shared by consecutive chunks.
+        separators (list[str]): The separators to try, from coarsest to finest.
+    """
+
+    def __init__(self, chunk_size=1024, chunk_overlap=80, separators=("\n\n", "\n", " ", "")):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators)
+
+    def split_spans(self, text: str):
+        """
+        Splits a text into chunk spans.
+
+        Args:
+            text (str): The text to split.
+
+        Returns:
+            list[tuple[int, int]]: The (start, end) offsets of every chunk.
+        """
+        return self._split(text, 0, len(text), self.separators)
+
+    def split_text(self, text: str):
+        return [text[start:end] for start, end in self.split_spans(text)]
+
+    def split_documents(self, documents: list[Document]):
+        """
+        Splits documents into chunks that record their "start_index" and "end_index" in the page.
+
+        Args:
+            documents (list[Document]): The documents to split.
+
+        Returns:
+            list[Document]: The chunks.
+        """
+        chunks = []
+        for document in documents:
+            text = document.page_content
+            for start, end in self.split_spans(text):
+                metadata = dict(document.metadata)
+                metadata["start_index"] = start
+                metadata["end_index"] = end
+                chunks.append(Document(page_content=text[start:end], metadata=metadata))
+        return chunks
+
+    def _split(self, text, start, end, separators):
+        # Use the first separator present in the span, and recurse with the finer ones.
+        separator = separators[-1]
+        finer_separators = []
+        for i, candidate in enumerate(separators):
+            if candidate == "":
+                separator = candidate
+                break
+            if text.find(candidate, start, end) != -1:
+                separator = candidate
+                finer_separators = separators[i + 1:]
+                break
+
+        spans = []
+        good_spans = []
+        for piece in self._pieces(text, start, end, separator):
+            if piece[1] - piece[0] < self.chunk_size:
+                good_spans.append(piece)
+                continue
+            if good_spans:
+                spans.extend(self._merge(text, good_spans))
+                good_spans = []
+            if not finer_separators:
+                spans.append(piece)
+            else:
+                spans.extend(self._split(text, piece[0], piece[1], finer_separators))
+        if good_spans:
+            spans.extend(self._merge(text, good_spans))
+        return spans
+
+    def _pieces(self, text, start, end, separator):
+        # Non-empty pieces of the span, each separator kept at the start of the piece after it.
+        if separator == "":
+            return [(i, i + 1) for i in range(start, end)]
+
+        pieces = []
+        piece_start = start
+        position = text.find(separator, start, end)
+        while position != -1:
+            if position > piece_start:
+                pieces.append((piece_start, position))
+            piece_start = position
+            position = text.find(separator, position + len(separator), end)
+        if end > piece_start:
+            pieces.append((piece_start, end))
+        return pieces
+
+    def _merge(self, text, pieces):
+        # Combine consecutive pieces into chunks of at most chunk_size, keeping up to
+        # chunk_overlap characters of the previous chunk at the start of the next one.
+        chunks = []
+        first = 0
+        total = 0
+        for i, (start, end) in enumerate(pieces):
+            length = end - start
+            if total + length > self.chunk_size and i > first:
+                chunk = self._strip(text, pieces[first][0], pieces[i - 1][1])
+                if chunk:
+                    chunks.append(chunk)
+                while first < i and (total > self.chunk_overlap or total + length > self.chunk_size):
+                    total -= pieces[first][1] - pieces[first][0]
+                    first += 1
+            total += length
+        if first < len(pieces):
+            chunk = self._strip(text, pieces[first][0], pieces[-1][1])
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def _strip(self, text, start, end):
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start == end:
+            return None
+        return (start, end)
@@ -0,0 +1,86 @@
+import argparse
+import hashlib
+import json
+import random
+import struct
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the parts of the Ollama API used by the app, so ingestion can be
+# tested and benchmarked without the real models. Embeddings are deterministic: the same
+# text always gets the same unit vector.
+
+DIMENSIONS = 768
+
+def fake_embedding(text, dimensions=DIMENSIONS):
+    # Expand a hash of the text into a unit vector
+    values = []
+    counter = 0
+    while len(values) < dimensions:
+        digest = hashlib.sha256(f"{counter}:{text}".encode()).digest()
+        values.extend(v / 2**31 - 1.0 for v in struct.unpack("<8I", digest))
+        counter += 1
+    values = values[:dimensions]
+    norm = sum(v * v for v in values) ** 0.5 or 1.0
+    return [v / norm for v in values]
+
+class StandinHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    per_text_latency = 0.0
+    error_rate = 0.0
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": "nomic-embed-text:latest", "model": "nomic-embed-text:latest"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+
+        if random.random() < self.error_rate:
+            self._send_json(503, {"error": "server busy"})
+            return
+
+        if self.path == "/api/embed":
+            texts = request.get("input", [])
+            if isinstance(texts, str):
+                texts = [texts]
+            time.sleep(self.latency + self.per_text_latency * len(texts))
+            self._send_json(200, {"model": request.get("model"), "embeddings": [fake_embedding(text) for text in texts]})
+        elif self.path == "/api/embeddings":
+            time.sleep(self.latency + self.per_text_latency)
+            self._send_json(200, {"embedding": fake_embedding(request.get("prompt", ""))})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama-compatible stand-in server for tests and benchmarks.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every request.")
+    parser.add_argument("--per-text-latency", type=float, default=0.002, help="Seconds added per embedded text.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503.")
+    args = parser.parse_args()
+
+    StandinHandler.latency = args.latency
+    StandinHandler.per_text_latency = args.per_text_latency
+    StandinHandler.error_rate = args.error_rate
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StandinHandler)
+    print(f"Ollama stand-in listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
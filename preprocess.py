@@ -1,41 +1,424 @@
-from langchain_community.document_loaders import DirectoryLoader
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredMarkdownLoader, UnstructuredExcelLoader, UnstructuredPowerPointLoader, CSVLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import os
+import queue
+import threading
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing.connection import wait
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredMarkdownLoader, UnstructuredPowerPointLoader
 from langchain.schema.document import Document
+from offset_splitter import OffsetTextSplitter
+from table_store import TABULAR_MODE, TableLoader, iter_sheets, format_row
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # PyMuPDF is optional, only PDF_BACKEND=pymupdf needs it
+    fitz = None
+
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 80
+
+# "pypdf" or "pymupdf", the library used to extract text from PDFs
+PDF_BACKEND = os.getenv("PDF_BACKEND", "pypdf")
+# PDFs with more pages than this are extracted in parallel page ranges of this size
+PDF_PAGES_PER_RANGE = int(os.getenv("PDF_PAGES_PER_RANGE", 64))
+# Worker processes extracting the page ranges of large PDFs, shared by all loader threads
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 4))
+
+# PyMuPDF is not thread-safe: the loader threads of this process take turns using it.
+_fitz_lock = threading.Lock()
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+def _extract_page_range(file_path, first_page, last_page):
+    # Extract the text of pages [first_page, last_page) of a PDF
+    with fitz.open(file_path) as pdf:
+        return [(page_number, pdf[page_number].get_text()) for page_number in range(first_page, last_page)]
+
+def _get_pdf_pool():
+    # One pool of spawned processes for the whole process, created on first use
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+class PyMuPDFPageRangeLoader:
+    """
+    Loads a PDF with PyMuPDF, one Document per page with the same "source" and "page"
+    metadata as PyPDFLoader.
+
+    Large PDFs are cut into ranges of `pages_per_range` pages that are extracted in parallel
+    by the worker processes of a pool shared by all loaders (sequentially when already
+    running inside a daemon worker process). Everything else uses PyMuPDF in this process,
+    one thread at a time.
+
+    Args:
+        file_path (str): The path of the PDF.
+        pages_per_range (int): The number of pages extracted by one worker.
+    """
+
+    def __init__(self, file_path, pages_per_range=PDF_PAGES_PER_RANGE):
+        if fitz is None:
+            raise ImportError("PDF_BACKEND=pymupdf needs PyMuPDF: pip install pymupdf")
+        self.file_path = file_path
+        self.pages_per_range = pages_per_range
+
+    def load(self):
+        with _fitz_lock:
+            with fitz.open(self.file_path) as pdf:
+                page_count = pdf.page_count
+
+        ranges = [
+            (first_page, min(first_page + self.pages_per_range, page_count))
+            for first_page in range(0, page_count, self.pages_per_range)
+        ]
+        if len(ranges) > 1 and not multiprocessing.current_process().daemon:
+            results = _get_pdf_pool().map(_extract_page_range, [self.file_path] * len(ranges), *zip(*ranges))
+            pages = [page for result in results for page in result]
+        else:
+            with _fitz_lock:
+                pages = [page for first_page, last_page in ranges for page in _extract_page_range(self.file_path, first_page, last_page)]
+
+        return [
+            Document(page_content=text, metadata={"source": self.file_path, "page": page_number})
+            for page_number, text in pages
+        ]
+
+# Spreadsheet rows per document; a group of rows also ends once it reaches CHUNK_SIZE characters
+ROW_GROUP_MAX_ROWS = int(os.getenv("ROW_GROUP_MAX_ROWS", 200))
+# Documents a streaming loader hands over at a time
+STREAM_PART_SIZE = int(os.getenv("STREAM_PART_SIZE", 64))
+
+def _row_groups(source, header, rows, max_rows, max_chars, sheet=None):
+    """
+    Groups numbered rows into Documents of at most `max_rows` rows and about `max_chars`
+    characters, each starting with the header so it can be read on its own.
+
+    Args:
+        source (str): The path of the spreadsheet.
+        header (list): The header row.
+        rows (iterable): (row number, values) of the data rows.
+        max_rows (int): The maximum number of rows per document.
+        max_chars (int): The number of characters after which a group is closed.
+        sheet (str): The name of the worksheet, if any.
+
+    Yields:
+        Document: One group of rows with its "rows", "row_start" and "row_end" metadata.
+    """
+    context = format_row(header or [])
+    if sheet is not None:
+        context = f"Sheet: {sheet}\n{context}"
+
+    def document(lines, row_start, row_end):
+        rows_label = f"{row_start}-{row_end}" if sheet is None else f"{sheet}!{row_start}-{row_end}"
+        metadata = {"source": source, "rows": rows_label, "row_start": row_start, "row_end": row_end}
+        if sheet is not None:
+            metadata["sheet"] = sheet
+        return Document(page_content="\n".join([context, *lines]), metadata=metadata)
+
+    lines, size, row_start, row_end = [], len(context), None, None
+    for row_number, values in rows:
+        line = format_row(values)
+        if not line:
+            continue
+        if lines and (len(lines) >= max_rows or size + 1 + len(line) > max_chars):
+            yield document(lines, row_start, row_end)
+            lines, size = [], len(context)
+        if not lines:
+            row_start = row_number
+        lines.append(line)
+        size += 1 + len(line)
+        row_end = row_number
+    if lines:
+        yield document(lines, row_start, row_end)
+
+class RowGroupLoader:
+    """
+    Streams a .csv file or the worksheets of an .xlsx workbook as groups of rows
+    instead of one Document per row.
+
+    Rows are read one at a time (the workbook is opened read-only), so memory stays
+    constant whatever the size of the file. Row numbers are the ones shown in a
+    spreadsheet, the header being row 1 of a CSV file.
+
+    Args:
+        file_path (str): The path of the spreadsheet.
+        max_rows (int): The maximum number of rows per document.
+        max_chars (int): The number of characters after which a group is closed.
+    """
+
+    streaming = True
+
+    def __init__(self, file_path, max_rows=ROW_GROUP_MAX_ROWS, max_chars=CHUNK_SIZE):
+        self.file_path = file_path
+        self.max_rows = max_rows
+        self.max_chars = max_chars
+
+    def lazy_load(self):
+        for sheet, header, rows in iter_sheets(self.file_path):
+            yield from _row_groups(self.file_path, header, rows, self.max_rows, self.max_chars, sheet=sheet)
+
+    def load(self):
+        return list(self.lazy_load())
+
+pdf_backends = {
+    "pypdf": PyPDFLoader,
+    "pymupdf": PyMuPDFPageRangeLoader,
+}
 
 types = {
-    ".pdf": PyPDFLoader,
+    ".pdf": pdf_backends[PDF_BACKEND],
     ".docx": Docx2txtLoader,
     ".md": UnstructuredMarkdownLoader,
     ".pptx": UnstructuredPowerPointLoader,
-    ".xlsx": UnstructuredExcelLoader,
-    ".csv": CSVLoader,
+    ".xlsx": TableLoader if TABULAR_MODE == "table" else RowGroupLoader,
+    ".csv": TableLoader if TABULAR_MODE == "table" else RowGroupLoader,
 }
 
-def documents_directory_loader(file_type, DATA_PATH):
+# "thread" keeps parsing in this process, "process" parses every file in an isolated worker process
+LOADER_MODE = os.getenv("LOADER_MODE", "thread")
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", os.cpu_count() or 4))
+# Seconds a file (or a part of a streamed file) may take before its worker is killed (process mode only)
+LOADER_TIMEOUT = float(os.getenv("LOADER_TIMEOUT", 300))
+
+text_splitter = OffsetTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+def scan_directory(DATA_PATH):
     """
-    Load documents from a directory based on the specified file type.
+    Walk a directory tree once and group the supported files by file type.
 
     Args:
-        file_type (str): The file type to filter the documents (e.g., '.txt', '.pdf').
         DATA_PATH (str): The path to the directory containing the documents.
 
+    Returns:
+        dict: A dictionary mapping each file type in `types` to a sorted list of file paths.
+
+    """
+    files_by_type = {file_type: [] for file_type in types}
+    for root, _, file_names in os.walk(DATA_PATH):
+        for file_name in file_names:
+            file_type = os.path.splitext(file_name)[1].lower()
+            if file_type in files_by_type:
+                files_by_type[file_type].append(os.path.join(root, file_name))
+
+    for file_type, file_paths in files_by_type.items():
+        file_paths.sort()
+        print(f"Found {len(file_paths)} {file_type} files")
+    return files_by_type
+
+def load_file_parts(file_path):
+    """
+    Loads a single file in parts. Streaming loaders hand over STREAM_PART_SIZE documents
+    at a time as they read the file, the others load it in one part.
+
+    Args:
+        file_path (str): The path of the file to load.
+
+    Yields:
+        tuple: (documents, last), where last is True for the final part of the file.
+    """
+    file_type = os.path.splitext(file_path)[1].lower()
+    loader = types[file_type](file_path)
+    if not getattr(loader, "streaming", False):
+        yield loader.load(), True
+        return
+
+    part = []
+    for document in loader.lazy_load():
+        part.append(document)
+        if len(part) >= STREAM_PART_SIZE:
+            yield part, False
+            part = []
+    yield part, True
+
+def _parse_worker(conn):
+    # Worker process loop: receive a path, send back (path, documents, error, last) for every part
+    while True:
+        file_path = conn.recv()
+        if file_path is None:
+            break
+        try:
+            for documents, last in load_file_parts(file_path):
+                conn.send((file_path, documents, None, last))
+        except Exception as e:
+            conn.send((file_path, [], f"{type(e).__name__}: {e}", True))
+
+def _start_parse_worker(ctx):
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_parse_worker, args=(child_conn,), daemon=True)
+    process.start()
+    child_conn.close()
+    return {"process": process, "conn": parent_conn, "file_path": None, "started": None}
+
+def _stop_parse_worker(worker, kill=False):
+    if kill:
+        worker["process"].kill()
+    else:
+        try:
+            worker["conn"].send(None)
+        except (BrokenPipeError, OSError):
+            worker["process"].kill()
+    worker["process"].join()
+    worker["conn"].close()
+
+def _iter_documents_in_processes(file_paths, max_workers, timeout):
+    """
+    Parses files in a pool of worker processes, one file per worker at a time.
+
+    A worker that crashes or exceeds the timeout is killed and replaced, so a single
+    bad file only fails itself.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    pending = deque(file_paths)
+    workers = [_start_parse_worker(ctx) for _ in range(min(max_workers, len(file_paths)))]
+
+    try:
+        while True:
+            for worker in workers:
+                if worker["file_path"] is None and pending:
+                    worker["file_path"] = pending.popleft()
+                    worker["started"] = time.monotonic()
+                    worker["conn"].send(worker["file_path"])
+
+            busy = [worker for worker in workers if worker["file_path"] is not None]
+            if not busy:
+                break
+
+            now = time.monotonic()
+            wait_for = min(worker["started"] + timeout - now for worker in busy)
+            wait(
+                [worker["conn"] for worker in busy] + [worker["process"].sentinel for worker in busy],
+                timeout=max(wait_for, 0),
+            )
+
+            now = time.monotonic()
+            for i, worker in enumerate(workers):
+                file_path = worker["file_path"]
+                if file_path is None:
+                    continue
+
+                error = None
+                if worker["conn"].poll():
+                    try:
+                        result = worker["conn"].recv()
+                        if result[3]:
+                            worker["file_path"] = None
+                        else:
+                            # A streaming loader made progress, its timeout starts over.
+                            worker["started"] = time.monotonic()
+                        yield result
+                        continue
+                    except (EOFError, OSError):
+                        error = f"worker exited with code {worker['process'].exitcode}"
+                elif not worker["process"].is_alive():
+                    error = f"worker exited with code {worker['process'].exitcode}"
+                elif now - worker["started"] > timeout:
+                    error = f"timed out after {timeout:.0f}s"
+
+                if error:
+                    _stop_parse_worker(worker, kill=True)
+                    workers[i] = _start_parse_worker(ctx)
+                    yield file_path, [], error, True
+    finally:
+        for worker in workers:
+            _stop_parse_worker(worker, kill=worker["file_path"] is not None)
+
+def _iter_documents_in_threads(file_paths, max_workers):
+    # Loader threads hand their parts over through a bounded queue, so a streaming loader
+    # waits for the consumer instead of reading ahead.
+    results = queue.Queue(maxsize=max_workers * 2)
+    cancelled = threading.Event()
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def load(file_path):
+        if cancelled.is_set():
+            return
+        try:
+            for documents, last in load_file_parts(file_path):
+                if not put((file_path, documents, None, last)):
+                    return
+        except Exception as e:
+            put((file_path, [], f"{type(e).__name__}: {e}", True))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for file_path in file_paths:
+            executor.submit(load, file_path)
+        try:
+            remaining = len(file_paths)
+            while remaining:
+                item = results.get()
+                if item[3]:
+                    remaining -= 1
+                yield item
+        finally:
+            cancelled.set()
+
+def iter_documents(file_paths: list[str], mode=None, max_workers=None, timeout=None):
+    """
+    Load files concurrently and yield each file's documents as soon as it is parsed.
+    Files of every type share a single pool. A file that fails to load is reported
+    instead of stopping the others. Streaming loaders yield a file in several parts
+    while they read it; parts of different files may be interleaved.
+
+    Args:
+        file_paths (list[str]): The paths of the files to load.
+        mode (str): "thread" or "process", defaults to LOADER_MODE.
+        max_workers (int): The number of workers, defaults to LOADER_WORKERS.
+        timeout (float): Seconds allowed per file in process mode, defaults to LOADER_TIMEOUT.
+
+    Yields:
+        tuple: (file_path, documents, error, last), where error is None on success and
+        last is True for the final part of a file.
+
+    """
+    mode = mode or LOADER_MODE
+    max_workers = max_workers or LOADER_WORKERS
+    timeout = timeout or LOADER_TIMEOUT
+    if not file_paths:
+        return
+
+    if mode == "process":
+        yield from _iter_documents_in_processes(file_paths, max_workers, timeout)
+    else:
+        yield from _iter_documents_in_threads(file_paths, max_workers)
+
+def documents_file_loader(file_paths: list[str]):
+    """
+    Load a given list of files, picking the loader from their extension.
+    Files that fail to load are skipped with a message.
+
+    Args:
+        file_paths (list[str]): The paths of the files to load.
+
     Returns:
         list: A list of loaded documents.
 
     """
-    document_loader = DirectoryLoader(
-        path=DATA_PATH, 
-        glob=f"**/*{file_type}", 
-        loader_cls=types[file_type],
-        use_multithreading=True
-    )
-    print(f"loader_cls: {types[file_type]}")
-    return document_loader.load()
+    documents = []
+    for file_path, loaded, error, _ in iter_documents(file_paths):
+        if error:
+            print(f"❌ Failed to load {file_path}: {error}")
+        documents.extend(loaded)
+    return documents
 
 def split_documents(documents: list[Document]):
     """
     Splits a list of documents into smaller chunks using a text splitter.
+    Each chunk records its "start_index" and "end_index" in the page text.
 
     Args:
         documents (list[Document]): The list of documents to be split.
@@ -44,10 +427,4 @@ def split_documents(documents: list[Document]):
         list[Document]: The list of split documents.
 
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1024,
-        chunk_overlap=80,
-        length_function=len,
-        is_separator_regex=False,
-    )
     return text_splitter.split_documents(documents)
\ No newline at end of file
@@ -1,48 +1,603 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import dotenv
 from dotenv import load_dotenv
 load_dotenv()
 
 from langchain_community.vectorstores.chroma import Chroma
 from langchain.prompts import ChatPromptTemplate
-from langchain_community.llms.ollama import Ollama
-from langchain_openai import ChatOpenAI
 
 # For chains
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
 
 # For chat history
-from langchain.chains import create_history_aware_retriever
 from langchain_core.prompts import MessagesPlaceholder
 
-from langchain_community.chat_message_histories import SQLChatMessageHistory
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
-from vector_store import load_vector_store
-from db_utils import update_message_with_sources
+# For table questions
+from typing import Any
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from langchain.schema.document import Document
+
+from vector_store import load_vector_store, index_version, sync_lexical_index, sync_filter_metadata, filter_metadata
+from lexical_index import load_lexical_index, lexical_terms
+from db_utils import update_message_with_sources, get_session_history
+from llm_utils import get_llm, OPENAI_MODELS, MODEL_CONTEXT_WINDOWS, OLLAMA_CONTEXT_WINDOW
+from preprocess import CHUNK_SIZE
+from manifest import corpus_version, manifest_paths
+from dedup import NearDuplicateIndex, DEDUP_ENABLED
+from answer_cache import load_answer_cache
+from table_store import TABULAR_MODE, table_summary, run_query, format_row
+from stage_timings import stage, untimed, auntimed
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken is optional, token counts are estimated without it
+    tiktoken = None
 
 chat_history = {}
 
 CHROMA_PATH = "chroma"
 
-def create_chain(model: str):
+# Chunks put in the prompt for a question
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", 3))
+# "1" fuses BM25 results from the lexical index with the vector search results
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "1") == "1"
+# Candidates each retriever contributes before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 10))
+RRF_K = 60
+
+# "1" fetches CONTEXT_CANDIDATES chunks, merges the overlapping ones and packs them into a per-model
+# token budget, "0" puts the RETRIEVAL_K best chunks in the prompt as they are
+CONTEXT_ASSEMBLY = os.getenv("CONTEXT_ASSEMBLY", "1") == "1"
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", 12))
+# Tokens of the context window left for the prompt, the chat history and the answer
+CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", 1024))
+# Share of a model's context window retrieved context may take; it always gets room for the
+# RETRIEVAL_K full chunks that were sent before context assembly, if the window allows
+CONTEXT_WINDOW_SHARE = float(os.getenv("CONTEXT_WINDOW_SHARE", 0.0625))
+# Per-model budgets overriding the above, e.g. "gpt-4-turbo=6000,llama3:70b=4000"
+CONTEXT_BUDGETS = dict(
+    (name.strip(), int(tokens)) for name, _, tokens in
+    (entry.rpartition("=") for entry in os.getenv("CONTEXT_BUDGETS", "").split(",") if "=" in entry)
+)
+# Characters between two chunks of a page below which they are merged into one passage
+CONTEXT_MERGE_GAP = 2
+
+# "always" rewrites every follow-up question before retrieval, "conditional" skips the rewrite
+# for self-contained questions, "speculative" also retrieves with the raw question while rewriting
+QUERY_REWRITE_MODE = os.getenv("QUERY_REWRITE_MODE", "conditional")
+# Term overlap (Jaccard) below which a rewritten query is retrieved again in speculative mode
+REWRITE_SIMILARITY = float(os.getenv("REWRITE_SIMILARITY", 0.5))
+
+_speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-retrieval")
+
+# Words that refer back to the conversation
+_FOLLOW_UP_WORDS = {
+    "it", "its", "this", "that", "these", "those", "they", "them", "their", "he", "she", "him", "her", "his",
+    "one", "ones", "above", "previous", "earlier", "same", "former", "latter", "then", "else",
+}
+_FOLLOW_UP_OPENERS = ("and ", "but ", "so ", "also ", "what about", "how about")
+
+# Models whose chains are kept ready; the least recently used one is dropped first
+CHAIN_CACHE_SIZE = int(os.getenv("CHAIN_CACHE_SIZE", 4))
+_chains = OrderedDict()
+_chains_lock = threading.Lock()
+
+sql_prompt = ChatPromptTemplate.from_messages([
+    ("system", "You write SQLite queries. Given the table below, answer with a single SELECT statement that retrieves the data needed to answer the user's question, and nothing else. Use aggregates (COUNT, SUM, AVG, MIN, MAX, GROUP BY) rather than listing rows whenever possible.\n\n{schema}"),
+    ("human", "{question}")
+])
+
+def _extract_sql(text):
+    # Strip markdown fences and prose around the generated statement
+    if "```" in text:
+        text = text.split("```")[1]
+        if text.lower().startswith("sql"):
+            text = text[3:]
+    return text.strip().split(";")[0]
+
+def is_self_contained(query):
+    # A question is self-contained when it is not too short and nothing in it refers back to the conversation
+    text = query.lower().strip()
+    words = re.findall(r"[a-z']+", text)
+    if len(words) < 3 or text.startswith(_FOLLOW_UP_OPENERS):
+        return False
+    return not any(word in _FOLLOW_UP_WORDS for word in words)
+
+def differs_materially(query, rewritten, threshold=REWRITE_SIMILARITY):
+    # Whether a rewritten query shares too few terms with the original to reuse its results
+    original, new = set(lexical_terms(query.lower()).split()), set(lexical_terms(rewritten.lower()).split())
+    if not new:
+        return False
+    return len(original & new) / len(original | new) < threshold
+
+def create_rewriting_retriever(llm, retriever, prompt, mode=QUERY_REWRITE_MODE):
+    """
+    Creates the retrieval step of the chat chain, which rewrites follow-up questions
+    into standalone search queries.
+
+    In "always" mode every follow-up question is rewritten, like langchain's
+    history-aware retriever. In "conditional" mode the rewrite (a full LLM generation)
+    is skipped on the first turn and for self-contained questions. "speculative" mode
+    also starts retrieving with the raw question while the rewrite runs, and only
+    retrieves again when the rewritten query differs materially from it.
+
+    The "scope" of the chain input, if any, is passed on to the retriever. Run
+    asynchronously, the rewrite and the retrieval are awaited, so cancelling the caller
+    cancels them.
+
+    Args:
+        llm: The model that rewrites the question.
+        retriever (BaseRetriever): The retriever.
+        prompt (ChatPromptTemplate): The rewrite prompt, taking "chat_history" and "input".
+        mode (str): "always", "conditional" or "speculative".
+
+    Returns:
+        Runnable: Takes the chain input and returns the retrieved documents.
+    """
+    rewrite_chain = prompt | llm | StrOutputParser()
+
+    def retrieve(inputs, config):
+        query, scope = inputs["input"], inputs.get("scope")
+        if not inputs.get("chat_history") or (mode != "always" and is_self_contained(query)):
+            return retriever.invoke(query, config, scope=scope)
+        if mode != "speculative":
+            with stage("rewrite"):
+                rewritten = rewrite_chain.invoke(inputs, config)
+            return retriever.invoke(rewritten, config, scope=scope)
+
+        # The speculative retrieval overlaps the rewrite, so only the time spent waiting for it
+        # once the rewrite is done counts as retrieval.
+        speculative = _speculative_executor.submit(
+            contextvars.copy_context().run, untimed, retriever.invoke, query, config, scope=scope
+        )
+        with stage("rewrite"):
+            rewritten = rewrite_chain.invoke(inputs, config)
+        with stage("retrieval"):
+            documents = speculative.result()
+        if differs_materially(query, rewritten):
+            documents = retriever.invoke(rewritten, config, scope=scope)
+        return documents
+
+    async def aretrieve(inputs, config):
+        query, scope = inputs["input"], inputs.get("scope")
+        if not inputs.get("chat_history") or (mode != "always" and is_self_contained(query)):
+            return await retriever.ainvoke(query, config, scope=scope)
+        if mode != "speculative":
+            with stage("rewrite"):
+                rewritten = await rewrite_chain.ainvoke(inputs, config)
+            return await retriever.ainvoke(rewritten, config, scope=scope)
+
+        speculative = asyncio.ensure_future(auntimed(retriever.ainvoke, query, config, scope=scope))
+        try:
+            with stage("rewrite"):
+                rewritten = await rewrite_chain.ainvoke(inputs, config)
+            with stage("retrieval"):
+                documents = await speculative
+        finally:
+            speculative.cancel()
+        if differs_materially(query, rewritten):
+            documents = await retriever.ainvoke(rewritten, config, scope=scope)
+        return documents
+
+    return RunnableLambda(retrieve, afunc=aretrieve).with_config(run_name="retrieve_documents")
+
+def expand_table_documents(documents, question, llm):
+    """
+    Answers the question against the tables behind retrieved table documents.
+
+    Each table document (a schema summary with a "table" in its metadata) is replaced
+    by its summary, the SQL query written by the model and the rows it returned. If the
+    query cannot be written or run, the summary is kept as it is.
+
+    Args:
+        documents (list[Document]): Retrieved documents.
+        question (str): The search query.
+        llm: The model that writes the SQL.
+
+    Returns:
+        list[Document]: The documents, with table documents expanded.
+    """
+    expanded = []
+    for document, schema in _table_schemas(documents):
+        if schema is None:
+            expanded.append(document)
+            continue
+        try:
+            with stage("table_query"):
+                sql = _extract_sql((sql_prompt | llm | StrOutputParser()).invoke({"schema": schema, "question": question}))
+                result = run_query(sql)
+        except Exception as e:
+            print(f"❌ Table query on {document.metadata['table']} failed: {type(e).__name__}: {e}")
+            expanded.append(document)
+            continue
+        expanded.append(_table_result(document, schema, sql, *result))
+    return expanded
+
+async def aexpand_table_documents(documents, question, llm):
+    # Asynchronous counterpart of expand_table_documents, awaiting the model that writes the SQL
+    expanded = []
+    for document, schema in await asyncio.to_thread(lambda: list(_table_schemas(documents))):
+        if schema is None:
+            expanded.append(document)
+            continue
+        try:
+            with stage("table_query"):
+                sql = _extract_sql(await (sql_prompt | llm | StrOutputParser()).ainvoke({"schema": schema, "question": question}))
+                result = await asyncio.to_thread(run_query, sql)
+        except Exception as e:
+            print(f"❌ Table query on {document.metadata['table']} failed: {type(e).__name__}: {e}")
+            expanded.append(document)
+            continue
+        expanded.append(_table_result(document, schema, sql, *result))
+    return expanded
+
+def _table_schemas(documents):
+    # Yield (document, schema of its table): None for documents that are not tables, once per table
+    seen_tables = set()
+    for document in documents:
+        table = document.metadata.get("table")
+        if table is None:
+            yield document, None
+            continue
+        if table in seen_tables:
+            continue
+        seen_tables.add(table)
+        yield document, table_summary(table)
+
+def _table_result(document, schema, sql, columns, rows, truncated):
+    # A table document replaced by its schema, the query and the rows it returned
+    result = [schema, f"Query: {sql}", f"Result ({len(rows)}{'+' if truncated else ''} rows):", format_row(columns)]
+    result.extend(format_row(row) for row in rows)
+    return Document(page_content="\n".join(result), metadata=document.metadata)
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Merges ranked lists of documents with reciprocal rank fusion: a document scores
+    1 / (k + rank) in every list it appears in, so documents ranked well by several
+    retrievers come first whatever the scale of their original scores.
+
+    Args:
+        rankings (list[list[Document]]): Documents ordered best first, one list per retriever.
+        k (int): Dampens the weight of the top ranks.
+
+    Returns:
+        list[Document]: The fused ranking.
+    """
+    scores, documents = {}, {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document.metadata.get("id") or document.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+def expand_scope(scope):
+    """
+    Normalizes the scope of a question: empty entries are dropped, file types lose
+    their dot, and folders include the folders below them.
+
+    Chunks that near-duplicate deduplication did not store for a document in scope are
+    represented by the chunk kept in another document; their IDs are added as
+    "duplicate_ids" so the filters match them too.
+
+    Args:
+        scope (dict): "sources" (list of document paths), "folders" (list of folders),
+            "file_types" (list of extensions) and "ingested_after" (a Unix time), all optional.
+
+    Returns:
+        dict: The scope, or None when it does not restrict anything.
+    """
+    if not scope:
+        return None
+    expanded = {}
+    if scope.get("sources"):
+        expanded["sources"] = sorted(set(scope["sources"]))
+    if scope.get("folders"):
+        roots = [folder.rstrip("/\\") for folder in scope["folders"]]
+        folders = set(roots)
+        for path in manifest_paths():
+            folder = os.path.dirname(path)
+            if any(folder.startswith(root + "/") or folder.startswith(root + os.sep) for root in roots):
+                folders.add(folder)
+        expanded["folders"] = sorted(folders)
+    if scope.get("file_types"):
+        expanded["file_types"] = sorted({file_type.lower().lstrip(".") for file_type in scope["file_types"]})
+    if scope.get("ingested_after") is not None:
+        expanded["ingested_after"] = scope["ingested_after"]
+    if DEDUP_ENABLED and any(expanded.get(name) for name in ("sources", "folders", "file_types")):
+        dedup_index = NearDuplicateIndex()
+        in_scope = [source for source in dedup_index.suppressed_sources() if _source_in_scope(source, expanded)]
+        duplicate_ids = dedup_index.kept_ids(in_scope) if in_scope else []
+        if duplicate_ids:
+            expanded["duplicate_ids"] = duplicate_ids
+    return expanded or None
+
+def _source_in_scope(source, scope):
+    # Whether a document matches the sources, folders and file types of an expanded scope
+    metadata = dict(filter_metadata(source, 0), source=source)
+    return all(
+        metadata[key] in scope[name]
+        for name, key in (("sources", "source"), ("folders", "folder"), ("file_types", "file_type"))
+        if scope.get(name)
+    )
+
+def scope_filter(scope):
+    # The Chroma where filter of an expanded scope, applied inside the vector search
+    if not scope:
+        return None
+    conditions = [
+        {key: {"$in": scope[name]}}
+        for name, key in (("sources", "source"), ("folders", "folder"), ("file_types", "file_type"))
+        if scope.get(name)
+    ]
+    if scope.get("duplicate_ids"):
+        # Chunks kept in another document for a document in scope match as well.
+        match = conditions[0] if len(conditions) == 1 else {"$and": conditions}
+        conditions = [{"$or": [match, {"id": {"$in": scope["duplicate_ids"]}}]}]
+    if scope.get("ingested_after") is not None:
+        conditions.append({"ingested_at": {"$gte": int(scope["ingested_after"])}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def scope_key(scope):
+    # A short stamp of an expanded scope, for cache keys
+    if not scope:
+        return ""
+    return hashlib.sha1(json.dumps(scope, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieves chunks with both the vector store and the BM25 lexical index and fuses
+    the two rankings, so exact identifiers, error codes and part numbers are found even
+    when their embeddings are not close to the question's. Without a lexical index only
+    the vector store is searched.
+
+    A scope passed to invoke (see expand_scope) is applied as a filter inside both searches.
+    """
+
+    vector_store: Any
+    lexical_index: Any = None
+    k: int = RETRIEVAL_K
+    candidates: int = HYBRID_CANDIDATES
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, scope=None):
+        where = scope_filter(scope)
+        with stage("retrieval"):
+            if self.lexical_index is None:
+                return self.vector_store.similarity_search(query, k=self.k, filter=where)
+            vector_hits = self.vector_store.similarity_search(query, k=self.candidates, filter=where)
+            lexical_hits = self.lexical_index.search(query, k=self.candidates, scope=scope)
+            return reciprocal_rank_fusion([vector_hits, lexical_hits])[:self.k]
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, scope=None):
+        # Both searches run in worker threads at the same time
+        where = scope_filter(scope)
+        with stage("retrieval"):
+            if self.lexical_index is None:
+                return await asyncio.to_thread(self.vector_store.similarity_search, query, k=self.k, filter=where)
+            vector_hits, lexical_hits = await asyncio.gather(
+                asyncio.to_thread(self.vector_store.similarity_search, query, k=self.candidates, filter=where),
+                asyncio.to_thread(self.lexical_index.search, query, k=self.candidates, scope=scope),
+            )
+            return reciprocal_rank_fusion([vector_hits, lexical_hits])[:self.k]
+
+def context_budget(model):
+    """
+    The number of prompt tokens the retrieved context of a model may take.
+
+    It is CONTEXT_WINDOW_SHARE of the model's context window, but at least RETRIEVAL_K
+    full chunks, and at most the window minus CONTEXT_RESERVE_TOKENS (never less than one
+    chunk). With the defaults gpt-3.5-turbo gets 1024 tokens, gpt-4-turbo 8000 and an
+    Ollama model with a 2048-token window 771. CONTEXT_BUDGETS overrides it per model.
+
+    Args:
+        model (str): The model name.
+
+    Returns:
+        int: The budget in tokens.
+    """
+    if model in CONTEXT_BUDGETS:
+        return CONTEXT_BUDGETS[model]
+    window = MODEL_CONTEXT_WINDOWS.get(model, OLLAMA_CONTEXT_WINDOW)
+    chunk_tokens = estimate_tokens("x" * CHUNK_SIZE)
+    budget = max(int(window * CONTEXT_WINDOW_SHARE), RETRIEVAL_K * chunk_tokens)
+    return max(min(budget, window - CONTEXT_RESERVE_TOKENS), chunk_tokens)
+
+def estimate_tokens(text):
+    # About four characters per token for English text, with any of the models used here
+    return len(text) // 4 + 1
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def token_counter(model):
+    # The model's own tokenizer for OpenAI models (tiktoken), the estimate for the others
+    if tiktoken is None or model not in OPENAI_MODELS:
+        return estimate_tokens
+    with _encodings_lock:
+        if model not in _encodings:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except Exception as e:
+                # The encoding is downloaded on first use.
+                print(f"⚠️ No tokenizer for {model}, estimating token counts: {type(e).__name__}: {e}")
+                _encodings[model] = None
+        encoding = _encodings[model]
+    if encoding is None:
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+def _join_chunks(first, second):
+    # Join two chunks of a page, the second starting at or after the first, without repeating their overlap.
+    # The overlap is only dropped when the texts really share it, so wrong offsets cannot garble a passage.
+    first_end, second_start, second_end = first.metadata["end_index"], second.metadata["start_index"], second.metadata["end_index"]
+    overlap = first_end - second_start
+    if second_end <= first_end and second.page_content in first.page_content:
+        content = first.page_content
+    elif 0 <= overlap <= min(len(first.page_content), len(second.page_content)) and \
+            first.page_content[len(first.page_content) - overlap:] == second.page_content[:overlap]:
+        content = first.page_content + second.page_content[overlap:]
+    else:
+        content = first.page_content + "\n" + second.page_content
+    metadata = dict(first.metadata, end_index=max(first_end, second_end))
+    metadata["merged_ids"] = first.metadata.get("merged_ids", [first.metadata.get("id")]) + \
+        second.metadata.get("merged_ids", [second.metadata.get("id")])
+    return Document(page_content=content, metadata=metadata)
+
+def merge_adjacent_chunks(documents, max_gap=CONTEXT_MERGE_GAP):
+    """
+    Merges retrieved chunks of the same page that overlap or follow each other into
+    one passage, so the text they share is only sent once.
+
+    Chunks are merged using their "start_index" and "end_index" in the page (or row
+    group); chunks without them (table summaries) are kept as they are. A passage
+    takes the rank of its best chunk and lists the IDs of its chunks in "merged_ids".
+
+    Args:
+        documents (list[Document]): Retrieved chunks, best first.
+        max_gap (int): Characters allowed between two chunks that are merged.
+
+    Returns:
+        list[Document]: The passages, best first.
+    """
+    groups = {}
+    for rank, document in enumerate(documents):
+        metadata = document.metadata
+        if metadata.get("start_index") is None or metadata.get("end_index") is None:
+            key = ("unmergeable", rank)
+        else:
+            # Offsets are relative to the page, or to the row group of a spreadsheet.
+            key = (metadata.get("source"), metadata.get("rows", metadata.get("page")))
+        groups.setdefault(key, []).append((rank, document))
+
+    passages = []
+    for key, members in groups.items():
+        if key[0] == "unmergeable":
+            passages.extend(members)
+            continue
+        members.sort(key=lambda member: member[1].metadata["start_index"])
+        passage_rank, passage = members[0]
+        for rank, document in members[1:]:
+            if document.metadata["start_index"] <= passage.metadata["end_index"] + max_gap:
+                passage, passage_rank = _join_chunks(passage, document), min(passage_rank, rank)
+            else:
+                passages.append((passage_rank, passage))
+                passage_rank, passage = rank, document
+        passages.append((passage_rank, passage))
+    return [passage for _, passage in sorted(passages, key=lambda member: member[0])]
+
+def pack_context(documents, budget, count_tokens=estimate_tokens):
+    """
+    Keeps the passages that fit in a token budget, best first. A passage that does not
+    fit is skipped and the next ones are still tried; if not even the best one fits, its
+    beginning is kept.
+
+    Args:
+        documents (list[Document]): Passages, best first.
+        budget (int): The number of tokens the passages may take.
+        count_tokens (function): Counts the tokens of a text, see token_counter.
+
+    Returns:
+        list[Document]: The packed passages, best first.
+    """
+    packed, used = [], 0
+    for document in documents:
+        tokens = count_tokens(document.page_content)
+        if used + tokens <= budget:
+            packed.append(document)
+            used += tokens
+        elif not packed:
+            content = document.page_content[:len(document.page_content) * budget // tokens]
+            packed.append(Document(page_content=content, metadata=document.metadata))
+            used = budget
+    return packed
+
+def context_sources(documents):
+    # The chunk IDs behind the documents of a context, including the chunks merged into a passage
+    return [chunk_id for doc in documents for chunk_id in doc.metadata.get("merged_ids", [doc.metadata.get("id", None)])]
+
+class PackedContextRetriever(BaseRetriever):
+    """
+    Wraps a retriever that returns more candidates than needed, merges its overlapping
+    chunks and keeps as many passages as fit in the model's context budget.
+    """
+
+    retriever: BaseRetriever
+    budget: int
+    count_tokens: Any = estimate_tokens
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs):
+        documents = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()}, **kwargs)
+        return pack_context(merge_adjacent_chunks(documents), self.budget, self.count_tokens)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs):
+        documents = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}, **kwargs)
+        return pack_context(merge_adjacent_chunks(documents), self.budget, self.count_tokens)
+
+class TableQueryRetriever(BaseRetriever):
+    """
+    Wraps a retriever so that questions hitting a spreadsheet are answered with SQL on
+    the table store instead of with the rows that would fit in the prompt.
+    """
+
+    retriever: BaseRetriever
+    llm: Any
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs):
+        documents = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()}, **kwargs)
+        return expand_table_documents(documents, query, self.llm)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs):
+        documents = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()}, **kwargs)
+        return await aexpand_table_documents(documents, query, self.llm)
+
+def create_chain(model: str, llm=None):
     """
     Creates a retrieval chain for answering user's questions about documents.
 
     Args:
         model (str): The model to be used for generating responses.
+        llm: The client of the model, the shared one from get_llm when not given.
 
     Returns:
         retrieval_chain: The retrieval chain for answering user's questions.
     """
-    if model == "gpt-3.5-turbo-0125" or model == "gpt-4-turbo":
-        model = ChatOpenAI(model=model)
-    else:
-        model = Ollama(model=model)
-    
+    model_name = model
+    model = llm or get_llm(model)
+
     # Prepare the DB.
     db = load_vector_store()
-    retriever = db.as_retriever(search_kwargs={"k": 3})
+    sync_filter_metadata(db)
+    k = CONTEXT_CANDIDATES if CONTEXT_ASSEMBLY else RETRIEVAL_K
+    if HYBRID_RETRIEVAL:
+        sync_lexical_index(db)
+        retriever = HybridRetriever(
+            vector_store=db, lexical_index=load_lexical_index(), k=k, candidates=max(HYBRID_CANDIDATES, k)
+        )
+    else:
+        retriever = HybridRetriever(vector_store=db, k=k)
+    if CONTEXT_ASSEMBLY:
+        retriever = PackedContextRetriever(
+            retriever=retriever, budget=context_budget(model_name), count_tokens=token_counter(model_name)
+        )
+    if TABULAR_MODE == "table":
+        retriever = TableQueryRetriever(retriever=retriever, llm=model)
 
     # Initialize the chains
     prompt_template = ChatPromptTemplate.from_messages([
@@ -62,7 +617,7 @@ def create_chain(model: str):
         ("human", "Given the above conversation, generate a search query to look up in order to get information relevant to the conversation")
     ])
 
-    history_aware_retriever = create_history_aware_retriever(
+    history_aware_retriever = create_rewriting_retriever(
         llm=model,
         retriever=retriever,
         prompt=retriever_prompt
@@ -74,14 +629,55 @@ def create_chain(model: str):
     )
     return retrieval_chain
 
-def process_chat(chain, query_text, session_id):
+def with_message_history(chain):
+    # Wrap a retrieval chain so that it reads and appends the chat history of the session
+    return RunnableWithMessageHistory(
+        chain,
+        get_session_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="answer",
+    )
+
+def get_chain(model: str):
+    """
+    Returns the chat chain of a model, built once and reused for every question.
+
+    Up to CHAIN_CACHE_SIZE chains are kept, evicting the least recently used one.
+    A chain built before the index last changed is rebuilt.
+
+    Args:
+        model (str): The model to be used for generating responses.
+
+    Returns:
+        RunnableWithMessageHistory: The retrieval chain with message history.
+    """
+    version = index_version()
+    with _chains_lock:
+        cached = _chains.get(model)
+        if cached is not None and cached[0] == version:
+            _chains.move_to_end(model)
+            return cached[1]
+
+    chain = with_message_history(create_chain(model))
+    with _chains_lock:
+        _chains[model] = (version, chain)
+        _chains.move_to_end(model)
+        while len(_chains) > CHAIN_CACHE_SIZE:
+            _chains.popitem(last=False)
+    return chain
+
+def process_chat(chain, query_text, session_id, on_token=None, scope=None):
     """
     Process a chat message using a given chain.
 
     Args:
-        chain (RunnableWithMessageHistory): The chain to process the chat message.
+        chain (RunnableWithMessageHistory): The chain to process the chat message, see get_chain.
         query_text (str): The text of the chat message.
         session_id (str): The session ID for the chat.
+        on_token (function): Called with every piece of the answer as it is generated.
+            The answer is streamed from the model when given.
+        scope (dict): Restricts retrieval to some documents, see expand_scope.
 
     Returns:
         tuple: A tuple containing the response and sources. The response is a dictionary
@@ -89,54 +685,104 @@ def process_chat(chain, query_text, session_id):
         of document IDs associated with the response.
 
     """
-    history_chain = RunnableWithMessageHistory(
-        chain,
-        # get_session_history,
-        lambda session_id: SQLChatMessageHistory(
-            session_id=session_id, connection_string="sqlite:///sqlite.db", table_name="history"
-        ),
-        input_messages_key="input",
-        history_messages_key="chat_history",
-        output_messages_key="answer",
-    )
-
-    response = history_chain.invoke(
-        {"input": query_text},
-        config={
-            "configurable": {"session_id": session_id},
-        }
-    )
-    sources = [doc.metadata.get("id", None) for doc in response["context"]]
+    inputs = {"input": query_text, "scope": scope}
+    config = {"configurable": {"session_id": session_id}}
+    if on_token is None:
+        response = chain.invoke(inputs, config=config)
+    else:
+        response = {"answer": ""}
+        for chunk in chain.stream(inputs, config=config):
+            for key, value in chunk.items():
+                if key == "answer":
+                    response["answer"] += value
+                    on_token(value)
+                else:
+                    response[key] = value
+    sources = context_sources(response["context"])
     return response, sources
 
+def format_response(session_id, answer, sources):
+    # Format an answer for the chat window and attach its sources to the stored AI message
+    f_answer = f"{answer}<br>"
+    f_sources = "<b>Sources:</b><ul>"
+    for source in sources:
+        f_sources += f"<li>{source}</li>"
+    f_sources += "</ul>"
+
+    print(f"f_answer: {f_answer}")
+    print(f"f_sources: {f_sources}")
+    formatted_response = [f_answer, f_sources, sources]
+    update_message_with_sources(session_id, sources)
+    return formatted_response
+
+def lookup_answer(model, query_text, history_messages, scope=None):
+    """
+    Looks a question up in the answer cache.
+
+    Only questions that do not depend on the conversation are cached: self-contained
+    ones and the first question of a chat.
+
+    Args:
+        model (str): The model that answers.
+        query_text (str): The question.
+        history_messages (list): The messages of the chat so far.
+        scope (dict): The expanded scope of the question; answers are only shared within a scope.
+
+    Returns:
+        tuple: (the cached answer or None, the key to store the answer under or None when
+        the question cannot be cached).
+    """
+    answer_cache = load_answer_cache()
+    if answer_cache is None or (history_messages and not is_self_contained(query_text)):
+        return None, None
+    with stage("cache"):
+        key = (corpus_version() + scope_key(scope), load_vector_store().embeddings.embed_query(query_text))
+        hit = answer_cache.lookup(model, *key)
+    if hit:
+        print(f"⚡ Answer cache hit (similarity {hit['similarity']:.3f}, hit rate {answer_cache.hit_rate():.0%})")
+    return hit, key
 
-def query_rag(model: str, session_id: str, query_text: str):
+def store_answer(model, key, query_text, answer, sources):
+    # Cache an answer under the key returned by lookup_answer
+    if key is not None:
+        version, query_vector = key
+        load_answer_cache().store(model, version, query_text, query_vector, answer, sources)
+
+def query_rag(model: str, session_id: str, query_text: str, on_token=None, scope=None):
     """
     Queries the RAG (Retrieval-Augmented Generation) model with the given parameters.
 
+    Questions that do not depend on the conversation are looked up in the answer cache
+    first, by similarity to earlier questions asked to the same model against the same
+    corpus version.
+
     Args:
         model (str): The name of the RAG model to use.
         session_id (str): The session ID for the query.
         query_text (str): The text of the query.
+        on_token (function): Called with every piece of the answer as it is generated.
+        scope (dict): Only retrieve from these "sources", "folders" or "file_types", or from
+            chunks ingested at or after "ingested_after" (a Unix time).
 
     Returns:
         list: A list containing the formatted response, formatted sources, and sources.
     """
-    chain = create_chain(model)
-    response, sources = process_chat(chain, query_text, session_id)
+    scope = expand_scope(scope)
+    history = get_session_history(session_id)
+    hit, key = lookup_answer(model, query_text, history.messages, scope)
+    if hit:
+        history.add_user_message(query_text)
+        history.add_ai_message(hit["answer"])
+        if on_token:
+            on_token(hit["answer"])
+        return format_response(session_id, hit["answer"], hit["sources"])
 
-    f_answer = f"{response['answer']}<br>"
-    f_sources = "<b>Sources:</b><ul>"
-    for source in sources:
-        f_sources += f"<li>{source}</li>"
-    f_sources += "</ul>"
-    
-    print(f"f_answer: {f_answer}")
-    print(f"f_sources: {f_sources}")
-    formatted_response = [f_answer, f_sources, sources]
-    update_message_with_sources(session_id, sources)
-    
-    return formatted_response
+    chain = get_chain(model)
+    with stage("chain"):
+        response, sources = process_chat(chain, query_text, session_id, on_token=on_token, scope=scope)
+    store_answer(model, key, query_text, response["answer"], sources)
+
+    return format_response(session_id, response["answer"], sources)
 # DEBUG
 # if __name__ == "__main__":
 #     print(query_rag("gpt-3.5-turbo-0125", "4", "What is fuzzy set then?"))
@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from vector_store import load_vector_store, sync_lexical_index, ingest_data_directory, docs_used_in_chroma, index_version
+from query_data_v2 import query_rag, get_chain
+from summarize_docs import summarize_docs
+from db_utils import create_db, generate_session_id, return_chat_history
+from async_api import backend_of, OLLAMA_MAX_CONCURRENCY, OPENAI_MAX_CONCURRENCY
+from watcher import DataWatcher
+
+SERVER_HOST = os.getenv("SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8765))
+
+class _Call:
+    # One running request and the tokens it has produced so far, for the requests joining it
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self.condition = threading.Condition()
+
+    def publish(self, token):
+        with self.condition:
+            self.tokens.append(token)
+            self.condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.condition:
+            self.result, self.error, self.done = result, error, True
+            self.condition.notify_all()
+
+    def follow(self, on_token=None):
+        # Replay the tokens produced so far, then the new ones, and return the result
+        seen = 0
+        while True:
+            with self.condition:
+                while seen == len(self.tokens) and not self.done:
+                    self.condition.wait()
+                tokens, done = self.tokens[seen:], self.done
+            seen += len(tokens)
+            if on_token:
+                for token in tokens:
+                    on_token(token)
+            if done and seen == len(self.tokens):
+                break
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class RequestCoalescer:
+    """
+    Runs identical requests once: a request arriving while an identical one is in flight
+    waits for it and gets the same result, and the tokens it streamed so far followed by
+    the rest.
+
+    Requests are identical when their keys are equal; the key includes the session, so a
+    duplicate submission in one chat writes its question and answer to the history once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, fn, on_token=None):
+        """
+        Runs fn, or joins the identical call in flight.
+
+        Args:
+            key (tuple): Identifies the request.
+            fn (function): Called with an `on_token` callback when this request runs it.
+            on_token (function): Called with every token of the result.
+
+        Returns:
+            The result of fn.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            return call.follow(on_token)
+
+        def publish(token):
+            call.publish(token)
+            if on_token:
+                on_token(token)
+
+        try:
+            result = fn(publish)
+        except Exception as e:
+            call.finish(error=e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+        call.finish(result=result)
+        return result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+coalescer = RequestCoalescer()
+
+# Questions and summaries answered at the same time per backend, like async_api
+_backend_slots = {
+    "ollama": threading.BoundedSemaphore(OLLAMA_MAX_CONCURRENCY),
+    "openai": threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY),
+}
+
+_session_lock = threading.Lock()
+_last_session_id = 0
+
+def new_session_id():
+    # Like generate_session_id, but two clients asking at the same time get different IDs
+    global _last_session_id
+    with _session_lock:
+        _last_session_id = max(int(generate_session_id()), _last_session_id + 1)
+        return str(_last_session_id)
+
+def _answer(model, session_id, question, scope, on_token):
+    with _backend_slots[backend_of(model)]:
+        f_answer, _, sources = query_rag(model, session_id, question, on_token=on_token, scope=scope)
+    return {"answer": f_answer.removesuffix("<br>"), "sources": sources}
+
+def _summarize(model, session_id, on_token):
+    with _backend_slots[backend_of(model)]:
+        summary = summarize_docs(model, session_id)
+    on_token(summary)
+    return {"summary": summary}
+
+def _ingest(dry_run, on_token):
+    failed = ingest_data_directory(dry_run=dry_run)
+    return {"failed": failed, "index_version": index_version()}
+
+class AnalyzerHandler(BaseHTTPRequestHandler):
+    """
+    The HTTP API of the document analyzer.
+
+    GET  /health                        {"status", "index_version", "in_flight"}
+    GET  /documents                     {"documents": [source, ...]}
+    GET  /history[?session=ID]          {"sessions": {ID: [message, ...]}}
+    POST /sessions                      {"session": ID}
+    POST /ingest     {"dry_run"}        {"failed": [path, ...], "index_version"}
+    POST /query      {"model", "session", "question", "scope", "stream"}
+                                        {"answer", "sources"}
+    POST /summarize  {"model", "session", "stream"}
+                                        {"summary"}
+
+    With "stream": true the answer is sent as JSON lines, {"token": ...} for every piece
+    of it and the final object last. Errors are returned as {"error": message}.
+    """
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = json.loads(self.rfile.read(length) or b"{}")
+        if not isinstance(data, dict):
+            raise ValueError("the request body must be a JSON object")
+        return data
+
+    def _run(self, key, fn, stream):
+        # Run a coalesced request and send its result, as JSON lines when streaming
+        if not stream:
+            self._send_json(200, coalescer.run(key, fn))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        connected = [True]
+
+        def write_line(data):
+            if not connected[0]:
+                return
+            try:
+                self.wfile.write((json.dumps(data) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except OSError:
+                # The client went away; the request still finishes for the others sharing it.
+                connected[0] = False
+
+        try:
+            result = coalescer.run(key, fn, on_token=lambda token: write_line({"token": token}))
+        except Exception as e:
+            result = {"error": f"{type(e).__name__}: {e}"}
+        write_line(result)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == "/health":
+                self._send_json(200, {"status": "ok", "index_version": index_version(), "in_flight": coalescer.in_flight()})
+            elif url.path == "/documents":
+                self._send_json(200, {"documents": docs_used_in_chroma()})
+            elif url.path == "/history":
+                sessions = return_chat_history()
+                if "session" in params:
+                    sessions = {session: sessions.get(session, []) for session in params["session"]}
+                self._send_json(200, {"sessions": sessions})
+            else:
+                self._send_json(404, {"error": f"unknown path {url.path}"})
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            data = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {"error": f"invalid JSON: {e}"})
+            return
+
+        try:
+            if url.path == "/sessions":
+                self._send_json(200, {"session": new_session_id()})
+            elif url.path == "/ingest":
+                dry_run = bool(data.get("dry_run"))
+                self._run(("ingest", dry_run), lambda on_token: _ingest(dry_run, on_token), stream=False)
+            elif url.path == "/query":
+                model, session, question = data["model"], str(data["session"]), data["question"]
+                scope = data.get("scope")
+                self._run(
+                    ("query", model, session, question, json.dumps(scope, sort_keys=True)),
+                    lambda on_token: _answer(model, session, question, scope, on_token),
+                    stream=bool(data.get("stream")),
+                )
+            elif url.path == "/summarize":
+                model, session = data["model"], str(data["session"])
+                self._run(
+                    ("summarize", model, session),
+                    lambda on_token: _summarize(model, session, on_token),
+                    stream=bool(data.get("stream")),
+                )
+            else:
+                self._send_json(404, {"error": f"unknown path {url.path}"})
+        except KeyError as e:
+            self._send_json(400, {"error": f"missing field {e}"})
+        except Exception as e:
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+def warm_up(models=()):
+    """
+    Opens the vector store, the lexical index and the chat history database, and builds
+    the chains of the given models, so the first requests do not pay for them.
+
+    Args:
+        models (list[str]): The models to build a chain for.
+    """
+    create_db()
+    sync_lexical_index(load_vector_store())
+    for model in models:
+        get_chain(model)
+    print(f"🔥 Backend warm ({len(models)} chains ready)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the document analyzer over HTTP.")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--warm", action="append", default=[], metavar="MODEL", help="Build the chain of a model at startup.")
+    parser.add_argument("--watch", action="store_true", help="Ingest the files that change in data/.")
+    args = parser.parse_args()
+
+    warm_up(args.warm)
+    watcher = None
+    if args.watch:
+        watcher = DataWatcher("data")
+        watcher.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), AnalyzerHandler)
+    print(f"🌐 Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if watcher:
+            watcher.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+_timings = contextvars.ContextVar("stage_timings", default=None)
+
+def start_timings():
+    """
+    Starts collecting stage timings in the current context. Threads and tasks started
+    from it with a copy of the context (asyncio tasks, asyncio.to_thread, langchain's
+    executors) add their stages to the same dict.
+
+    Returns:
+        dict: stage name -> seconds, filled in as stages finish.
+    """
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+@contextmanager
+def stage(name):
+    # Add the time spent in the block to the stage, when timings are being collected
+    timings = _timings.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def untimed(func, *args, **kwargs):
+    # Call func without adding its stages to the timings, for work that overlaps a timed
+    # stage; only to be run in a copy of the context (a task, or contextvars.Context.run)
+    _timings.set(None)
+    return func(*args, **kwargs)
+
+async def auntimed(func, *args, **kwargs):
+    # untimed for a coroutine function, wrapped in a task
+    _timings.set(None)
+    return await func(*args, **kwargs)
+
+def record(name, seconds):
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+def percentile(values, p):
+    # Nearest-rank percentile of a list of numbers
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(-(-p * len(ordered) // 100)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
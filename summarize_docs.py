@@ -1,36 +1,22 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from langchain_community.llms.ollama import Ollama
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.chains.llm import LLMChain
 from langchain.chains import MapReduceDocumentsChain, ReduceDocumentsChain
 from langchain.chains.combine_documents.stuff import StuffDocumentsChain
 
-from langchain_community.chat_message_histories import SQLChatMessageHistory
-
-from preprocess import documents_directory_loader, split_documents
-from db_utils import create_db
+from preprocess import scan_directory, documents_file_loader, split_documents, RowGroupLoader
+from table_store import is_table_file, stored_table_documents
+from db_utils import create_db, get_session_history
+from llm_utils import get_llm
 
 # Code for loading a pdf document and then summarize it using langchain map reduce
 
 DATA_PATH = "data"
 
-types = [
-    ".pdf",
-    ".docx",
-    ".md",
-    ".pptx",
-    ".xlsx",
-    ".csv"
-]
-
-def create_summary_chain(model):
-    if model == "gpt-3.5-turbo-0125" or model == "gpt-4-turbo":
-        model = ChatOpenAI(model=model)
-    else:
-        model = Ollama(model=model)
+def create_summary_chain(model, llm=None):
+    model = llm or get_llm(model)
 
     # Map chain
     map_prompt = """
@@ -78,6 +64,25 @@ def create_summary_chain(model):
 
     return map_reduce_chain
 
+def load_documents_to_summarize():
+    # Load and split every supported file of the data directory, without writing to the table store:
+    # spreadsheets use the summaries of their loaded tables, or are read as rows when not ingested yet
+    files_by_type = scan_directory(DATA_PATH)
+    file_paths = [path for paths in files_by_type.values() for path in paths]
+    table_files = [path for path in file_paths if is_table_file(path)]
+    stored = stored_table_documents(table_files)
+
+    documents = documents_file_loader([path for path in file_paths if not is_table_file(path)])
+    for path in table_files:
+        if path in stored:
+            documents.extend(stored[path])
+            continue
+        try:
+            documents.extend(RowGroupLoader(path).load())
+        except Exception as e:
+            print(f"❌ Failed to load {path}: {e}")
+    return split_documents(documents)
+
 def summarize_docs(model, session_id):
     """
     Summarizes documents using the specified model.
@@ -89,12 +94,7 @@ def summarize_docs(model, session_id):
     Returns:
         str: The summaries of the documents.
     """
-    split_docs = []
-    for file_type in types:
-        documents = documents_directory_loader(file_type, DATA_PATH)
-        print(documents)
-        splits = split_documents(documents)
-        split_docs.extend(splits)
+    split_docs = load_documents_to_summarize()
 
     print(f"Summarizing documents using {model}, Please wait...")
 
@@ -105,9 +105,7 @@ def summarize_docs(model, session_id):
     summaries = response["output_text"]
 
     # Add summaries to chat history
-    chat_message_history = SQLChatMessageHistory(
-        session_id=session_id, connection_string="sqlite:///sqlite.db", table_name="history"
-    )
+    chat_message_history = get_session_history(session_id)
     chat_message_history.add_ai_message(summaries)
 
     print(f"Summaries:\n{summaries}")
@@ -0,0 +1,390 @@
+import csv
+import datetime
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import openpyxl
+from langchain.schema.document import Document
+
+# "table" loads .csv/.xlsx files into the table store and only embeds their schema,
+# "rows" embeds groups of rows like any other text
+TABULAR_MODE = os.getenv("TABULAR_MODE", "table")
+TABLE_STORE_PATH = os.getenv("TABLE_STORE_PATH", "tables.db")
+TABLE_SAMPLE_ROWS = int(os.getenv("TABLE_SAMPLE_ROWS", 3))
+# Rows returned to the model for one table query
+TABLE_QUERY_MAX_ROWS = int(os.getenv("TABLE_QUERY_MAX_ROWS", 50))
+# Seconds a table query may run before it is aborted
+TABLE_QUERY_TIMEOUT = float(os.getenv("TABLE_QUERY_TIMEOUT", 10))
+TABLE_INSERT_BATCH_SIZE = 5000
+
+tabular_types = (".csv", ".xlsx")
+
+def is_table_file(file_path):
+    # Whether a file goes to the table store instead of being embedded row by row
+    return TABULAR_MODE == "table" and os.path.splitext(file_path)[1].lower() in tabular_types
+
+def format_row(values):
+    # One spreadsheet row as a CSV line, without its trailing empty cells
+    values = ["" if value is None else value for value in values]
+    while values and values[-1] == "":
+        values.pop()
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="").writerow(values)
+    return buffer.getvalue()
+
+def iter_sheets(file_path):
+    """
+    Streams the tables of a spreadsheet without loading it in memory.
+
+    A CSV file is a single table whose first row is the header. Every worksheet of an
+    XLSX workbook (opened read-only) is a table whose first non-empty row is the header.
+
+    Args:
+        file_path (str): The path of the .csv or .xlsx file.
+
+    Yields:
+        tuple: (sheet name or None, header, iterator of (row number, values)).
+    """
+    if os.path.splitext(file_path)[1].lower() == ".csv":
+        with open(file_path, newline="", encoding="utf-8", errors="replace") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is not None:
+                yield None, header, enumerate(reader, start=2)
+        return
+
+    workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            rows = enumerate(worksheet.iter_rows(values_only=True), start=1)
+            header = next((values for _, values in rows if format_row(values)), None)
+            if header is not None:
+                yield worksheet.title, header, rows
+    finally:
+        workbook.close()
+
+def table_name(source, sheet=None):
+    # A stable SQL name for a sheet, e.g. "sales_q1_3f2a9c"
+    stem = os.path.splitext(os.path.basename(source))[0]
+    label = stem if sheet is None else f"{stem}_{sheet}"
+    slug = re.sub(r"\W+", "_", label.lower()).strip("_")[:40] or "table"
+    digest = hashlib.sha1(f"{source}\n{sheet}".encode("utf-8")).hexdigest()[:6]
+    return f"{slug}_{digest}"
+
+def _column_names(header):
+    # Unique SQL column names for a header row
+    names = []
+    for i, value in enumerate(header, start=1):
+        name = re.sub(r"\W+", "_", str(value if value is not None else "").strip().lower()).strip("_")
+        if not name or name[0].isdigit():
+            name = f"col_{i}" if not name else f"col_{name}"
+        while name in names:
+            name = f"{name}_{i}"
+        names.append(name)
+    return names
+
+def _stage_value(value):
+    # A cell as it is staged: text is kept as written, empty cells become NULL
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if not isinstance(value, str):
+        return value
+    return value.strip() or None
+
+def _value_type(value):
+    # The narrowest column type holding a staged value, None for an empty cell
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "REAL" if math.isfinite(value) else "TEXT"
+    # Leading zeros (zip codes, identifiers) are kept as text, like the digit groupings SQLite does not read.
+    if len(value) > 1 and value.lstrip("+-").startswith("0") and not value.lstrip("+-").startswith("0."):
+        return "TEXT"
+    if "_" in value:
+        return "TEXT"
+    try:
+        int(value)
+        return "INTEGER"
+    except ValueError:
+        pass
+    try:
+        return "REAL" if math.isfinite(float(value)) else "TEXT"
+    except ValueError:
+        return "TEXT"
+
+def _column_type(types):
+    # One type for a whole column, so every value of it compares the same way
+    if "TEXT" in types or not types:
+        return "TEXT"
+    return "REAL" if "REAL" in types else "INTEGER"
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _connect(timeout=60):
+    conn = sqlite3.connect(TABLE_STORE_PATH, timeout=timeout)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute('''CREATE TABLE IF NOT EXISTS table_catalog
+             (table_name TEXT PRIMARY KEY, source TEXT, sheet TEXT, columns TEXT, row_count INTEGER,
+              first_row INTEGER, last_row INTEGER, summary TEXT, updated REAL)''')
+    conn.commit()
+    return conn
+
+def _describe(conn, name, columns):
+    # Type, distinct count and range of every column, in a single scan of the table
+    selects = []
+    for column in columns:
+        quoted = _quote(column)
+        selects += [
+            f"SUM(typeof({quoted}) = 'integer')", f"SUM(typeof({quoted}) = 'real')",
+            f"SUM(typeof({quoted}) = 'text')", f"COUNT(DISTINCT {quoted})", f"MIN({quoted})", f"MAX({quoted})",
+        ]
+    values = conn.execute(f"SELECT {', '.join(selects)} FROM {_quote(name)}").fetchone()
+
+    described = []
+    for i, column in enumerate(columns):
+        integers, reals, texts, distinct, low, high = values[i * 6:(i + 1) * 6]
+        if texts or not (integers or reals):
+            column_type = "TEXT"
+        elif reals:
+            column_type = "REAL"
+        else:
+            column_type = "INTEGER"
+        described.append({"name": column, "type": column_type, "distinct": distinct or 0, "min": low, "max": high})
+    return described
+
+def _summary(name, source, sheet, columns, row_count, sample):
+    location = source if sheet is None else f"{source}, sheet {sheet}"
+    lines = [f"Table {name} ({location}): {row_count} rows, {len(columns)} columns.", "Columns:"]
+    for column in columns:
+        line = f"- {column['name']} {column['type']}, {column['distinct']} distinct values"
+        if column["min"] is not None:
+            line += f", from {str(column['min'])[:40]} to {str(column['max'])[:40]}"
+        lines.append(line)
+    lines.append("Sample rows:")
+    lines.append(format_row([column["name"] for column in columns]))
+    lines.extend(format_row(row) for row in sample)
+    return "\n".join(lines)
+
+def load_sheet(conn, source, sheet, header, rows):
+    """
+    Loads one table into the store, replacing its previous version.
+
+    Rows are inserted in batches into a staging table that is swapped in once complete,
+    so readers never see a half-loaded table and other loads can write in between.
+
+    Every column gets one declared type, inferred from all of its values: INTEGER or REAL
+    when every value is a number, TEXT otherwise (e.g. zip codes with leading zeros), in
+    which case its numbers are stored as text too.
+
+    Args:
+        conn (sqlite3.Connection): A connection to the table store.
+        source (str): The path of the spreadsheet.
+        sheet (str): The name of the worksheet, None for a CSV file.
+        header (list): The header row.
+        rows (iterable): (row number, values) of the data rows.
+
+    Returns:
+        dict: The catalog entry of the table.
+    """
+    name = table_name(source, sheet)
+    raw = f"{name}__raw"
+    staging = f"{name}__loading"
+    columns = _column_names(header)
+    width = len(columns)
+    column_types = [set() for _ in columns]
+
+    conn.execute(f"DROP TABLE IF EXISTS {_quote(raw)}")
+    conn.execute(f"DROP TABLE IF EXISTS {_quote(staging)}")
+    conn.execute(f"CREATE TABLE {_quote(raw)} ({', '.join(_quote(column) for column in columns)})")
+    insert = f"INSERT INTO {_quote(raw)} VALUES ({', '.join('?' * width)})"
+
+    batch, row_count, first_row, last_row = [], 0, None, None
+    for row_number, values in rows:
+        values = [_stage_value(value) for value in list(values)[:width]]
+        if all(value is None for value in values):
+            continue
+        for types, value in zip(column_types, values):
+            value_type = _value_type(value)
+            if value_type:
+                types.add(value_type)
+        batch.append(values + [None] * (width - len(values)))
+        row_count += 1
+        first_row = first_row or row_number
+        last_row = row_number
+        if len(batch) >= TABLE_INSERT_BATCH_SIZE:
+            conn.executemany(insert, batch)
+            conn.commit()
+            batch = []
+    conn.executemany(insert, batch)
+    conn.commit()
+
+    # The declared types convert the staged values as they are copied.
+    declared = ", ".join(f"{_quote(column)} {_column_type(types)}" for column, types in zip(columns, column_types))
+    with conn:
+        conn.execute(f"CREATE TABLE {_quote(staging)} ({declared})")
+        conn.execute(f"INSERT INTO {_quote(staging)} SELECT * FROM {_quote(raw)}")
+        conn.execute(f"DROP TABLE {_quote(raw)}")
+
+    described = _describe(conn, staging, columns)
+    sample = conn.execute(f"SELECT * FROM {_quote(staging)} LIMIT ?", (TABLE_SAMPLE_ROWS,)).fetchall()
+    summary = _summary(name, source, sheet, described, row_count, sample)
+
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+        conn.execute(f"ALTER TABLE {_quote(staging)} RENAME TO {_quote(name)}")
+        conn.execute(
+            "INSERT OR REPLACE INTO table_catalog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, source, sheet, json.dumps(described, default=str), row_count, first_row, last_row, summary, time.time()),
+        )
+    return {"table_name": name, "sheet": sheet, "row_count": row_count, "first_row": first_row, "last_row": last_row, "summary": summary}
+
+class TableLoader:
+    """
+    Loads the tables of a .csv or .xlsx file into the table store (TABLE_STORE_PATH).
+
+    Rows are streamed into SQLite instead of being embedded; the loader only returns one
+    Document per table with its schema, column statistics and a few sample rows, which is
+    what goes into the vector store. Questions that retrieve it are answered with SQL.
+
+    Args:
+        file_path (str): The path of the spreadsheet.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def load(self):
+        conn = _connect()
+        try:
+            entries = [load_sheet(conn, self.file_path, sheet, header, rows) for sheet, header, rows in iter_sheets(self.file_path)]
+            # Sheets that no longer exist in the file are dropped.
+            loaded = {entry["table_name"] for entry in entries}
+            _drop(conn, [name for name, in conn.execute(
+                "SELECT table_name FROM table_catalog WHERE source = ?", (self.file_path,)
+            ) if name not in loaded])
+        finally:
+            conn.close()
+
+        return [_table_document(self.file_path, entry) for entry in entries]
+
+def _table_document(source, entry):
+    # The Document embedded for a table: its summary, pointing at the table
+    rows_label = f"{entry['first_row']}-{entry['last_row']}"
+    if entry["sheet"] is not None:
+        rows_label = f"{entry['sheet']}!{rows_label}"
+    metadata = {"source": source, "table": entry["table_name"], "rows": rows_label}
+    if entry["sheet"] is not None:
+        metadata["sheet"] = entry["sheet"]
+    return Document(page_content=entry["summary"], metadata=metadata)
+
+def stored_table_documents(sources):
+    """
+    Reads the table documents of spreadsheets already in the table store, without
+    loading anything into it.
+
+    Args:
+        sources (list[str]): The paths of the spreadsheets.
+
+    Returns:
+        dict: source -> list of Documents, for the sources that have tables in the store.
+    """
+    if not sources or not os.path.exists(TABLE_STORE_PATH):
+        return {}
+    conn = sqlite3.connect(f"{Path(TABLE_STORE_PATH).resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(
+            f"""SELECT source, table_name, sheet, first_row, last_row, summary FROM table_catalog
+               WHERE source IN ({",".join("?" * len(sources))}) ORDER BY source, table_name""",
+            list(sources),
+        ).fetchall()
+    finally:
+        conn.close()
+    documents = {}
+    for source, name, sheet, first_row, last_row, summary in rows:
+        entry = {"table_name": name, "sheet": sheet, "first_row": first_row, "last_row": last_row, "summary": summary}
+        documents.setdefault(source, []).append(_table_document(source, entry))
+    return documents
+
+def _drop(conn, names):
+    with conn:
+        for name in names:
+            conn.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+            conn.execute("DELETE FROM table_catalog WHERE table_name = ?", (name,))
+
+def drop_tables(sources):
+    # Remove the tables of deleted files
+    if not sources or not os.path.exists(TABLE_STORE_PATH):
+        return
+    conn = _connect()
+    try:
+        placeholders = ",".join("?" * len(sources))
+        names = [name for name, in conn.execute(
+            f"SELECT table_name FROM table_catalog WHERE source IN ({placeholders})", list(sources)
+        )]
+        _drop(conn, names)
+    finally:
+        conn.close()
+
+def clear_tables():
+    if os.path.exists(TABLE_STORE_PATH):
+        conn = _connect()
+        try:
+            _drop(conn, [name for name, in conn.execute("SELECT table_name FROM table_catalog")])
+        finally:
+            conn.close()
+
+def table_summary(name):
+    # The schema description of a table, None when it is not in the store
+    if not os.path.exists(TABLE_STORE_PATH):
+        return None
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT summary FROM table_catalog WHERE table_name = ?", (name,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def run_query(sql, max_rows=TABLE_QUERY_MAX_ROWS, timeout=TABLE_QUERY_TIMEOUT):
+    """
+    Runs a read-only query against the table store.
+
+    Only a single SELECT (or WITH ... SELECT) statement is accepted, the store is opened
+    read-only and the query is aborted after `timeout` seconds.
+
+    Args:
+        sql (str): The query.
+        max_rows (int): The maximum number of rows returned.
+        timeout (float): Seconds the query may run.
+
+    Returns:
+        tuple: (column names, rows, truncated).
+    """
+    sql = sql.strip().rstrip(";").strip()
+    if ";" in sql or not re.match(r"(?is)^(select|with)\b", sql):
+        raise ValueError("only a single SELECT statement can be run")
+
+    conn = sqlite3.connect(f"{Path(TABLE_STORE_PATH).resolve().as_uri()}?mode=ro", uri=True)
+    deadline = time.monotonic() + timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        cursor = conn.execute(sql)
+        columns = [description[0] for description in cursor.description]
+        rows = cursor.fetchmany(max_rows + 1)
+    finally:
+        conn.close()
+    return columns, rows[:max_rows], len(rows) > max_rows
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The modules keep their databases at relative paths, so every test runs in its own directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    return tmp_path
+
+@pytest.fixture
+def store(workdir, monkeypatch):
+    # A fresh vector store and lexical index with deterministic embeddings, and .txt files as a loadable type
+    from langchain_community.document_loaders import TextLoader
+    from chromadb.api.client import SharedSystemClient
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+    import lexical_index
+    import preprocess
+    import vector_store
+
+    monkeypatch.setattr(vector_store, "get_embedding_function", lambda: DeterministicFakeEmbedding(size=32))
+    monkeypatch.setattr(vector_store, "_vector_store", None)
+    # Chroma keeps one client per path for the whole process; every test gets its own.
+    monkeypatch.setattr(vector_store, "CHROMA_PATH", str(workdir / "chroma"))
+    SharedSystemClient.clear_system_cache()
+    monkeypatch.setattr(vector_store, "_filter_metadata_synced", False)
+    monkeypatch.setattr(lexical_index, "_lexical_index", None)
+    monkeypatch.setitem(preprocess.types, ".txt", TextLoader)
+    return vector_store
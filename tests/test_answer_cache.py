@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache
+from query_data_v2 import lookup_answer, store_answer
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+@pytest.fixture
+def cache(store, monkeypatch):
+    cache = AnswerCache(path="answers.db")
+    monkeypatch.setattr(answer_cache, "_answer_cache", cache)
+    write(os.path.join("data", "a.txt"), "The first document.")
+    store.ingest_data_directory()
+    return cache
+
+def ask(question, scope=None, history=()):
+    # Look the question up, and cache an answer for it on a miss
+    hit, key = lookup_answer("llama3", question, list(history), scope)
+    if hit:
+        return hit["answer"]
+    store_answer("llama3", key, question, f"answer {len(os.listdir('data'))} {scope}", [])
+    return None
+
+def test_answers_are_reused_within_a_corpus_version(cache, store):
+    assert ask("What is in the first document?") is None
+    assert ask("What is in the first document?") == "answer 1 None"
+
+    # An ingest changes the corpus version, so the question is answered again
+    write(os.path.join("data", "b.txt"), "The second document.")
+    store.ingest_data_directory()
+    assert ask("What is in the first document?") is None
+    assert ask("What is in the first document?") == "answer 2 None"
+    assert cache.stats == {"hits": 2, "misses": 2}
+
+def test_answers_are_reused_within_a_scope(cache):
+    first = {"sources": [os.path.join("data", "a.txt")]}
+    second = {"sources": [os.path.join("data", "b.txt")]}
+    assert ask("What is in the first document?", scope=first) is None
+    assert ask("What is in the first document?") is None
+    assert ask("What is in the first document?", scope=second) is None
+
+    assert ask("What is in the first document?", scope=first) == f"answer 1 {first}"
+    assert ask("What is in the first document?", scope=second) == f"answer 1 {second}"
+    assert ask("What is in the first document?") == "answer 1 None"
+
+def test_follow_up_questions_are_not_cached(cache):
+    history = [("human", "What is in the first document?"), ("ai", "A sentence.")]
+    assert lookup_answer("llama3", "and what else?", history) == (None, None)
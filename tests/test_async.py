@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+import query_data_v2
+from lexical_index import load_lexical_index
+from stage_timings import stage, start_timings
+
+class HangingChatModel(FakeListChatModel):
+    # A model whose asynchronous calls never return, and that must not be called synchronously
+    responses: list = [""]
+    cancelled: list = []
+
+    def _generate(self, *args, **kwargs):
+        raise AssertionError("the model was called synchronously")
+
+    async def _agenerate(self, *args, **kwargs):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            self.cancelled.append(True)
+            raise
+
+PROMPT = ChatPromptTemplate.from_messages([MessagesPlaceholder(variable_name="chat_history"), ("human", "{input}")])
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+@pytest.fixture
+def retriever(store):
+    first = write(os.path.join("data", "first.txt"), "The warehouse stores part number ZX-4471. " * 5)
+    write(os.path.join("data", "second.txt"), "Office notes about desks and chairs. " * 5)
+    store.ingest_data_directory()
+    hybrid = query_data_v2.HybridRetriever(vector_store=store.load_vector_store(), lexical_index=load_lexical_index(), k=4)
+    return query_data_v2.PackedContextRetriever(retriever=hybrid, budget=1000), first
+
+def test_ainvoke_with_scope(retriever):
+    retriever, first = retriever
+    documents = asyncio.run(retriever.ainvoke("part number ZX-4471", scope={"sources": [first]}))
+    assert documents
+    assert {document.metadata["source"] for document in documents} == {first}
+    assert documents == retriever.invoke("part number ZX-4471", scope={"sources": [first]})
+
+@pytest.mark.parametrize("mode", ["always", "conditional", "speculative"])
+def test_cancelling_cancels_the_rewrite(retriever, mode):
+    retriever, first = retriever
+    llm = HangingChatModel(cancelled=[])
+    rewriting = query_data_v2.create_rewriting_retriever(llm, retriever, PROMPT, mode=mode)
+    inputs = {"input": "and its suppliers?", "chat_history": [("human", "Where is ZX-4471?")], "scope": {"sources": [first]}}
+
+    async def run():
+        task = asyncio.ensure_future(rewriting.ainvoke(inputs))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert llm.cancelled == [True]
+
+class SlowChatModel(FakeListChatModel):
+    # A rewrite that takes 0.4s and returns the question unchanged
+    def _generate(self, *args, **kwargs):
+        time.sleep(0.4)
+        return super()._generate(*args, **kwargs)
+
+    async def _agenerate(self, *args, **kwargs):
+        await asyncio.sleep(0.4)
+        return await super()._agenerate(*args, **kwargs)
+
+class SlowRetriever(BaseRetriever):
+    # A retrieval that takes 0.2s
+    def _get_relevant_documents(self, query, *, run_manager):
+        with stage("retrieval"):
+            time.sleep(0.2)
+        return [Document(page_content=query)]
+
+    async def _aget_relevant_documents(self, query, *, run_manager):
+        with stage("retrieval"):
+            await asyncio.sleep(0.2)
+        return [Document(page_content=query)]
+
+@pytest.mark.parametrize("run_async", [False, True])
+def test_speculative_retrieval_is_not_counted_twice(run_async):
+    query = "and its suppliers?"
+    rewriting = query_data_v2.create_rewriting_retriever(SlowChatModel(responses=[query]), SlowRetriever(), PROMPT, mode="speculative")
+    inputs = {"input": query, "chat_history": [("human", "Where is ZX-4471?")]}
+
+    async def run():
+        timings = start_timings()
+        start = time.perf_counter()
+        documents = await rewriting.ainvoke(inputs) if run_async else rewriting.invoke(inputs)
+        return timings, time.perf_counter() - start, documents
+
+    timings, elapsed, documents = asyncio.run(run())
+    assert documents[0].page_content == query
+    # The retrieval ran during the rewrite, so hardly any retrieval time is added after it
+    assert timings["rewrite"] >= 0.4
+    assert timings["retrieval"] < 0.1
+    assert timings["rewrite"] + timings["retrieval"] <= elapsed
+
+def test_table_queries_are_awaited(store):
+    write(os.path.join("data", "offices.csv"), "city,staff\nBoston,7\nDenver,12\n")
+    store.ingest_data_directory()
+    table = store.load_vector_store()._collection.get(include=["metadatas"])["metadatas"][0]["table"]
+
+    hybrid = query_data_v2.HybridRetriever(vector_store=store.load_vector_store(), lexical_index=load_lexical_index(), k=4)
+    llm = FakeListChatModel(responses=[f"```sql\nSELECT SUM(staff) AS total FROM {table}\n```"])
+    retriever = query_data_v2.TableQueryRetriever(retriever=hybrid, llm=llm)
+    documents = asyncio.run(retriever.ainvoke("How many staff in total?", scope={"file_types": ["csv"]}))
+    assert "total\n19" in documents[0].page_content
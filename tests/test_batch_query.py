@@ -0,0 +1,26 @@
+import json
+
+from batch_query import read_records
+
+def write_records(path, records):
+    path.write_text("\n".join(json.dumps(record) for record in records) + "\n\n", encoding="utf-8")
+    return str(path)
+
+def test_records_get_their_own_session(tmp_path):
+    path = write_records(tmp_path / "questions.jsonl", [
+        {"question": "What is A?"},
+        {"question": "What is B?"},
+        {"question": "And then?", "session": 7},
+        {"question": "Why?", "session_id": "7"},
+    ])
+    records = read_records(path, "llama3")
+    assert len(records) == 4
+    assert records[0]["session"] != records[1]["session"]
+    assert records[2]["session"] == records[3]["session"] == "7"
+    assert {record["model"] for record in records} == {"llama3"}
+
+def test_default_session_is_shared(tmp_path):
+    path = write_records(tmp_path / "questions.jsonl", [{"question": "What is A?"}, {"question": "What is B?", "model": "gpt-4-turbo"}])
+    records = read_records(path, "llama3", "shared")
+    assert [record["session"] for record in records] == ["shared", "shared"]
+    assert records[1]["model"] == "gpt-4-turbo"
@@ -0,0 +1,81 @@
+from langchain.schema.document import Document
+
+import query_data_v2
+from query_data_v2 import context_budget, context_sources, estimate_tokens, merge_adjacent_chunks, pack_context
+
+PAGE = "".join(f"Sentence number {i:03d} of the page. " for i in range(100))
+
+def chunk(start, end, page=0, source="data/a.pdf", chunk_id=None):
+    metadata = {"source": source, "page": page, "start_index": start, "end_index": end, "id": chunk_id or f"{source}:{page}:{start}"}
+    return Document(page_content=PAGE[start:end], metadata=metadata)
+
+def test_overlapping_chunks_are_merged_without_repeating_text():
+    first, second = chunk(0, 400), chunk(320, 700)
+    merged = merge_adjacent_chunks([second, first])
+    assert len(merged) == 1
+    assert merged[0].page_content == PAGE[0:700]
+    assert merged[0].metadata["merged_ids"] == [first.metadata["id"], second.metadata["id"]]
+    assert context_sources(merged) == [first.metadata["id"], second.metadata["id"]]
+
+def test_adjacent_chunks_are_merged_and_distant_ones_kept_apart():
+    merged = merge_adjacent_chunks([chunk(0, 100), chunk(101, 200), chunk(500, 600)])
+    assert [document.page_content for document in merged] == [PAGE[0:100] + "\n" + PAGE[101:200], PAGE[500:600]]
+
+def test_chunks_of_other_pages_or_without_offsets_are_not_merged():
+    table = Document(page_content="Table summary", metadata={"source": "data/t.csv", "table": "t", "id": "t"})
+    documents = [chunk(0, 100), chunk(100, 200, page=1), table, chunk(0, 100, source="data/b.pdf")]
+    assert merge_adjacent_chunks(documents) == documents
+
+def test_passages_keep_the_rank_of_their_best_chunk():
+    best, other, later = chunk(500, 600), chunk(0, 100, page=2), chunk(550, 700)
+    merged = merge_adjacent_chunks([best, other, later])
+    assert [document.metadata["id"] for document in merged] == [best.metadata["id"], other.metadata["id"]]
+
+def test_pack_context_skips_what_does_not_fit():
+    small, large, last = chunk(0, 200, page=1), chunk(0, 2000), chunk(0, 40, page=2)
+    budget = estimate_tokens(small.page_content) + estimate_tokens(last.page_content)
+    assert pack_context([small, large, last], budget) == [small, last]
+
+def test_pack_context_cuts_the_best_passage_when_nothing_fits():
+    packed = pack_context([chunk(0, 2000)], 100)
+    assert len(packed) == 1
+    assert estimate_tokens(packed[0].page_content) <= 101
+    assert PAGE.startswith(packed[0].page_content)
+
+def test_pack_context_uses_the_token_counter():
+    documents = [chunk(0, 100), chunk(0, 100, page=1), chunk(0, 100, page=2)]
+    assert len(pack_context(documents, 2, count_tokens=lambda text: 1)) == 2
+
+def test_budgets_follow_the_model_windows(monkeypatch):
+    budgets = {model: context_budget(model) for model in ("gpt-3.5-turbo-0125", "gpt-4-turbo", "llama3")}
+    assert budgets["gpt-4-turbo"] > budgets["gpt-3.5-turbo-0125"] > budgets["llama3"]
+    assert budgets["llama3"] <= query_data_v2.OLLAMA_CONTEXT_WINDOW - query_data_v2.CONTEXT_RESERVE_TOKENS
+
+    monkeypatch.setitem(query_data_v2.MODEL_CONTEXT_WINDOWS, "llama3:70b", 32768)
+    assert context_budget("llama3:70b") > budgets["llama3"]
+    monkeypatch.setitem(query_data_v2.CONTEXT_BUDGETS, "llama3", 3000)
+    assert context_budget("llama3") == 3000
+
+def test_default_budgets_keep_the_old_context():
+    # The RETRIEVAL_K full chunks sent before context assembly still fit, for every model
+    k = query_data_v2.RETRIEVAL_K
+    documents = [chunk(0, query_data_v2.CHUNK_SIZE, page=page) for page in range(k + 1)]
+    documents = [Document(page_content="x" * query_data_v2.CHUNK_SIZE, metadata=document.metadata) for document in documents]
+    for model in ("gpt-3.5-turbo-0125", "gpt-4-turbo", "llama3"):
+        assert len(pack_context(documents[:k], context_budget(model))) == k, model
+    # and the OpenAI default does not grow far past them
+    assert len(pack_context(documents, context_budget("gpt-3.5-turbo-0125"))) <= k + 1
+
+def test_chunks_with_wrong_offsets_are_not_garbled():
+    first = chunk(0, 400)
+    # Stored offsets claim an overlap the texts do not share.
+    second = Document(page_content=PAGE[600:900], metadata={**chunk(350, 650).metadata, "id": "other"})
+    merged = merge_adjacent_chunks([first, second])
+    assert len(merged) == 1
+    assert merged[0].page_content == PAGE[0:400] + "\n" + PAGE[600:900]
+
+def test_contained_chunk_with_wrong_offsets_is_kept():
+    first = chunk(0, 400)
+    second = Document(page_content=PAGE[600:700], metadata={**chunk(100, 200).metadata, "id": "other"})
+    merged = merge_adjacent_chunks([first, second])
+    assert PAGE[600:700] in merged[0].page_content
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+
+from langchain.schema.document import Document
+
+import dedup
+from dedup import NearDuplicateIndex, minhash
+
+WORDS = "the quick brown fox jumps over the lazy dog while the farmer watches from the old red barn".split()
+
+def chunk(chunk_id, text, source="data/a.txt"):
+    return Document(page_content=text, metadata={"id": chunk_id, "source": source})
+
+def edited(words, count):
+    # The text with its last `count` words replaced
+    return " ".join(words[:len(words) - count] + [f"other{i}" for i in range(count)])
+
+def test_similarity_estimate():
+    text = " ".join(WORDS * 4)
+    assert (minhash(text) == minhash(text)).all()
+    assert (minhash(text) == minhash("completely unrelated words about tax forms and invoices")).mean() < 0.2
+
+def test_threshold(workdir):
+    words = WORDS * 10
+    index = NearDuplicateIndex(path="dedup.db", threshold=0.85)
+    original = chunk("a:0:1", " ".join(words))
+    near = chunk("b:0:1", edited(words, 2), source="data/b.txt")
+    far = chunk("c:0:1", edited(words, 60), source="data/c.txt")
+
+    kept = index.filter([original, near, far])
+    assert [document.metadata["id"] for document in kept] == ["a:0:1", "c:0:1"]
+    assert index.duplicate_sources(["a:0:1"]) == {"a:0:1": ["data/b.txt"]}
+    assert index.kept_ids(["data/b.txt"]) == ["a:0:1"]
+    assert index.kept_ids([]) == []
+    # More sources than older SQLite builds bind in one statement
+    index.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    assert index.kept_ids([f"data/other{i}.txt" for i in range(2000)] + ["data/b.txt"]) == ["a:0:1"]
+
+    # A stored chunk stays stored when it is filtered again.
+    assert index.filter([original]) == [original]
+
+def test_other_writers_are_not_locked_out(workdir, monkeypatch):
+    monkeypatch.setattr(dedup, "DEDUP_COMMIT_INTERVAL", 4)
+    index = NearDuplicateIndex(path="dedup.db")
+    chunks = [chunk(f"a:0:{i}", f"chunk number {i} " + " ".join(WORDS[i:] + WORDS[:i])) for i in range(12)]
+
+    writes = []
+    original_minhash = dedup.minhash
+
+    def minhash_and_write(text):
+        # Another connection writes while filtering is in progress, without waiting
+        if text.startswith("chunk number 7 "):
+            conn = sqlite3.connect("dedup.db", timeout=0)
+            conn.execute("CREATE TABLE IF NOT EXISTS other_writer (value TEXT)")
+            conn.execute("INSERT INTO other_writer VALUES ('written')")
+            conn.commit()
+            conn.close()
+            writes.append(True)
+        return original_minhash(text)
+
+    monkeypatch.setattr(dedup, "minhash", minhash_and_write)
+    assert len(index.filter(chunks)) == 12
+    assert writes == [True]
+
+def test_released_duplicates_are_indexed_in_the_same_run(store):
+    text = " ".join(WORDS * 10)
+    for name in ("a.txt", "b.txt"):
+        with open(os.path.join("data", name), "w", encoding="utf-8") as f:
+            f.write(text)
+    store.ingest_data_directory()
+    a, b = os.path.join("data", "a.txt"), os.path.join("data", "b.txt")
+    assert store.stored_sources() == [a]
+
+    # a.txt no longer holds the chunk b.txt was suppressed under, so b.txt gets its own right away
+    with open(a, "w", encoding="utf-8") as f:
+        f.write("completely unrelated words about tax forms and invoices")
+    assert store.ingest_data_directory() == []
+    assert store.stored_sources() == [a, b]
+    assert NearDuplicateIndex().kept_ids([b]) == []
@@ -0,0 +1,98 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+import manifest
+from embedding_cache import CachedEmbeddings
+from llm_utils import BatchedOllamaEmbeddings
+from ollama_standin import StandinHandler, fake_embedding
+
+class RecordingHandler(StandinHandler):
+    # The stand-in, remembering how many texts every embed response carried
+    batch_sizes = []
+
+    def _send_json(self, status, body):
+        if "embeddings" in body:
+            self.batch_sizes.append(len(body["embeddings"]))
+        super()._send_json(status, body)
+
+@pytest.fixture
+def standin():
+    RecordingHandler.batch_sizes = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", RecordingHandler.batch_sizes
+    server.shutdown()
+    server.server_close()
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    # Remembers every text it embedded
+    embedded: list = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+def test_batches_keep_the_order_of_the_texts(standin):
+    host, batch_sizes = standin
+    embeddings = BatchedOllamaEmbeddings(host=host, batch_size=4, max_in_flight=3)
+    texts = [f"text number {i}" for i in range(10)]
+
+    assert embeddings.embed_documents(texts) == [fake_embedding(text) for text in texts]
+    assert sorted(batch_sizes) == [2, 4, 4]
+    assert embeddings.stats["chunks"] == 10
+    assert embeddings.embed_query("text number 3") == fake_embedding("text number 3")
+
+def test_cache_hits_and_misses(workdir):
+    inner = CountingEmbedding(size=8, embedded=[])
+    cache = CachedEmbeddings(inner, "model@/api/embed", path="cache.db")
+
+    first = cache.embed_documents(["alpha", "beta", "alpha"])
+    assert inner.embedded == ["alpha", "beta"]
+    # Texts that only differ in whitespace share an entry; vectors are stored as float32
+    assert np.allclose(cache.embed_documents(["beta", "  alpha\n"]), [first[1], first[0]])
+    assert inner.embedded == ["alpha", "beta"]
+    assert cache.stats["hits"] == 3 and cache.stats["misses"] == 2
+
+def test_cache_is_keyed_on_the_model_and_endpoint(workdir):
+    inner = CountingEmbedding(size=8, embedded=[])
+    CachedEmbeddings(inner, "model@/api/embeddings", path="cache.db").embed_documents(["alpha"])
+    CachedEmbeddings(inner, "model@/api/embed", path="cache.db").embed_documents(["alpha"])
+    CachedEmbeddings(inner, "other@/api/embed", path="cache.db").embed_documents(["alpha"])
+    assert inner.embedded == ["alpha", "alpha", "alpha"]
+
+def test_cache_evicts_the_least_recently_used(workdir):
+    inner = CountingEmbedding(size=8, embedded=[])
+    cache = CachedEmbeddings(inner, "model@/api/embed", path="cache.db", max_entries=10)
+    for i in range(10):
+        cache.embed_documents([f"text {i}"])
+    cache.embed_documents(["text 0"])
+    cache.embed_documents(["text 10"])
+
+    # Eleven entries are one too many: the cache drops back to 9, keeping the recently used ones
+    assert cache.stats["evictions"] == 2
+    inner.embedded.clear()
+    cache.embed_documents(["text 0", "text 10", "text 1"])
+    assert inner.embedded == ["text 1"]
+
+def test_a_new_embedding_endpoint_embeds_everything_again(store, monkeypatch):
+    embedding = CountingEmbedding(size=32, embedded=[])
+    monkeypatch.setattr(store, "get_embedding_function", lambda: embedding)
+    with open(os.path.join("data", "a.txt"), "w", encoding="utf-8") as f:
+        f.write("A document embedded through the old endpoint.")
+    store.ingest_data_directory()
+    assert manifest.stored_embedding_version() == store.EMBEDDING_VERSION
+
+    embedding.embedded.clear()
+    store.ingest_data_directory()
+    assert embedding.embedded == []
+
+    monkeypatch.setattr(store, "EMBEDDING_VERSION", store.EMBEDDING_VERSION + "-v2")
+    store.ingest_data_directory()
+    assert embedding.embedded == ["A document embedded through the old endpoint."]
+    assert manifest.stored_embedding_version() == store.EMBEDDING_VERSION
@@ -0,0 +1,56 @@
+import os
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from journal import IngestJournal
+
+class CountingEmbedding(DeterministicFakeEmbedding):
+    # Remembers every text it embedded
+    embedded: list = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+def test_interrupted_ingestion_resumes(store, monkeypatch, capsys):
+    embedding = CountingEmbedding(size=32, embedded=[])
+    monkeypatch.setattr(store, "get_embedding_function", lambda: embedding)
+    monkeypatch.setattr(store, "PIPELINE_BATCH_SIZE", 2)
+    monkeypatch.setattr(store, "CHROMA_WRITE_BATCH_SIZE", 1)
+    first = write(os.path.join("data", "a.txt"), "A short finished file.")
+    second = write(os.path.join("data", "b.txt"), "\n\n".join(f"Paragraph {i}: " + "words of the long file " * 40 for i in range(8)))
+
+    # The run stops while writing the second batch of b.txt, one chunk per write
+    write_batch, writes = store._write_batch, []
+
+    def failing_write_batch(db, chunks, embeddings, refreshed=()):
+        if any(chunk.metadata["source"] == second for chunk in chunks):
+            writes.append(chunks)
+            if len(writes) == 3:
+                raise RuntimeError("interrupted")
+        write_batch(db, chunks, embeddings, refreshed)
+
+    monkeypatch.setattr(store, "_write_batch", failing_write_batch)
+    assert store.ingest_data_directory() == [second]
+    written = {chunk.page_content for chunk in writes[0] + writes[1]}
+    assert written and IngestJournal().has_batches(second)
+    assert store.load_vector_store()._collection.get(where={"source": first})["ids"]
+
+    monkeypatch.setattr(store, "_write_batch", write_batch)
+    embedding.embedded.clear()
+    capsys.readouterr()
+    assert store.ingest_data_directory() == []
+    assert f"({len(written)} already written)" in capsys.readouterr().out
+
+    # Neither the finished file nor the finished batch is embedded again, the rest of b.txt is
+    assert "A short finished file." not in embedding.embedded
+    assert not written & set(embedding.embedded)
+    stored = store.load_vector_store()._collection.get(where={"source": second}, include=["documents"])
+    assert set(stored["documents"]) == written | set(embedding.embedded)
+    assert len(stored["ids"]) > len(written)
+    assert not IngestJournal().has_batches(second)
@@ -0,0 +1,161 @@
+import os
+import subprocess
+import sys
+
+from langchain.schema.document import Document
+from langchain_core.runnables import RunnableLambda
+
+import manifest
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+def test_classify_files(workdir):
+    first = write(os.path.join("data", "a.txt"), "first version")
+    second = write(os.path.join("data", "b.txt"), "other file")
+
+    changes = manifest.classify_files([first, second])
+    assert sorted(changes["new"]) == [first, second]
+    manifest.record_files(changes["fingerprints"])
+
+    changes = manifest.classify_files([first, second])
+    assert sorted(changes["unchanged"]) == [first, second]
+
+    write(first, "second version, longer")
+    changes = manifest.classify_files([first, second])
+    assert changes["changed"] == [first]
+    assert changes["unchanged"] == [second]
+
+def test_removed_files_leave_the_manifest(workdir):
+    path = write(os.path.join("data", "a.txt"), "text")
+    manifest.record_files(manifest.classify_files([path])["fingerprints"])
+    version = manifest.corpus_version()
+
+    manifest.remove_from_manifest([path])
+    assert manifest.manifest_paths() == []
+    assert manifest.corpus_version() != version
+
+def test_migration_flag(workdir):
+    assert not manifest.migration_done("example")
+    manifest.mark_migration_done("example")
+    assert manifest.migration_done("example")
+
+def test_cached_chains_see_ingests_of_other_processes(workdir, monkeypatch):
+    import query_data_v2
+
+    builds = []
+    monkeypatch.setattr(query_data_v2, "create_chain", lambda model: builds.append(model) or RunnableLambda(lambda x: x))
+    monkeypatch.setattr(query_data_v2, "_chains", query_data_v2.OrderedDict())
+    chain = query_data_v2.get_chain("llama3")
+    assert query_data_v2.get_chain("llama3") is chain
+
+    # e.g. the watcher, ingesting in its own process
+    subprocess.run([sys.executable, "-c", "import manifest; manifest.bump_index_version()"],
+                   check=True, env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.dirname(os.path.abspath(__file__)))})
+    assert query_data_v2.get_chain("llama3") is not chain
+    assert builds == ["llama3", "llama3"]
+
+def seed_legacy_chunks(db, source, count):
+    # Chunks stored before the manifest existed, with positional IDs
+    ids = [f"{source}:0:{index}" for index in range(count)]
+    documents = [Document(page_content=f"legacy chunk {index} of {source}", metadata={"source": source, "page": 0}) for index in range(count)]
+    db.add_documents(documents, ids=ids)
+    return ids
+
+def test_upgrade_replaces_legacy_chunks(store, capsys):
+    kept = write(os.path.join("data", "kept.txt"), "This document is still on disk. " * 20)
+    gone = os.path.join("data", "gone.txt")
+    manifest.record_embedding_version(store.EMBEDDING_VERSION)
+    db = store.load_vector_store()
+    legacy_kept = seed_legacy_chunks(db, kept, 2)
+    seed_legacy_chunks(db, gone, 3)
+
+    store.ingest_data_directory(dry_run=True)
+    report = capsys.readouterr().out
+    assert f"deleted  {gone}: 3 chunks to delete" in report
+    assert "2 stale chunks to delete" in report
+    assert db._collection.count() == 5
+
+    store.ingest_data_directory()
+    stored = db._collection.get(include=["metadatas"])
+    assert not set(legacy_kept) & set(stored["ids"])
+    assert {metadata["source"] for metadata in stored["metadatas"]} == {kept}
+    assert manifest.migration_done("chroma_sources")
+
+    count = db._collection.count()
+    store.ingest_data_directory()
+    assert db._collection.count() == count
+
+def test_changed_embeddings_are_replaced(store, capsys):
+    path = write(os.path.join("data", "kept.txt"), "This document is still on disk. " * 20)
+    manifest.record_embedding_version("nomic-embed-text@/api/embeddings")
+    db = store.load_vector_store()
+    legacy = seed_legacy_chunks(db, path, 2)
+
+    store.ingest_data_directory(dry_run=True)
+    assert "would be embedded again" in capsys.readouterr().out
+    assert db._collection.count() == 2
+
+    store.ingest_data_directory()
+    db = store.load_vector_store()
+    assert not set(legacy) & set(db._collection.get()["ids"])
+    assert db._collection.count() > 0
+    assert manifest.stored_embedding_version() == store.EMBEDDING_VERSION
+
+def test_unrecorded_normalized_embeddings_are_kept(store, monkeypatch):
+    from langchain_community.embeddings import FakeEmbeddings
+
+    class NormalizedEmbeddings(FakeEmbeddings):
+        def embed_documents(self, texts):
+            return [[1.0] + [0.0] * (self.size - 1) for _ in texts]
+
+    monkeypatch.setattr(store, "get_embedding_function", lambda: NormalizedEmbeddings(size=32))
+    path = write(os.path.join("data", "kept.txt"), "This document is still on disk. " * 20)
+    ids = seed_legacy_chunks(store.load_vector_store(), path, 2)
+
+    assert not store.embeddings_changed()
+    assert manifest.stored_embedding_version() == store.EMBEDDING_VERSION
+    assert store.load_vector_store()._collection.get(ids=ids)["ids"] == ids
+
+def test_reconciliation_of_changed_and_deleted_files(store):
+    first = write(os.path.join("data", "first.txt"), "Alpha paragraph about rivers.\n\n" + "Beta paragraph about lakes. " * 60)
+    second = write(os.path.join("data", "second.txt"), "Gamma paragraph about mountains. " * 10)
+    store.ingest_data_directory()
+    db = store.load_vector_store()
+
+    def ids_of(source):
+        return set(db.get(where={"source": source}, include=[])["ids"])
+
+    first_ids, second_ids = ids_of(first), ids_of(second)
+    assert first_ids and second_ids
+
+    write(first, "Alpha paragraph about oceans.\n\n" + "Beta paragraph about lakes. " * 60)
+    os.remove(second)
+    store.ingest_data_directory()
+
+    changed_ids = ids_of(first)
+    assert changed_ids != first_ids
+    assert changed_ids & first_ids, "unchanged chunks keep their IDs"
+    assert not ids_of(second)
+    assert manifest.manifest_paths() == [first]
+    assert store.load_lexical_index().search("mountains") == []
+
+def test_unchanged_chunks_of_an_edited_file_get_their_new_offsets(store):
+    paragraphs = [f"Paragraph {i} talks about topic {i}. " * 20 for i in range(6)]
+    path = write(os.path.join("data", "edited.txt"), "\n\n".join(paragraphs))
+    store.ingest_data_directory()
+    db = store.load_vector_store()
+    before = set(db._collection.get()["ids"])
+
+    text = "Intro.\n\n" + "\n\n".join(paragraphs)
+    write(path, text)
+    store.ingest_data_directory()
+
+    stored = db._collection.get(include=["metadatas", "documents"])
+    assert len(set(stored["ids"]) & before) >= 5
+    for metadata, content in zip(stored["metadatas"], stored["documents"]):
+        assert text[metadata["start_index"]:metadata["end_index"]] == content
+    for document in store.load_lexical_index().search("Paragraph topic", k=20):
+        assert text[document.metadata["start_index"]:document.metadata["end_index"]] == document.page_content
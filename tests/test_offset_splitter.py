@@ -0,0 +1,40 @@
+import random
+
+import pytest
+from langchain.schema.document import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from offset_splitter import OffsetTextSplitter
+
+def random_text(seed):
+    # Paragraphs of lines of words, with runs of whitespace and a few words longer than a chunk
+    rng = random.Random(seed)
+    paragraphs = []
+    for _ in range(rng.randint(1, 12)):
+        lines = []
+        for _ in range(rng.randint(1, 8)):
+            words = []
+            for _ in range(rng.randint(0, 40)):
+                length = rng.choice([rng.randint(1, 12)] * 30 + [rng.randint(50, 400)])
+                words.append("".join(rng.choice("abcdefghij") for _ in range(length)))
+            lines.append(rng.choice([" ", "  "]).join(words))
+        paragraphs.append("\n".join(lines))
+    return rng.choice(["", "\n", "  "]) + "\n\n".join(paragraphs) + rng.choice(["", "\n\n", " "])
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(1024, 80), (200, 40), (64, 0), (50, 49)])
+@pytest.mark.parametrize("seed", range(20))
+def test_same_chunks_as_recursive_character_splitter(seed, chunk_size, chunk_overlap):
+    text = random_text(seed)
+    expected = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text)
+    assert OffsetTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text) == expected
+
+def test_chunks_know_their_offsets():
+    text = random_text(3)
+    document = Document(page_content=text, metadata={"source": "data/a.pdf", "page": 2})
+    chunks = OffsetTextSplitter(chunk_size=200, chunk_overlap=40).split_documents([document])
+    assert chunks
+    for chunk in chunks:
+        assert text[chunk.metadata["start_index"]:chunk.metadata["end_index"]] == chunk.page_content
+        assert chunk.metadata["page"] == 2
+    starts = [chunk.metadata["start_index"] for chunk in chunks]
+    assert starts == sorted(starts)
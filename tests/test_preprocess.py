@@ -0,0 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import preprocess
+
+def make_pdf(path, page_count):
+    fitz = pytest.importorskip("fitz")
+    pdf = fitz.open()
+    for page_number in range(page_count):
+        pdf.new_page().insert_text((72, 72), f"Page {page_number} of {path.name}")
+    pdf.save(str(path))
+    pdf.close()
+    return str(path)
+
+def test_pymupdf_loader_from_threads(tmp_path):
+    paths = [make_pdf(tmp_path / f"doc{index}.pdf", 5 + index) for index in range(4)]
+
+    def load(path):
+        return preprocess.PyMuPDFPageRangeLoader(path, pages_per_range=2).load()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(load, paths))
+
+    for path, documents in zip(paths, results):
+        assert [document.metadata["page"] for document in documents] == list(range(len(documents)))
+        assert all(document.metadata["source"] == path for document in documents)
+        assert documents[-1].page_content.strip() == f"Page {len(documents) - 1} of {path.rsplit('/', 1)[-1]}"
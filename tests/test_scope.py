@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import query_data_v2
+from query_data_v2 import HybridRetriever, expand_scope, scope_filter
+from lexical_index import load_lexical_index
+
+TEXT = "The quarterly report lists the warehouse inventory of part number ZX-4471 and its suppliers. " * 3
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+def test_scope_filter():
+    assert scope_filter(None) is None
+    assert scope_filter({"sources": ["data/a.txt"]}) == {"source": {"$in": ["data/a.txt"]}}
+    assert scope_filter({"file_types": ["txt"], "ingested_after": 10}) == {
+        "$and": [{"file_type": {"$in": ["txt"]}}, {"ingested_at": {"$gte": 10}}]
+    }
+
+def test_scope_matches_chunks_kept_in_other_documents(store):
+    first = write(os.path.join("data", "first.txt"), TEXT)
+    second = write(os.path.join("data", "second.txt"), TEXT)
+    other = write(os.path.join("data", "other.txt"), "Meeting notes about the office move and the new desks. " * 3)
+    store.ingest_files([first, second, other])
+
+    db = store.load_vector_store()
+    stored_sources = {metadata["source"] for metadata in db._collection.get(include=["metadatas"])["metadatas"]}
+    suppressed = ({first, second} - stored_sources).pop()
+
+    scope = expand_scope({"sources": [suppressed]})
+    assert scope["duplicate_ids"]
+    assert expand_scope({"sources": [other]}) == {"sources": [other]}
+
+    retriever = HybridRetriever(vector_store=db, lexical_index=load_lexical_index(), k=3)
+    documents = retriever.invoke("part number ZX-4471", scope=scope)
+    assert documents
+    assert {document.metadata["id"] for document in documents} <= set(scope["duplicate_ids"])
+
+    lexical_hits = load_lexical_index().search("ZX-4471", scope=scope)
+    assert {document.metadata["id"] for document in lexical_hits} == set(scope["duplicate_ids"])
+    assert not load_lexical_index().search("ZX-4471", scope=expand_scope({"sources": [other]}))
+    assert query_data_v2.scope_key(scope) != query_data_v2.scope_key({"sources": [suppressed]})
+
+def test_filter_metadata_is_backfilled_once(store, monkeypatch):
+    from langchain.schema.document import Document
+
+    db = store.load_vector_store()
+    db.add_documents([Document(page_content="an old chunk", metadata={"source": "data/old.txt", "id": "data/old.txt:0:0"})], ids=["data/old.txt:0:0"])
+
+    store.sync_filter_metadata(db)
+    assert db._collection.get(ids=["data/old.txt:0:0"])["metadatas"][0]["file_type"] == "txt"
+
+    # A new process finds the flag and does not scan the collection again.
+    monkeypatch.setattr(store, "_filter_metadata_synced", False)
+    monkeypatch.setattr(db._collection, "get", lambda *args, **kwargs: pytest.fail("the collection was scanned"))
+    store.sync_filter_metadata(db)
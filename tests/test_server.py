@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from server import RequestCoalescer
+
+class Backend:
+    # A request that streams "first", waits to be released, then streams "second"
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, on_token):
+        self.calls += 1
+        on_token("first")
+        self.started.set()
+        self.release.wait(5)
+        on_token("second")
+        if self.error:
+            raise self.error
+        return "answer"
+
+def run_in_thread(coalescer, key, backend):
+    # Run a request in the background; returns its tokens and a dict for its result or error
+    tokens, outcome = [], {}
+
+    def run():
+        try:
+            outcome["result"] = coalescer.run(key, backend, on_token=tokens.append)
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, tokens, outcome
+
+def test_identical_requests_run_once():
+    coalescer, backend, other_backend = RequestCoalescer(), Backend(), Backend()
+    leader = run_in_thread(coalescer, ("llama3", "s1", "What is A?"), backend)
+    assert backend.started.wait(5)
+    follower = run_in_thread(coalescer, ("llama3", "s1", "What is A?"), backend)
+    # The same question in another session is another request
+    other = run_in_thread(coalescer, ("llama3", "s2", "What is A?"), other_backend)
+    assert other_backend.started.wait(5)
+    time.sleep(0.2)
+    backend.release.set()
+    other_backend.release.set()
+    for thread, _, _ in (leader, follower, other):
+        thread.join(5)
+
+    assert backend.calls == 1 and other_backend.calls == 1
+    # The follower joined after the first token and still gets all of them
+    assert leader[1] == follower[1] == other[1] == ["first", "second"]
+    assert leader[2] == follower[2] == {"result": "answer"}
+    assert coalescer.in_flight() == 0
+
+def test_errors_reach_every_waiter():
+    coalescer, backend = RequestCoalescer(), Backend(error=RuntimeError("backend down"))
+    leader = run_in_thread(coalescer, "key", backend)
+    assert backend.started.wait(5)
+    followers = [run_in_thread(coalescer, "key", backend) for _ in range(3)]
+    time.sleep(0.2)
+    backend.release.set()
+    for thread, _, _ in [leader] + followers:
+        thread.join(5)
+
+    assert backend.calls == 1
+    assert {str(outcome["error"]) for _, _, outcome in [leader] + followers} == {"backend down"}
+    assert coalescer.in_flight() == 0
+
+    # The next identical request runs again
+    with pytest.raises(RuntimeError):
+        coalescer.run("key", backend)
+    assert backend.calls == 2
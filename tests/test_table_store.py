@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import table_store
+
+def load_csv(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return table_store.TableLoader(str(path)).load()
+
+def test_columns_get_one_type(workdir):
+    documents = load_csv(workdir / "data" / "offices.csv", "city,zip,staff,budget\nNew York,10001,12,1.5\nBoston,02139,7,2\n")
+    name = documents[0].metadata["table"]
+
+    for condition in ("zip = '10001'", "zip = 10001", "zip = '02139'"):
+        _, rows, _ = table_store.run_query(f"SELECT city FROM {name} WHERE {condition}")
+        assert len(rows) == 1, condition
+    _, rows, _ = table_store.run_query(f"SELECT typeof(staff), typeof(budget), SUM(budget) FROM {name}")
+    assert rows[0] == ("integer", "real", 3.5)
+    assert "- zip TEXT" in documents[0].page_content
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM table_catalog",
+    "SELECT 1; DROP TABLE table_catalog",
+    "UPDATE table_catalog SET summary = ''",
+    "PRAGMA writable_schema = 1",
+])
+def test_run_query_rejects_writes(workdir, sql):
+    load_csv(workdir / "data" / "offices.csv", "city,zip\nBoston,02139\n")
+    with pytest.raises(ValueError):
+        table_store.run_query(sql)
+
+def test_run_query_is_read_only(workdir):
+    import sqlite3
+
+    load_csv(workdir / "data" / "offices.csv", "city,zip\nBoston,02139\n")
+    with pytest.raises(sqlite3.OperationalError):
+        table_store.run_query("WITH gone AS (SELECT 1) DELETE FROM table_catalog")
+
+def test_summarizing_does_not_write_the_table_store(workdir):
+    import summarize_docs
+
+    with open(workdir / "data" / "offices.csv", "w", encoding="utf-8") as f:
+        f.write("city,zip\nBoston,02139\n")
+    documents = summarize_docs.load_documents_to_summarize()
+    assert "Boston" in documents[0].page_content
+    assert not (workdir / "tables.db").exists()
+
+    table_store.TableLoader(os.path.join("data", "offices.csv")).load()
+    documents = summarize_docs.load_documents_to_summarize()
+    assert documents[0].metadata["table"]
+
+def test_tables_are_reloaded_once_with_column_types(store):
+    import manifest
+
+    path = os.path.join("data", "offices.csv")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("city,zip\nBoston,02139\n")
+    store.ingest_data_directory()
+    assert manifest.migration_done("table_column_types")
+
+    # A table store from before the column types: the table is loaded again by the next run.
+    conn = table_store._connect()
+    conn.execute("DELETE FROM table_catalog")
+    conn.commit()
+    conn.close()
+    conn = manifest.sqlite3.connect(manifest.MANIFEST_DB)
+    conn.execute("DELETE FROM ingest_migrations WHERE name = 'table_column_types'")
+    conn.commit()
+    conn.close()
+
+    store.ingest_data_directory()
+    assert table_store.stored_table_documents([path])
@@ -0,0 +1,72 @@
+import os
+import time
+
+import manifest
+from watcher import DataWatcher
+
+def write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    return path
+
+def watch(monkeypatch, **kwargs):
+    # A started watcher that records the batches it would ingest
+    watcher = DataWatcher(poll=True, poll_interval=60, **kwargs)
+    batches = []
+    monkeypatch.setattr(watcher, "ingest", batches.append)
+    watcher.start(catch_up=False)
+    return watcher, batches
+
+def wait_for(batches, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return batches
+
+def test_bursts_are_ingested_once_quiet(store, monkeypatch):
+    watcher, batches = watch(monkeypatch, debounce=0.3, max_delay=10)
+    try:
+        for name in ("a.txt", "b.txt", "a.txt", "notes.bin"):
+            watcher.notify(os.path.join("data", name))
+            time.sleep(0.05)
+        assert batches == []
+        assert wait_for(batches) == [[os.path.join("data", "a.txt"), os.path.join("data", "b.txt")]]
+    finally:
+        watcher.stop()
+
+def test_a_stream_of_events_is_ingested_after_max_delay(store, monkeypatch):
+    watcher, batches = watch(monkeypatch, debounce=0.3, max_delay=0.5)
+    try:
+        start = time.monotonic()
+        while not batches and time.monotonic() - start < 3:
+            watcher.notify(os.path.join("data", "a.txt"))
+            time.sleep(0.05)
+        assert batches and time.monotonic() - start < 1.5
+    finally:
+        watcher.stop()
+
+def test_absolute_paths_match_the_manifest(workdir, monkeypatch):
+    watcher, batches = watch(monkeypatch, data_path=str(workdir / "data"), debounce=0.05)
+    try:
+        watcher.notify(str(workdir / "data" / "sub" / ".." / "a.pdf"))
+        assert wait_for(batches) == [[os.path.join("data", "a.pdf")]]
+    finally:
+        watcher.stop()
+
+def test_changed_and_deleted_files_are_ingested(store):
+    kept = write(os.path.join("data", "kept.txt"), "A file that does not change.")
+    changed = write(os.path.join("data", "changed.txt"), "The first version of the file.")
+    deleted = write(os.path.join("data", "deleted.txt"), "A file that gets removed.")
+    store.ingest_data_directory()
+    kept_ids = store.load_vector_store()._collection.get(where={"source": kept})["ids"]
+
+    write(changed, "The second version, which is longer than the first.")
+    os.remove(deleted)
+    # The watcher reports absolute paths when it watches an absolute directory
+    DataWatcher(data_path=os.path.abspath("data")).ingest([os.path.abspath(changed), os.path.abspath(deleted)])
+
+    assert store.stored_sources() == [changed, kept]
+    assert sorted(manifest.manifest_paths()) == [changed, kept]
+    stored = store.load_vector_store()._collection.get(where={"source": changed}, include=["documents"])
+    assert stored["documents"] == ["The second version, which is longer than the first."]
+    assert store.load_vector_store()._collection.get(where={"source": kept})["ids"] == kept_ids
@@ -1,29 +1,78 @@
 import argparse
+import hashlib
 import os
+import queue
 import shutil
+import threading
+import time
 
+import numpy as np
 from langchain.schema.document import Document
-from llm_utils import get_embedding_function
+from llm_utils import get_embedding_function, EMBEDDING_VERSION
 from langchain_community.vectorstores.chroma import Chroma
-from preprocess import documents_directory_loader, split_documents
+from preprocess import scan_directory, iter_documents, split_documents
+from manifest import classify_files, record_files, clear_manifest, manifest_paths, remove_from_manifest, migration_done, mark_migration_done, fingerprint
+from manifest import stored_embedding_version, record_embedding_version, stored_index_version, bump_index_version
+from dedup import NearDuplicateIndex, DEDUP_ENABLED
+from journal import IngestJournal
+from table_store import is_table_file, drop_tables, clear_tables
+from lexical_index import load_lexical_index
 
 CHROMA_PATH = "chroma"
 DATA_PATH = "data"
 
-types = [
-    ".pdf",
-    ".docx",
-    ".md",
-    ".pptx",
-    ".xlsx",
-    ".csv"
-]
+# Items (files or chunk batches) each pipeline queue may hold before the upstream stage blocks
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+# Chunks per batch handed from the split stage to the embed and write stages
+PIPELINE_BATCH_SIZE = int(os.getenv("PIPELINE_BATCH_SIZE", 64))
+# Chunks written to Chroma per add() call
+CHROMA_WRITE_BATCH_SIZE = int(os.getenv("CHROMA_WRITE_BATCH_SIZE", 512))
+PROGRESS_INTERVAL = 5
+
+_vector_store = None
+_vector_store_lock = threading.Lock()
+_ingest_lock = threading.Lock()
+_filter_metadata_synced = False
 
 def load_vector_store():
-    # Load the vector store db
-    embedding_function = get_embedding_function()
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
-    return db
+    # Load the vector store db, one handle (and embedding function) is shared by the whole process
+    global _vector_store
+    with _vector_store_lock:
+        if _vector_store is None:
+            embedding_function = get_embedding_function()
+            _vector_store = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
+        return _vector_store
+
+def index_version():
+    # Changes whenever an ingestion or a reset modifies the index, so cached chains get rebuilt.
+    # It is kept in sqlite.db, so ingests run by other processes (watcher, CLI) count too.
+    return stored_index_version()
+def existing_chunk_ids(db, ids: list[str]):
+    """
+    Looks up which of the given chunk IDs are already stored.
+
+    Only the candidate IDs are queried, so the cost grows with the number of
+    candidates rather than with the size of the collection.
+
+    Args:
+        db (Chroma): The vector store.
+        ids (list[str]): The candidate chunk IDs.
+
+    Returns:
+        set: The IDs that already exist in the vector store.
+    """
+    existing = set()
+    for i in range(0, len(ids), CHROMA_WRITE_BATCH_SIZE):
+        existing.update(db.get(ids=ids[i:i + CHROMA_WRITE_BATCH_SIZE], include=[])["ids"])
+    return existing
+
+def stored_metadatas(db, ids: list[str]):
+    # The stored metadata of those of the given chunk IDs that exist, by ID
+    stored = {}
+    for i in range(0, len(ids), CHROMA_WRITE_BATCH_SIZE):
+        result = db._collection.get(ids=ids[i:i + CHROMA_WRITE_BATCH_SIZE], include=["metadatas"])
+        stored.update(zip(result["ids"], result["metadatas"]))
+    return stored
 
 def run_database():
     """
@@ -31,8 +80,12 @@ def run_database():
 
     This function checks if the database should be cleared using the --reset flag.
     If the flag is provided, the function clears the database and then proceeds to process the files.
-    The function processes different file types, loads the documents from the 'data/' directory,
-    splits the documents into chunks, and adds the chunks to the chroma.
+    The function scans the 'data/' directory once, compares the files of every supported type
+    against the ingestion manifest, and streams only the new or changed files through the
+    ingestion pipeline. Chunk IDs are derived from the chunk content, so for changed files only
+    the chunks that changed are embedded and the stale ones are deleted. Chunks of files that
+    were deleted from 'data/' are removed. Near-duplicate chunks are stored once, with the other
+    sources they appeared in. With --dry-run the work is only reported.
 
     Returns:
         bool: True if the database process is completed successfully.
@@ -40,113 +93,625 @@ def run_database():
     # Check if the database should be cleared (using the --reset flag).
     parser = argparse.ArgumentParser()
     parser.add_argument("--reset", action="store_true", help="Reset the database.")
-    args = parser.parse_args()
+    parser.add_argument("--dry-run", action="store_true", help="Report the changes without applying them.")
+    args, _ = parser.parse_known_args()
     if args.reset:
         print("✨ Clearing Database")
         clear_database()
-    
-    docs_used = []
-
-    for file_type in types:
-        print(f"Processing {file_type} files...")
-        documents = documents_directory_loader(file_type, 'data/')
-        if documents:
-            docs_used.append(documents)
-        chunks = split_documents(documents)
-        # print(f"Chunks: {chunks}")
-        add_to_chroma(file_type, chunks)
 
+    ingest_data_directory(dry_run=args.dry_run)
+    return True
+
+def ingest_data_directory(dry_run=False):
+    """
+    Scans the 'data/' directory and ingests the files that are new, changed or deleted
+    since the last run.
+
+    The first run also removes the chunks of files that were deleted before the manifest
+    existed, by comparing the sources stored in Chroma with the files on disk, and the
+    first run with typed table columns reloads the spreadsheets of the table store.
+
+    When the stored vectors come from another embedding model or endpoint than
+    EMBEDDING_VERSION (or from before it was recorded), the database is reset and every
+    file is embedded again, since vectors of different embeddings cannot be compared.
+
+    Args:
+        dry_run (bool): Only report the work that would be done.
+
+    Returns:
+        list[str]: The files that failed to load.
+    """
+    files_by_type = scan_directory(DATA_PATH)
+    file_paths = [path for paths in files_by_type.values() for path in paths]
+    if embeddings_changed():
+        stored = stored_embedding_version() or "an earlier embedding endpoint"
+        if dry_run:
+            print(f"📝 Dry run: the vectors come from {stored}, all {len(file_paths)} files would be embedded again with {EMBEDDING_VERSION}")
+            return []
+        print(f"🔁 The vectors come from {stored}, embedding every file again with {EMBEDDING_VERSION}")
+        clear_database()
+        record_embedding_version(EMBEDDING_VERSION)
+    on_disk = set(file_paths)
+    deleted = [path for path in manifest_paths() if path not in on_disk]
+    if not migration_done("chroma_sources"):
+        known = set(deleted)
+        deleted += [source for source in stored_sources() if source not in on_disk and source not in known]
+
+    reload = [] if migration_done("table_column_types") else [path for path in file_paths if is_table_file(path)]
+
+    failed = ingest_files(file_paths, deleted, dry_run=dry_run, reload=reload)
+    if not dry_run:
+        mark_migration_done("chroma_sources")
+        mark_migration_done("table_column_types")
+    return failed
+
+def ingest_files(file_paths: list[str], deleted=(), dry_run=False, reload=()):
+    """
+    Brings the vector store up to date for the given files.
+
+    Files are compared against the ingestion manifest and only new or changed ones go
+    through the ingestion pipeline. Chunks of the deleted files are removed. A file that
+    is new to the manifest but already has chunks in Chroma (stored before the manifest
+    existed, under positional IDs) is re-indexed, so its old chunks are replaced. Only one
+    ingestion runs at a time, whether it comes from run_database or the data watcher.
+
+    Args:
+        file_paths (list[str]): Files that exist on disk.
+        deleted (list[str]): Files that were removed from disk.
+        dry_run (bool): Only report the work that would be done.
+        reload (list[str]): Unchanged files to ingest again anyway.
+
+    Returns:
+        list[str]: The files that failed to load.
+    """
+    if not dry_run and embeddings_changed():
+        # The whole store is embedded again, not only these files.
+        return ingest_data_directory()
+
+    with _ingest_lock:
+        journal = IngestJournal()
+        if deleted and not dry_run:
+            delete_sources_from_chroma(deleted)
+            drop_tables(deleted)
+            remove_from_manifest(deleted)
+            journal.forget(deleted)
+            if DEDUP_ENABLED:
+                # Files whose duplicates were only stored under a deleted file get indexed again.
+                dedup_index = NearDuplicateIndex()
+                released = [released for path in deleted for released in dedup_index.release(path)]
+                remove_from_manifest(released)
+                file_paths = list(file_paths) + [
+                    path for path in released if os.path.exists(path) and path not in file_paths
+                ]
+
+        changes = classify_files(file_paths)
+        skipped, added, reindexed = changes["unchanged"], changes["new"], changes["changed"]
+        for path in [path for path in skipped if path in reload]:
+            skipped.remove(path)
+            reindexed.append(path)
+            changes["fingerprints"][path] = fingerprint(path)
+        db = load_vector_store()
+        replace_sources = reindexed + [path for path in added if has_stored_chunks(db, path)]
+
+        if dry_run:
+            report_reconciliation(added, reindexed, deleted, skipped)
+            return []
+
+        to_load, given_up = journal.begin({path: changes["fingerprints"][path] for path in added + reindexed})
+        if to_load:
+            def on_file_done(path):
+                record_files({path: changes["fingerprints"][path]})
+                journal.mark_file_done(path)
+
+            result = run_ingest_pipeline(to_load, replace_sources=replace_sources, on_file_done=on_file_done, journal=journal)
+            failed = result["failed"] + given_up
+            # Files that lost the chunks their duplicates were stored under are indexed again right away.
+            done = set(to_load)
+            released = [path for path in result["released"] if os.path.exists(path) and path not in failed]
+            while released:
+                print(f"🔄 Re-indexing files whose duplicates were removed: {released}")
+                done.update(released)
+                reindexed += [path for path in released if path not in reindexed]
+                changes["fingerprints"].update((path, fingerprint(path)) for path in released)
+                to_load, given_up = journal.begin({path: changes["fingerprints"][path] for path in released})
+                result = run_ingest_pipeline(to_load, replace_sources=to_load, on_file_done=on_file_done, journal=journal)
+                failed += result["failed"] + given_up
+                released = [path for path in result["released"] if os.path.exists(path) and path not in done]
+            bump_index_version()
+        else:
+            failed = given_up
+            print("✅ No new or changed files\n")
+            if deleted:
+                bump_index_version()
+
+        print(f"⏭️ Skipped unchanged files: {len(skipped)}")
+        print(f"👉 Added files: {len([path for path in added if path not in failed])}")
+        print(f"🔄 Re-indexed files: {len([path for path in reindexed if path not in failed])}")
+        print(f"🗑️ Removed deleted files: {len(deleted)}")
+        if failed:
+            print(f"❌ Failed files (retried on the next run): {failed}")
+        return failed
+
+def embeddings_changed():
+    # Whether the stored vectors were made with another embedding than EMBEDDING_VERSION
+    stored = stored_embedding_version()
+    if stored == EMBEDDING_VERSION:
+        return False
+    sample = load_vector_store()._collection.get(limit=1, include=["embeddings"])["embeddings"]
+    # Before the version was recorded, /api/embed vectors are told apart by being normalized.
+    if len(sample) == 0 or (stored is None and abs(np.linalg.norm(sample[0]) - 1.0) < 1e-3):
+        record_embedding_version(EMBEDDING_VERSION)
+        return False
     return True
 
 def clear_database():
     # Clear database function
-    if os.path.exists(CHROMA_PATH):
+    global _vector_store
+    with _vector_store_lock:
+        db, _vector_store = _vector_store, None
+    if db is not None:
+        # Chroma keeps the files of an open database in use, so its collection is dropped instead.
+        db.delete_collection()
+    elif os.path.exists(CHROMA_PATH):
         shutil.rmtree(CHROMA_PATH)
     else:
         print("No database to clear.")
+    clear_manifest()
+    NearDuplicateIndex().clear()
+    IngestJournal().clear()
+    clear_tables()
+    load_lexical_index().clear()
+    bump_index_version()
 
-def docs_used_in_chroma():
+def filter_metadata(source, ingested_at):
+    # The metadata retrieval can be scoped by, besides the source: file type, folder and ingestion time
+    return {
+        "file_type": os.path.splitext(source)[1].lower().lstrip("."),
+        "folder": os.path.dirname(source),
+        "ingested_at": int(ingested_at),
+    }
+
+def add_filter_metadata(chunks, ingested_at=None):
+    ingested_at = time.time() if ingested_at is None else ingested_at
+    for chunk in chunks:
+        chunk.metadata.update(filter_metadata(chunk.metadata.get("source", ""), ingested_at))
+    return chunks
+
+def sync_filter_metadata(db=None):
+    # Add the filter metadata to chunks stored before it existed, once per database; they get the current time
+    global _filter_metadata_synced
+    if _filter_metadata_synced:
+        return
+    if migration_done("filter_metadata"):
+        _filter_metadata_synced = True
+        return
+    db = db or load_vector_store()
+    total = db._collection.count()
+    with_metadata = len(db._collection.get(where={"ingested_at": {"$gte": 0}}, include=[])["ids"]) if total else 0
+    if with_metadata < total:
+        print(f"🏷️ Adding filter metadata to {total - with_metadata} chunks")
+        now = time.time()
+        for offset in range(0, total, CHROMA_WRITE_BATCH_SIZE):
+            stored = db._collection.get(offset=offset, limit=CHROMA_WRITE_BATCH_SIZE, include=["metadatas", "documents"])
+            chunks = [
+                Document(page_content=content, metadata={**metadata, "id": chunk_id})
+                for chunk_id, metadata, content in zip(stored["ids"], stored["metadatas"], stored["documents"])
+                if "ingested_at" not in metadata
+            ]
+            if chunks:
+                add_filter_metadata(chunks, now)
+                db._collection.update(ids=[chunk.metadata["id"] for chunk in chunks], metadatas=[chunk.metadata for chunk in chunks])
+                load_lexical_index().add(chunks)
+    mark_migration_done("filter_metadata")
+    _filter_metadata_synced = True
+
+def delete_sources_from_chroma(sources: list[str], db=None):
     """
-    Retrieves the list of documents used in the chroma analysis.
+    Removes every chunk that was loaded from the given source files, in bulk.
+
+    Args:
+        sources (list[str]): The source paths whose chunks should be deleted.
+        db (Chroma): An already open vector store, loaded when not given.
 
     Returns:
-        list: A list of document IDs used in the chroma analysis.
+        None
     """
-    db = load_vector_store()
-    all_ids = db.get(include=[])["ids"]
+    if not sources:
+        return
+    db = db or load_vector_store()
+    load_lexical_index().delete_sources(sources)
+    stale_ids = db.get(where={"source": {"$in": list(sources)}}, include=[])["ids"]
+    if stale_ids:
+        print(f"🗑️ Removing {len(stale_ids)} chunks of {len(sources)} files")
+        for i in range(0, len(stale_ids), CHROMA_WRITE_BATCH_SIZE):
+            db.delete(ids=stale_ids[i:i + CHROMA_WRITE_BATCH_SIZE])
 
-    docs_used = list(set([doc_id.split(":")[0] for doc_id in all_ids]))
-    print(f"Number of documents in DB: {len(docs_used)}")
-    print(f"docs_used: \n{docs_used}")
-    return docs_used
+def has_stored_chunks(db, source: str):
+    return bool(db.get(where={"source": source}, limit=1, include=[])["ids"])
 
+def stored_sources(db=None):
+    # The distinct sources of the chunks stored in Chroma, read in batches
+    db = db or load_vector_store()
+    sources = set()
+    for offset in range(0, db._collection.count(), CHROMA_WRITE_BATCH_SIZE):
+        stored = db._collection.get(offset=offset, limit=CHROMA_WRITE_BATCH_SIZE, include=["metadatas"])
+        sources.update(metadata.get("source") for metadata in stored["metadatas"] if metadata)
+    sources.discard(None)
+    return sorted(sources)
 
-def add_to_chroma(file_type: str, chunks: list[Document]):
+def stale_chunk_ids(db, source: str, chunk_ids: list[str]):
+    # IDs stored for a source that are not among its current chunk IDs
+    stored_ids = db.get(where={"source": source}, include=[])["ids"]
+    current_ids = set(chunk_ids)
+    return [chunk_id for chunk_id in stored_ids if chunk_id not in current_ids]
+
+def sync_lexical_index(db=None):
+    # Build the lexical index from the vector store when it was created before the index existed
+    db = db or load_vector_store()
+    lexical_index = load_lexical_index()
+    if lexical_index.count() or not db._collection.count():
+        return
+    total = db._collection.count()
+    print(f"🔤 Building the lexical index for {total} chunks")
+    for offset in range(0, total, CHROMA_WRITE_BATCH_SIZE):
+        stored = db._collection.get(offset=offset, limit=CHROMA_WRITE_BATCH_SIZE, include=["metadatas", "documents"])
+        lexical_index.add([
+            Document(page_content=content, metadata={**metadata, "id": chunk_id})
+            for chunk_id, metadata, content in zip(stored["ids"], stored["metadatas"], stored["documents"])
+        ])
+
+def report_reconciliation(added, reindexed, deleted, skipped):
     """
-    Adds new documents to the Chroma database.
+    Prints the work a run would do without writing anything.
+
+    New and changed files are loaded and split to count the chunks that would be
+    embedded and the stale chunks that would be deleted.
 
     Args:
-        file_type (str): The type of file being added.
-        chunks (list[Document]): A list of Document objects representing the new documents.
+        added (list[str]): New files.
+        reindexed (list[str]): Changed files.
+        deleted (list[str]): Files recorded in the manifest or Chroma that are gone from disk.
+        skipped (list[str]): Unchanged files.
 
     Returns:
         None
     """
-    # Load the existing database.
-    db = Chroma(
-        persist_directory=CHROMA_PATH, embedding_function=get_embedding_function()
+    db = load_vector_store()
+    total_upserts, total_deletes = 0, 0
+    print("📝 Dry run, nothing will be written")
+
+    # Spreadsheets are not loaded: that would already write them to the table store.
+    for file_path in [path for path in added + reindexed if is_table_file(path)]:
+        status = "changed" if file_path in reindexed else "new"
+        print(f"  {status:<8} {file_path}: would be loaded into the table store")
+
+    # Streamed files arrive in parts; their chunk IDs are collected until the last one.
+    file_chunk_ids = {}
+    for file_path, documents, error, last in iter_documents([path for path in added + reindexed if not is_table_file(path)]):
+        if error:
+            file_chunk_ids.pop(file_path, None)
+            print(f"  ❌ {file_path}: would fail to load ({error})")
+            continue
+        chunk_ids = file_chunk_ids.setdefault(file_path, [])
+        chunk_ids.extend(chunk.metadata["id"] for chunk in calculate_chunk_ids(split_documents(documents)))
+        if not last:
+            continue
+        del file_chunk_ids[file_path]
+        upserts = len(chunk_ids) - len(existing_chunk_ids(db, chunk_ids))
+        deletes = len(stale_chunk_ids(db, file_path, chunk_ids))
+        total_upserts += upserts
+        total_deletes += deletes
+        status = "changed" if file_path in reindexed else "new"
+        print(f"  {status:<8} {file_path}: {upserts} chunks to embed, {deletes} stale chunks to delete")
+
+    for file_path in deleted:
+        deletes = len(db.get(where={"source": file_path}, include=[])["ids"])
+        total_deletes += deletes
+        print(f"  deleted  {file_path}: {deletes} chunks to delete")
+
+    print(
+        f"📝 {len(skipped)} unchanged, {len(added)} new, {len(reindexed)} changed, {len(deleted)} deleted files;"
+        f" {total_upserts} chunks to embed, {total_deletes} chunks to delete"
     )
 
-    # Calculate Page IDs.
-    chunks_with_ids = calculate_chunk_ids(chunks)
-
-    # Add or Update the documents.
-    existing_items = db.get(include=[])  # IDs are always included by default
-    existing_ids = set(existing_items["ids"])
-    print(f"Number of existing documents in DB: {len(existing_ids)}")
-
-    # Only add documents that don't exist in the DB.
-    new_chunks = []
-    for chunk in chunks_with_ids:
-        if chunk.metadata["id"] not in existing_ids:
-            new_chunks.append(chunk)
-
-    if len(new_chunks):
-        print(f"👉 Adding new documents: {len(new_chunks)}")
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        db.add_documents(new_chunks, ids=new_chunk_ids)
-        # db.persist()
-    else:
-        print(f"✅ No new documents {file_type} to add\n")
+def docs_used_in_chroma():
+    """
+    Retrieves the list of documents used in the chroma analysis.
+
+    Returns:
+        list: A list of document IDs used in the chroma analysis.
+    """
+    db = load_vector_store()
+    all_ids = db.get(include=[])["ids"]
 
+    docs_used = list(set([doc_id.split(":")[0] for doc_id in all_ids]))
+    print(f"Number of documents in DB: {len(docs_used)}")
+    print(f"docs_used: \n{docs_used}")
+    return docs_used
 
 def calculate_chunk_ids(chunks):
-    # This will create IDs like "data/monopoly.pdf:6:2"
-    # Page Source : Page Number : Chunk Index
+    # This will create IDs like "data/monopoly.pdf:6:3f2a9c0b1d4e5f60"
+    # Page Source : Page Number : Chunk Content Hash
+    # Spreadsheets use their row range instead of the page, e.g. "data/sales.xlsx:Q1!2-201:...".
+    # A chunk keeps its ID as long as its text and page do not change, wherever it sits in the
+    # file. Repeated text on the same page gets a "-1", "-2", ... suffix.
 
-    last_page_id = None
-    current_chunk_index = 0
+    seen_ids = {}
 
     for chunk in chunks:
         source = chunk.metadata.get("source")
-        page = chunk.metadata.get("page")
-        current_page_id = f"{source}:{page}"
-
-        # If the page ID is the same as the last one, increment the index.
-        if current_page_id == last_page_id:
-            current_chunk_index += 1
-        else:
-            current_chunk_index = 0
+        page = chunk.metadata.get("rows", chunk.metadata.get("page"))
+        content_hash = hashlib.sha1(chunk.page_content.encode("utf-8")).hexdigest()[:16]
+        chunk_id = f"{source}:{page}:{content_hash}"
 
-        # Calculate the chunk ID.
-        chunk_id = f"{current_page_id}:{current_chunk_index}"
-        last_page_id = current_page_id
+        occurrence = seen_ids.get(chunk_id, 0)
+        seen_ids[chunk_id] = occurrence + 1
+        if occurrence:
+            chunk_id = f"{chunk_id}-{occurrence}"
 
         # Add it to the page meta-data.
         chunk.metadata["id"] = chunk_id
 
     return chunks
 
+def _put(q, item, stop):
+    # Blocking put that gives up once another stage has failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q, stop):
+    # Blocking get that gives up once another stage has failed
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return None
+
+def _load_stage(file_paths, out_queue, stop, progress):
+    for file_path, documents, error, last in iter_documents(file_paths):
+        if last:
+            progress["load"] += 1
+        if not _put(out_queue, (file_path, documents, error, last), stop):
+            return
+    _put(out_queue, None, stop)
+
+def _release_duplicates(dedup_index, file_path, released, chunk_ids=None):
+    # Sources whose duplicates were only stored under the removed chunks are collected for
+    # ingest_files to index again, and leave the manifest in case this run does not get to them
+    sources = dedup_index.release(file_path, chunk_ids)
+    if sources:
+        remove_from_manifest(sources)
+        released.extend(source for source in sources if source not in released)
+
+def _split_stage(db, dedup_index, journal, in_queue, out_queue, stop, progress, failed, replace_sources, released):
+    streamed = set()
+    while (item := _get(in_queue, stop)) is not None:
+        file_path, documents, error, last = item
+        if error:
+            streamed.discard(file_path)
+            print(f"❌ Failed to load {file_path}: {error}")
+            failed.append(file_path)
+            if journal:
+                journal.mark_file_failed(file_path, error)
+            continue
+
+        chunks = add_filter_metadata(calculate_chunk_ids(split_documents(documents)))
+        del documents
+        progress["split"] += len(chunks)
+
+        # Chunks whose content changed get new IDs; drop the ones that are no longer produced.
+        if file_path in replace_sources and file_path not in streamed:
+            if last:
+                chunk_ids = [chunk.metadata["id"] for chunk in chunks]
+                stale_ids = stale_chunk_ids(db, file_path, chunk_ids)
+                if stale_ids:
+                    print(f"🗑️ Removing {len(stale_ids)} stale chunks of {file_path}")
+                    db.delete(ids=stale_ids)
+                    load_lexical_index().delete_ids(stale_ids)
+                if dedup_index:
+                    _release_duplicates(dedup_index, file_path, released, chunk_ids)
+            else:
+                # A streamed file is never held whole, so its stale chunks cannot be told apart:
+                # all of them are replaced, unless an interrupted run already started writing the new ones.
+                streamed.add(file_path)
+                if not (journal and journal.has_batches(file_path)):
+                    delete_sources_from_chroma([file_path], db)
+                    if dedup_index:
+                        _release_duplicates(dedup_index, file_path, released)
+        if last:
+            streamed.discard(file_path)
+
+        if dedup_index:
+            chunks = dedup_index.filter(chunks)
+        for i in range(0, len(chunks), PIPELINE_BATCH_SIZE):
+            batch = chunks[i:i + PIPELINE_BATCH_SIZE]
+            batch_id = journal.batch_id(file_path, batch) if journal else None
+            # Batches flushed before an interruption are not embedded again.
+            if journal and journal.batch_done(batch_id):
+                progress["resumed"] += len(batch)
+                continue
+            if not _put(out_queue, ("chunks", batch, (batch_id, file_path)), stop):
+                return
+        if last and not _put(out_queue, ("done", file_path), stop):
+            return
+    _put(out_queue, None, stop)
+
+def _embed_stage(db, embedding_function, in_queue, out_queue, stop, progress):
+    while (item := _get(in_queue, stop)) is not None:
+        if item[0] == "chunks":
+            # Skip chunks that are already stored before paying for their embeddings. Their text is
+            # unchanged but their offsets and ingestion time may not be, so their metadata is refreshed.
+            chunks = item[1]
+            stored = stored_metadatas(db, [chunk.metadata["id"] for chunk in chunks])
+            refreshed = [
+                Document(page_content=chunk.page_content, metadata={**stored[chunk.metadata["id"]], **chunk.metadata})
+                for chunk in chunks if chunk.metadata["id"] in stored
+            ]
+            chunks = [chunk for chunk in chunks if chunk.metadata["id"] not in stored]
+            embeddings = embedding_function.embed_documents([chunk.page_content for chunk in chunks]) if chunks else []
+            progress["embed"] += len(chunks)
+            item = ("chunks", chunks, embeddings, item[2], refreshed)
+        if not _put(out_queue, item, stop):
+            return
+    _put(out_queue, None, stop)
+
+def _write_batch(db, chunks, embeddings, refreshed=()):
+    # Write new chunks with their embeddings, and only the metadata of the refreshed ones
+    if chunks:
+        db._collection.upsert(
+            ids=[chunk.metadata["id"] for chunk in chunks],
+            embeddings=embeddings,
+            metadatas=[chunk.metadata for chunk in chunks],
+            documents=[chunk.page_content for chunk in chunks],
+        )
+    if refreshed:
+        db._collection.update(ids=[chunk.metadata["id"] for chunk in refreshed], metadatas=[chunk.metadata for chunk in refreshed])
+    load_lexical_index().add(list(chunks) + list(refreshed))
+
+def _write_stage(db, journal, in_queue, stop, progress, on_file_done, loaded):
+    # Chunks are buffered up to CHROMA_WRITE_BATCH_SIZE; a file counts as done once its buffer is flushed.
+    pending_chunks, pending_embeddings, pending_refreshed, pending_files, pending_batches = [], [], [], [], []
+
+    def flush():
+        for i in range(0, max(len(pending_chunks), len(pending_refreshed)), CHROMA_WRITE_BATCH_SIZE):
+            end = i + CHROMA_WRITE_BATCH_SIZE
+            _write_batch(db, pending_chunks[i:end], pending_embeddings[i:end], pending_refreshed[i:end])
+        progress["write"] += len(pending_chunks)
+        pending_chunks.clear()
+        pending_embeddings.clear()
+        pending_refreshed.clear()
+        if journal:
+            journal.mark_batches_done(pending_batches)
+        pending_batches.clear()
+        for file_path in pending_files:
+            loaded.append(file_path)
+            if on_file_done:
+                on_file_done(file_path)
+        pending_files.clear()
+
+    while (item := _get(in_queue, stop)) is not None:
+        if item[0] == "chunks":
+            pending_chunks.extend(item[1])
+            pending_embeddings.extend(item[2])
+            pending_batches.append(item[3])
+            pending_refreshed.extend(item[4])
+            if len(pending_chunks) + len(pending_refreshed) >= CHROMA_WRITE_BATCH_SIZE:
+                flush()
+        elif item[0] == "done":
+            pending_files.append(item[1])
+    if not stop.is_set():
+        flush()
+
+def _record_duplicate_sources(db, dedup_index):
+    # Store on every chunk that absorbed near-duplicates the other sources it appeared in
+    kept_ids = list(dedup_index.touched)
+    for i in range(0, len(kept_ids), CHROMA_WRITE_BATCH_SIZE):
+        stored = db._collection.get(ids=kept_ids[i:i + CHROMA_WRITE_BATCH_SIZE], include=["metadatas"])
+        if not stored["ids"]:
+            continue
+        sources = dedup_index.duplicate_sources(stored["ids"])
+        metadatas = []
+        for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            metadata = dict(metadata)
+            metadata["duplicate_sources"] = "; ".join(sources[chunk_id])
+            metadatas.append(metadata)
+        db._collection.update(ids=stored["ids"], metadatas=metadatas)
+
+def _print_progress(progress, total_files, embedding_function):
+    throughput = ""
+    if hasattr(embedding_function, "throughput"):
+        throughput = f" ({embedding_function.throughput():.1f} chunks/s)"
+    if hasattr(embedding_function, "hit_rate"):
+        throughput += f" [cache hit rate {embedding_function.hit_rate():.0%}]"
+    print(
+        f"📊 load: {progress['load']}/{total_files} files | split: {progress['split']} chunks"
+        f" ({progress['resumed']} already written)"
+        f" | embed: {progress['embed']} chunks{throughput} | write: {progress['write']} chunks"
+    )
+
+def run_ingest_pipeline(file_paths: list[str], replace_sources=(), on_file_done=None, journal=None):
+    """
+    Streams files through the load -> split -> embed -> write stages.
+    Near-duplicate chunks are suppressed in the split stage when DEDUP_ENABLED is set.
+
+    Each stage runs in its own thread and hands its output to the next one through a
+    bounded queue, so all stages overlap and only a few files and chunk batches are held
+    in memory at any time, whatever the size of the corpus.
+
+    Args:
+        file_paths (list[str]): The paths of the files to ingest.
+        replace_sources (list[str]): Sources whose stored chunks that are no longer produced get deleted.
+        on_file_done (function): Called with the path of every file once all of its chunks are written.
+        journal (IngestJournal): Records failed files and finished batches, and skips batches finished before.
+
+    Returns:
+        dict: The "loaded" and "failed" file paths, the "released" sources whose near-duplicates
+            were removed with replaced chunks, and the per-stage "progress" counters.
+    """
+    db = load_vector_store()
+    sync_lexical_index(db)
+    sync_filter_metadata(db)
+    embedding_function = db.embeddings
+    dedup_index = NearDuplicateIndex() if DEDUP_ENABLED else None
+    replace_sources = set(replace_sources)
+
+    stop = threading.Event()
+    errors = []
+    progress = {"load": 0, "split": 0, "resumed": 0, "embed": 0, "write": 0}
+    loaded, failed, released = [], [], []
+    documents_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    chunks_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    vectors_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    def run_stage(name, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(f"{name} stage: {type(e).__name__}: {e}")
+            stop.set()
+
+    stages = [
+        threading.Thread(target=run_stage, args=("load", _load_stage, file_paths, documents_queue, stop, progress)),
+        threading.Thread(target=run_stage, args=("split", _split_stage, db, dedup_index, journal, documents_queue, chunks_queue, stop, progress, failed, replace_sources, released)),
+        threading.Thread(target=run_stage, args=("embed", _embed_stage, db, embedding_function, chunks_queue, vectors_queue, stop, progress)),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # The write stage runs on the calling thread; a monitor prints progress meanwhile.
+    finished = threading.Event()
+
+    def monitor():
+        while not finished.wait(PROGRESS_INTERVAL):
+            _print_progress(progress, len(file_paths), embedding_function)
+
+    threading.Thread(target=monitor, daemon=True).start()
+    run_stage("write", _write_stage, db, journal, vectors_queue, stop, progress, on_file_done, loaded)
+    stop.set()
+    for stage in stages:
+        stage.join()
+    finished.set()
+
+    if dedup_index:
+        _record_duplicate_sources(db, dedup_index)
+        dedup_index.report()
+    _print_progress(progress, len(file_paths), embedding_function)
+    for error in errors:
+        print(f"❌ Pipeline stopped: {error}")
+    # Files that were still in flight when a stage failed are reported as failed too.
+    unfinished = [path for path in file_paths if path not in loaded and path not in failed]
+    if journal:
+        for path in unfinished:
+            journal.mark_file_failed(path, errors[0] if errors else "interrupted")
+    failed.extend(unfinished)
+    return {"loaded": loaded, "failed": failed, "released": released, "progress": progress}
+
 # DEBUG
 # if __name__ == "__main__":
 #     run_database()
@@ -0,0 +1,208 @@
+import argparse
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from preprocess import types, scan_directory
+from manifest import manifest_paths
+from vector_store import ingest_files, DATA_PATH
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # watchdog is optional, fall back to polling
+    Observer = None
+    FileSystemEventHandler = object
+
+# Seconds without new events before a burst of changes is ingested
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 2.0))
+# Longest a continuous stream of events can delay ingestion
+WATCH_MAX_DELAY = float(os.getenv("WATCH_MAX_DELAY", 30.0))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 5.0))
+
+def is_supported(path):
+    return os.path.splitext(path)[1].lower() in types
+
+def normalize_path(path):
+    # Paths relative to the working directory, like the "data/..." keys ingest_data_directory stores,
+    # whether the directory was given as an absolute path or reported that way by inotify
+    return os.path.normpath(os.path.relpath(path))
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        self.watcher.notify(event.src_path)
+        if getattr(event, "dest_path", None):
+            self.watcher.notify(event.dest_path)
+
+class DataWatcher:
+    """
+    Watches the data directory and ingests the files that change.
+
+    Changes are picked up with inotify (through watchdog) when it is installed, and by
+    rescanning the directory every `poll_interval` seconds otherwise. Events are
+    debounced: a burst of changes is ingested once the directory has been quiet for
+    `debounce` seconds, or after `max_delay` seconds at most, and only the affected
+    files are passed to the ingestion.
+
+    Args:
+        data_path (str): The directory to watch.
+        debounce (float): Quiet seconds before ingesting.
+        max_delay (float): Maximum seconds between the first event and ingestion.
+        poll (bool): Force the polling fallback.
+        poll_interval (float): Seconds between rescans when polling.
+    """
+
+    def __init__(self, data_path=DATA_PATH, debounce=WATCH_DEBOUNCE, max_delay=WATCH_MAX_DELAY,
+                 poll=False, poll_interval=WATCH_POLL_INTERVAL):
+        self.data_path = data_path
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll = poll or Observer is None
+        self.poll_interval = poll_interval
+
+        self._pending = set()
+        self._first_event = None
+        self._last_event = None
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._observer = None
+
+    def notify(self, path):
+        # Record a changed path, called from the inotify or polling thread
+        path = normalize_path(path)
+        if not is_supported(path):
+            return
+        with self._condition:
+            now = time.monotonic()
+            self._pending.add(path)
+            self._first_event = self._first_event or now
+            self._last_event = now
+            self._condition.notify()
+
+    def _snapshot(self):
+        snapshot = {}
+        for root, _, file_names in os.walk(self.data_path):
+            for file_name in file_names:
+                path = normalize_path(os.path.join(root, file_name))
+                if not is_supported(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+
+    def _poll_loop(self):
+        previous = self._snapshot()
+        while not self._stop.wait(self.poll_interval):
+            current = self._snapshot()
+            for path in set(previous) | set(current):
+                if previous.get(path) != current.get(path):
+                    self.notify(path)
+            previous = current
+
+    def _ingest_loop(self):
+        while not self._stop.is_set():
+            with self._condition:
+                while not self._pending and not self._stop.is_set():
+                    self._condition.wait(1.0)
+                if self._stop.is_set():
+                    return
+
+                now = time.monotonic()
+                quiet_for = now - self._last_event
+                waited = now - self._first_event
+                if quiet_for < self.debounce and waited < self.max_delay:
+                    self._condition.wait(min(self.debounce - quiet_for, self.max_delay - waited))
+                    continue
+
+                paths = sorted(self._pending)
+                self._pending.clear()
+                self._first_event = self._last_event = None
+
+            self.ingest(paths)
+
+    def ingest(self, paths):
+        """
+        Ingests a batch of changed paths.
+
+        Args:
+            paths (list[str]): Paths that were created, modified, moved or deleted.
+        """
+        paths = [normalize_path(path) for path in paths]
+        existing = [path for path in paths if os.path.isfile(path)]
+        known = {normalize_path(path) for path in manifest_paths()}
+        deleted = [path for path in paths if not os.path.exists(path) and path in known]
+        if not existing and not deleted:
+            return
+
+        print(f"👀 {len(existing)} changed and {len(deleted)} deleted files in {self.data_path}")
+        try:
+            ingest_files(existing, deleted)
+        except Exception as e:
+            print(f"❌ Ingestion of watched changes failed: {type(e).__name__}: {e}")
+
+    def start(self, catch_up=True):
+        """
+        Starts watching in background threads.
+
+        Args:
+            catch_up (bool): Ingest everything that changed while nobody was watching first.
+        """
+        if catch_up:
+            files_by_type = scan_directory(self.data_path)
+            file_paths = {normalize_path(path) for paths in files_by_type.values() for path in paths}
+            for path in file_paths | {normalize_path(path) for path in manifest_paths()}:
+                self.notify(path)
+
+        if self.poll:
+            print(f"👀 Polling {self.data_path} every {self.poll_interval:g}s")
+            self._threads.append(threading.Thread(target=self._poll_loop, daemon=True))
+        else:
+            print(f"👀 Watching {self.data_path} with inotify")
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.data_path, recursive=True)
+            self._observer.start()
+
+        self._threads.append(threading.Thread(target=self._ingest_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+        for thread in self._threads:
+            thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch the data directory and keep the vector store up to date.")
+    parser.add_argument("--data", default=DATA_PATH, help="The directory to watch.")
+    parser.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE)
+    parser.add_argument("--poll", action="store_true", help="Poll instead of using inotify.")
+    parser.add_argument("--no-catch-up", action="store_true", help="Skip the initial ingestion of changed files.")
+    args = parser.parse_args()
+
+    watcher = DataWatcher(data_path=args.data, debounce=args.debounce, poll=args.poll)
+    watcher.start(catch_up=not args.no_catch_up)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+
+if __name__ == "__main__":
+    main()